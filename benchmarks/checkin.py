@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''Measure the latency of a client check-in (GET /api/v1/host/<name>/).
+
+Run with: python3 -m benchmarks.checkin [--hosts N] [--rounds N]
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from cya_server import app
+from cya_server.models import container_requests, hosts, host_api_keys
+
+
+def _setup(modelsdir, num_hosts):
+    hosts._model_dir = os.path.join(modelsdir, 'hosts')
+    container_requests._model_dir = os.path.join(modelsdir, 'reqs')
+    os.mkdir(hosts._model_dir)
+    os.mkdir(container_requests._model_dir)
+    client = app.test_client()
+    for x in range(num_hosts):
+        data = {
+            'name': 'host%d' % x,
+            'distro_id': 'ubuntu',
+            'distro_release': '16.04',
+            'distro_codename': 'xenial',
+            'mem_total': 8000000000,
+            'cpu_total': 8,
+            'cpu_type': 'x86_64',
+            'api_key': 'key%d' % x,
+        }
+        resp = client.post('/api/v1/host/', data=json.dumps(data),
+                           content_type='application/json')
+        assert resp.status_code == 201, resp.status_code
+    return client
+
+
+def _checkin_round(client, num_hosts):
+    times = []
+    for x in range(num_hosts):
+        headers = [('Authorization', 'Token key%d' % x)]
+        start = time.time()
+        resp = client.get('/api/v1/host/host%d/?with_containers' % x,
+                          headers=headers)
+        times.append(time.time() - start)
+        assert resp.status_code == 200, resp.status_code
+    return times
+
+
+def _report(label, times):
+    times = sorted(times)
+    avg = sum(times) / len(times)
+    p50 = times[len(times) // 2]
+    p99 = times[min(len(times) - 1, int(len(times) * .99))]
+    print('%-10s checkins=%-5d avg=%.2fms p50=%.2fms p99=%.2fms' % (
+        label, len(times), avg * 1000, p50 * 1000, p99 * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    modelsdir = tempfile.mkdtemp()
+    try:
+        client = _setup(modelsdir, args.hosts)
+
+        # "before": every check-in pays for a full PBKDF2 verify
+        ttl = host_api_keys.ttl
+        host_api_keys.ttl = 0
+        host_api_keys.invalidate()
+        times = []
+        for _ in range(args.rounds):
+            times.extend(_checkin_round(client, args.hosts))
+        _report('uncached', times)
+
+        # "after": only the first check-in of each host is verified
+        host_api_keys.ttl = ttl
+        _checkin_round(client, args.hosts)
+        times = []
+        for _ in range(args.rounds):
+            times.extend(_checkin_round(client, args.hosts))
+        _report('cached', times)
+    finally:
+        shutil.rmtree(modelsdir)
+
+
+if __name__ == '__main__':
+    main()
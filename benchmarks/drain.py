@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''Simulate how long it takes the scheduler to drain a queue of requests.
+
+Every host "checks in" once per round, the way cya_client_lxd.py does once a
+minute from cron. The legacy mode places at most one request per check-in
+of the best host, the batch mode is what container_requests.handle does now.
+
+Run with: python3 -m benchmarks.drain [--hosts N] [--requests N]
+'''
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from cya_server import models
+from cya_server.models import container_requests, hosts, placement
+
+
+def _setup(modelsdir, num_hosts, num_requests):
+    hosts._model_dir = os.path.join(modelsdir, 'hosts')
+    container_requests._model_dir = os.path.join(modelsdir, 'reqs')
+    os.mkdir(hosts._model_dir)
+    os.mkdir(container_requests._model_dir)
+    rand = random.Random(42)
+    for x in range(num_hosts):
+        hosts.create('host%d' % x, {
+            'distro_id': 'ubuntu',
+            'distro_release': '16.04',
+            'distro_codename': 'xenial',
+            'mem_total': rand.choice((32, 64, 128)) * 1000000000,
+            'cpu_total': 8,
+            'cpu_type': 'x86_64',
+            'enlisted': True,
+        })
+        hosts.get('host%d' % x).ping()
+    for x in range(num_requests):
+        container_requests.create('c%d' % x, {
+            'template': 'ubuntu',
+            'release': 'xenial',
+            'date_requested': x,
+            'max_memory': rand.choice((1, 2, 4)) * 1000000000,
+        })
+
+
+def _legacy_handle(host):
+    queue = list(container_requests.list())
+    if not queue:
+        return
+    best = placement.best()
+    if best and best.name == host.name:
+        name = queue[0]
+        mem = container_requests.get(name).max_memory
+        if models._move_request(name, host.name):
+            placement.container_added(host.name, mem)
+
+
+def _drain(handle, num_hosts, max_rounds):
+    polls = 0
+    start = time.time()
+    for rnd in range(1, max_rounds + 1):
+        for x in range(num_hosts):
+            h = hosts.get('host%d' % x)
+            h.ping()
+            handle(h)
+            polls += 1
+            if container_requests.count() == 0:
+                return rnd, polls, time.time() - start
+    return max_rounds, polls, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--max-rounds', type=int, default=1000)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    for label, handle in (('legacy', _legacy_handle),
+                          ('batch', container_requests.handle)):
+        modelsdir = tempfile.mkdtemp()
+        try:
+            _setup(modelsdir, args.hosts, args.requests)
+            rounds, polls, wall = _drain(handle, args.hosts, args.max_rounds)
+            left = container_requests.count()
+            print('%-7s requests=%d hosts=%d rounds(minutes)=%d polls=%d '
+                  'left=%d wall=%.2fs' % (label, args.requests, args.hosts,
+                                          rounds, polls, left, wall))
+        finally:
+            shutil.rmtree(modelsdir)
+
+
+if __name__ == '__main__':
+    main()
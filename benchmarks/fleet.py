@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+'''Simulate a fleet of cya clients and report latency and throughput per
+endpoint.
+
+A synthetic MODELS_DIR with --hosts hosts of --containers containers each,
+--users users and --requests queued container requests is built first.
+Every simulated host then checks in --rounds times the way
+cya_client_lxd._check does:
+
+ * GET its host with containers, sending the ETag of the last full
+   response except on every --full-check-every'th check-in
+ * after a full response, PATCH a batch of container updates
+   (--patch-rate of the time) and its host props (--host-patch-rate)
+ * append --log-bytes to a container log from its last known offset
+   (--log-rate of the time)
+
+Users poll the fleet API (--user-rate per round). Requests go through
+app.test_client(), or a real HTTP server on a local port with --http, so
+nothing leaves the machine. Use benchmarks.load for a remote server.
+
+Run with: python3 -m benchmarks.fleet [--hosts N] [--json results.json]
+'''
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from unittest import mock
+
+from cya_server import app, settings
+from cya_server.models import (
+    container_requests, hosts, shared_storage, users)
+from cya_server.simplemodels import SecretField, get_storage, set_storage
+from cya_server.storage import create_backend
+
+API_KEY = 'fleet-key'
+
+
+def build_models_dir(modelsdir, num_hosts, num_containers, num_users,
+                     num_requests, seed=42):
+    '''Point the model managers at modelsdir and fill it.'''
+    for manager in (hosts, users, shared_storage, container_requests):
+        manager._model_dir = os.path.join(
+            modelsdir, os.path.basename(manager._model_dir))
+        os.makedirs(manager._model_dir, exist_ok=True)
+
+    rand = random.Random(seed)
+    # every host shares a key so setup doesn't pay for a PBKDF2 per host
+    hashed = SecretField('api_key').save(API_KEY)
+    with mock.patch.object(SecretField, 'save', lambda self, x: hashed):
+        for x in range(num_hosts):
+            hosts.create('host%d' % x, {
+                'distro_id': 'ubuntu',
+                'distro_release': '16.04',
+                'distro_codename': 'xenial',
+                'mem_total': rand.choice((32, 64, 128)) * 1000000000,
+                'cpu_total': 8,
+                'cpu_type': 'x86_64',
+                'api_key': API_KEY,
+                'enlisted': True,
+                'containers': [{
+                    'name': 'c%d' % y,
+                    'template': 'ubuntu',
+                    'release': 'xenial',
+                    'max_memory': rand.choice((1, 2, 4)) * 1000000000,
+                    'state': 'RUNNING',
+                } for y in range(num_containers)],
+            })
+            hosts.get('host%d' % x).ping()
+    for x in range(num_users):
+        users.create('user%d' % x, {
+            'nickname': 'user%d' % x,
+            'openid': 'https://openid.example.com/user%d' % x,
+            'approved': True,
+            'api_key': 'user-key%d' % x,
+        })
+    for x in range(num_requests):
+        container_requests.create('r%d' % x, {
+            'template': 'ubuntu',
+            'release': 'xenial',
+            'date_requested': x,
+            'max_memory': rand.choice((1, 2, 4)) * 1000000000,
+        })
+
+
+class _TestClient(object):
+    '''Sends requests straight to the app, one test client per thread.'''
+    def __init__(self):
+        self._local = threading.local()
+
+    def request(self, method, resource, data=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = app.test_client()
+        resp = client.open(resource, method=method, data=data,
+                           headers=list((headers or {}).items()))
+        return resp.status_code, resp.headers.get('ETag'), resp.data
+
+
+class _HTTP(object):
+    '''Sends requests over one kept-alive connection per thread.'''
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+
+    def request(self, method, resource, data=None, headers=None):
+        for attempt in (0, 1):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=60)
+            try:
+                conn.request(method, resource, data, headers or {})
+                resp = conn.getresponse()
+                return resp.status, resp.getheader('ETag'), resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+
+
+def _serve_http():
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Recorder(object):
+    '''Collects the latency of every request by endpoint.'''
+    def __init__(self):
+        self.times = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def call(self, endpoint, transport, method, resource, data=None,
+             headers=None, ok=(200,)):
+        start = time.time()
+        try:
+            status, etag, body = transport.request(
+                method, resource, data, headers)
+        except (http.client.HTTPException, OSError):
+            status, etag, body = None, None, b''
+        elapsed = time.time() - start
+        with self._lock:
+            self.times.setdefault(endpoint, []).append(elapsed)
+            if status not in ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return status, etag, body
+
+    def results(self, wall):
+        endpoints = {}
+        for name, times in sorted(self.times.items()):
+            times = sorted(times)
+            endpoints[name] = {
+                'count': len(times),
+                'errors': self.errors.get(name, 0),
+                'avg_ms': sum(times) * 1000 / len(times),
+                'p50_ms': times[len(times) // 2] * 1000,
+                'p99_ms': times[min(len(times) - 1,
+                                    int(len(times) * .99))] * 1000,
+                'throughput': len(times) / wall,
+            }
+        return endpoints
+
+
+class _Host(object):
+    def __init__(self, name, rand):
+        self.name = name
+        self.rand = rand
+        self.etag = None
+        self.containers = []
+        self.log_sizes = {}
+        self.checkins = 0
+        self.headers = {
+            'content-type': 'application/json',
+            'Authorization': 'Token ' + API_KEY,
+        }
+
+    def checkin(self, transport, rec, args):
+        headers = dict(self.headers)
+        if self.etag and self.checkins % args.full_check_every:
+            headers['If-None-Match'] = self.etag
+        self.checkins += 1
+        status, etag, body = rec.call(
+            'host_get', transport, 'GET',
+            '/api/v1/host/%s/?with_containers' % self.name,
+            headers=headers, ok=(200, 304))
+        if status == 200:
+            self.etag = etag
+            self.containers = [
+                x['name'] for x in json.loads(body.decode()).get(
+                    'containers', [])]
+            self._reconcile(transport, rec, args)
+        if self.containers and self.rand.random() < args.log_rate:
+            self._append_log(transport, rec, args)
+
+    def _reconcile(self, transport, rec, args):
+        if self.containers and self.rand.random() < args.patch_rate:
+            names = self.rand.sample(
+                self.containers, min(len(self.containers), 3))
+            data = {'containers': [{
+                'name': x,
+                'state': self.rand.choice(('RUNNING', 'STOPPED')),
+                'ips': '10.0.3.%d' % self.rand.randint(2, 254),
+            } for x in names]}
+            rec.call('containers_patch', transport, 'PATCH',
+                     '/api/v1/host/%s/containers/' % self.name,
+                     json.dumps(data), self.headers)
+        if self.rand.random() < args.host_patch_rate:
+            data = {'cpu_total': self.rand.choice((4, 8, 16))}
+            rec.call('host_patch', transport, 'PATCH',
+                     '/api/v1/host/%s/' % self.name, json.dumps(data),
+                     self.headers)
+
+    def _append_log(self, transport, rec, args):
+        container = self.rand.choice(self.containers)
+        offset = self.log_sizes.get(container, 0)
+        line = b'fleet benchmark log line\n'
+        data = line * max(1, args.log_bytes // len(line))
+        headers = dict(self.headers)
+        headers['content-type'] = 'text/plain'
+        status, _, body = rec.call(
+            'log_append', transport, 'POST',
+            '/api/v1/host/%s/container/%s/logs/init?offset=%d' % (
+                self.name, container, offset), data, headers, ok=(201,))
+        if status in (201, 409):
+            self.log_sizes[container] = json.loads(body.decode())['size']
+
+
+def _worker(transport, rec, args, host_names, user_names, seed):
+    rand = random.Random(seed)
+    fleet = [_Host(x, rand) for x in host_names]
+    for _ in range(args.rounds):
+        for host in fleet:
+            host.checkin(transport, rec, args)
+        for user in user_names:
+            if rand.random() < args.user_rate:
+                rec.call('fleet_get', transport, 'GET', '/api/v1/fleet/')
+
+
+def run(args):
+    '''Build the models, drive the fleet and return the results.'''
+    # with sqlite storage the models would otherwise go in STORAGE_DB
+    old = get_storage()
+    set_storage(create_backend(
+        settings.STORAGE_BACKEND, os.path.join(args.models_dir, 'models.db')))
+    try:
+        return _run(args)
+    finally:
+        backend = get_storage()
+        set_storage(old)
+        if hasattr(backend, 'close'):
+            backend.close()
+
+
+def _run(args):
+    build_models_dir(args.models_dir, args.hosts, args.containers,
+                     args.users, args.requests, args.seed)
+    server = None
+    if args.http:
+        server = _serve_http()
+        transport = _HTTP('127.0.0.1', server.server_port)
+    else:
+        transport = _TestClient()
+
+    rec = Recorder()
+    threads = []
+    names = ['host%d' % x for x in range(args.hosts)]
+    user_names = ['user%d' % x for x in range(args.users)]
+    for x in range(args.concurrency):
+        threads.append(threading.Thread(target=_worker, args=(
+            transport, rec, args, names[x::args.concurrency],
+            user_names[x::args.concurrency], args.seed + x)))
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+    if server:
+        server.shutdown()
+
+    endpoints = rec.results(wall)
+    config = dict(vars(args))
+    del config['json']
+    return {
+        'config': config,
+        'wall_s': wall,
+        'requests_left': container_requests.count(),
+        'endpoints': endpoints,
+        'total': {
+            'count': sum(x['count'] for x in endpoints.values()),
+            'errors': sum(x['errors'] for x in endpoints.values()),
+            'throughput': sum(x['throughput'] for x in endpoints.values()),
+        },
+    }
+
+
+def _report(results):
+    for name, r in results['endpoints'].items():
+        print('%-17s count=%-6d errors=%-4d rate=%.1f/s avg=%.2fms '
+              'p50=%.2fms p99=%.2fms' % (
+                  name, r['count'], r['errors'], r['throughput'],
+                  r['avg_ms'], r['p50_ms'], r['p99_ms']))
+    total = results['total']
+    print('%-17s count=%-6d errors=%-4d rate=%.1f/s wall=%.2fs' % (
+        'total', total['count'], total['errors'], total['throughput'],
+        results['wall_s']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, default=50)
+    parser.add_argument('--containers', type=int, default=10,
+                        help='Containers per host')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=20,
+                        help='Queued container requests')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='Check-ins per host')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Threads sending requests')
+    parser.add_argument('--full-check-every', type=int, default=10,
+                        help='Check-ins between ones without an ETag')
+    parser.add_argument('--patch-rate', type=float, default=0.2)
+    parser.add_argument('--host-patch-rate', type=float, default=0.01)
+    parser.add_argument('--log-rate', type=float, default=0.5)
+    parser.add_argument('--log-bytes', type=int, default=1024)
+    parser.add_argument('--user-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--http', action='store_true',
+                        help='Go through a local HTTP server')
+    parser.add_argument('--models-dir',
+                        help='Build the models here and keep them')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the results as JSON, - for stdout')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    keep = args.models_dir is not None
+    if not keep:
+        args.models_dir = tempfile.mkdtemp()
+    try:
+        results = run(args)
+    finally:
+        if not keep:
+            shutil.rmtree(args.models_dir)
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        _report(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
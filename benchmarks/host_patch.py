@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''Measure host PATCH latency against the number of containers on the host.
+
+Model.update used to serialize the whole child tree with to_dict() and write
+it into the host's props.json, so the "to_dict" column shows what each PATCH
+used to pay on top of the "patch" column.
+
+Run with: python3 -m benchmarks.host_patch [--containers 0,10,100,1000]
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from cya_server import app
+from cya_server.models import container_requests, hosts
+
+
+def _host(num_containers):
+    return {
+        'distro_id': 'ubuntu',
+        'distro_release': '16.04',
+        'distro_codename': 'xenial',
+        'mem_total': 8000000000,
+        'cpu_total': 8,
+        'cpu_type': 'x86_64',
+        'api_key': 'key',
+        'enlisted': True,
+        'containers': [
+            {'name': 'c%d' % x, 'template': 'ubuntu', 'release': 'xenial',
+             'max_memory': 1000000}
+            for x in range(num_containers)],
+    }
+
+
+def _avg_ms(func, rounds):
+    start = time.time()
+    for x in range(rounds):
+        func(x)
+    return (time.time() - start) * 1000 / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--containers', default='0,10,100,1000')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    client = app.test_client()
+    headers = [('Authorization', 'Token key')]
+    for num in [int(x) for x in args.containers.split(',')]:
+        modelsdir = tempfile.mkdtemp()
+        try:
+            hosts._model_dir = os.path.join(modelsdir, 'hosts')
+            container_requests._model_dir = os.path.join(modelsdir, 'reqs')
+            hosts.create('host', _host(num))
+            hosts.get('host').ping()
+
+            def patch(x):
+                resp = client.patch(
+                    '/api/v1/host/host/', headers=headers,
+                    data=json.dumps({'cpu_total': x + 1}),
+                    content_type='application/json')
+                assert resp.status_code == 200, resp.status_code
+
+            patch(0)  # warm up the api key cache
+            patch_ms = _avg_ms(patch, args.rounds)
+            to_dict_ms = _avg_ms(
+                lambda x: hosts.get('host').to_dict(), args.rounds)
+            size = os.path.getsize(
+                os.path.join(hosts._model_dir, 'host/props.json'))
+            print('containers=%-5d patch=%.2fms to_dict=%.2fms '
+                  'props.json=%d bytes' % (num, patch_ms, to_dict_ms, size))
+        finally:
+            shutil.rmtree(modelsdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''Simulate a fleet of hosts checking in to a running server.
+
+Each host registers itself and then checks in every --interval seconds the
+way cya_client_lxd.py does: a GET of the host with its containers over a
+kept-alive connection, sending the ETag of the last full response. Start
+the server with "manage.py serve" (or runserver to compare) first.
+
+Run with: python3 -m benchmarks.load http://localhost:8000 [--hosts N]
+'''
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+
+class _Host(object):
+    def __init__(self, url, name, api_key):
+        self.url = urllib.parse.urlparse(url)
+        self.name = name
+        self.api_key = api_key
+        self.etag = None
+        self.times = []
+        self.errors = 0
+        self._conn = None
+
+    def _request(self, method, resource, data=None, headers=None):
+        headers = dict(headers or {})
+        headers['Authorization'] = 'Token ' + self.api_key
+        if data is not None:
+            data = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        for attempt in (0, 1):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(
+                    self.url.hostname, self.url.port or 80, timeout=60)
+            try:
+                self._conn.request(method, resource, data, headers)
+                resp = self._conn.getresponse()
+                body = resp.read()
+                return resp, body
+            except (http.client.HTTPException, OSError):
+                # the server may close idle connections, retry on a new one
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+
+    def register(self):
+        resp, _ = self._request('POST', '/api/v1/host/', {
+            'name': self.name,
+            'distro_id': 'ubuntu',
+            'distro_release': '16.04',
+            'distro_codename': 'xenial',
+            'mem_total': 8000000000,
+            'cpu_total': 8,
+            'cpu_type': 'x86_64',
+            'api_key': self.api_key,
+        })
+        # 409 is a host left behind by an earlier run
+        if resp.status not in (201, 409):
+            raise RuntimeError('Unable to create %s: HTTP %d' % (
+                self.name, resp.status))
+
+    def checkin(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        start = time.time()
+        try:
+            resp, _ = self._request(
+                'GET', '/api/v1/host/%s/?with_containers' % self.name,
+                headers=headers)
+        except (http.client.HTTPException, OSError):
+            self.errors += 1
+            return
+        self.times.append(time.time() - start)
+        if resp.status == 200:
+            self.etag = resp.getheader('ETag')
+        elif resp.status != 304:
+            self.errors += 1
+
+    def run(self, interval, deadline):
+        # spread the hosts out the way cron start times would be
+        time.sleep(random.random() * interval)
+        while time.time() < deadline:
+            next_checkin = time.time() + interval
+            self.checkin()
+            time.sleep(max(0, next_checkin - time.time()))
+
+
+def _report(label, times, errors, elapsed):
+    times = sorted(times)
+    if not times:
+        print('%-10s no successful check-ins, errors=%d' % (label, errors))
+        return
+    avg = sum(times) / len(times)
+    p50 = times[len(times) // 2]
+    p99 = times[min(len(times) - 1, int(len(times) * .99))]
+    print('%-10s checkins=%-6d errors=%-4d rate=%.1f/s avg=%.2fms '
+          'p50=%.2fms p99=%.2fms' % (
+              label, len(times), errors, len(times) / elapsed, avg * 1000,
+              p50 * 1000, p99 * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', help='Base URL of the server')
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=1,
+                        help='Seconds between check-ins of each host')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to run for')
+    parser.add_argument('--prefix', default='loadhost')
+    args = parser.parse_args()
+
+    hosts = [_Host(args.url, '%s%d' % (args.prefix, x), 'loadkey%d' % x)
+             for x in range(args.hosts)]
+    for host in hosts:
+        host.register()
+
+    start = time.time()
+    threads = [threading.Thread(target=x.run,
+                                args=(args.interval, start + args.duration))
+               for x in hosts]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    _report('checkin', [t for x in hosts for t in x.times],
+            sum(x.errors for x in hosts), elapsed)
+
+
+if __name__ == '__main__':
+    main()
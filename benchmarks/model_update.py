@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+'''Measure concurrent Model.update throughput and check no update is lost.
+
+Every worker thread, in each of --processes processes, increments a field
+of a model --updates times. With --models 1 they all fight over the same
+model, otherwise each thread updates its own.
+
+Run with: python3 -m benchmarks.model_update [--processes 4] [--threads 4]
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from cya_server.models import hosts
+from cya_server.simplemodels import get_storage, set_storage
+from cya_server.storage import create_backend
+
+
+def _incr(props):
+    props['cpu_total'] += 1
+    return props
+
+
+def _run_threads(args, proc):
+    def update(thread):
+        name = 'host%d' % ((proc * args.threads + thread) % args.models)
+        path = os.path.join(hosts._model_dir, name)
+        for _ in range(args.updates):
+            get_storage().update(path, _incr)
+    threads = [threading.Thread(target=update, args=(x,))
+               for x in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def _measure(args, backend):
+    modelsdir = tempfile.mkdtemp()
+    try:
+        set_storage(create_backend(
+            backend, os.path.join(modelsdir, 'models.db')))
+        hosts._model_dir = os.path.join(modelsdir, 'hosts')
+        for x in range(args.models):
+            get_storage().create(os.path.join(hosts._model_dir, 'host%d' % x),
+                                 {'cpu_total': 0})
+
+        start = time.time()
+        pids = []
+        for proc in range(1, args.processes):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    _run_threads(args, proc)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        _run_threads(args, 0)
+        failed = sum(1 for x in pids if os.waitpid(x, 0)[1])
+        wall = time.time() - start
+
+        expected = args.processes * args.threads * args.updates
+        total = sum(get_storage().load(
+            os.path.join(hosts._model_dir, 'host%d' % x))['cpu_total']
+            for x in range(args.models))
+        return {
+            'updates': expected,
+            'lost': expected - total,
+            'failed_processes': failed,
+            'wall_s': wall,
+            'throughput': expected / wall,
+        }
+    finally:
+        shutil.rmtree(modelsdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--updates', type=int, default=100,
+                        help='Updates per thread')
+    parser.add_argument('--models', type=int, default=1)
+    parser.add_argument('--backends', default='filesystem,sqlite')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the results as JSON, - for stdout')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    results = {}
+    for backend in args.backends.split(','):
+        results[backend] = r = _measure(args, backend)
+        if args.json != '-':
+            print('%-10s updates=%-6d lost=%-4d rate=%.0f/s wall=%.2fs' % (
+                backend, r['updates'], r['lost'], r['throughput'],
+                r['wall_s']))
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if any(x['lost'] or x['failed_processes'] for x in results.values()):
+        sys.exit('Updates were lost')
+
+
+if __name__ == '__main__':
+    main()
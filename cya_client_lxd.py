@@ -2,18 +2,22 @@
 
 import argparse
 import fcntl
+import hashlib
+import http.client
 import json
 import logging
 import os
 import platform
 import select
+import socket
 import sys
 import subprocess
+import threading
 import time
-import urllib.error
-import urllib.request
 import urllib.parse
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from multiprocessing import cpu_count
 
@@ -28,6 +32,8 @@ IMAGE_ARCH = {
 script = os.path.abspath(__file__)
 hostprops_cached = os.path.join(os.path.dirname(script), 'hostprops.cache')
 container_cached = os.path.join(os.path.dirname(script), 'containers.cache')
+etag_cached = os.path.join(os.path.dirname(script), 'etag.cache')
+lookups_cached = os.path.join(os.path.dirname(script), 'lookups.cache')
 config_file = os.path.join(os.path.dirname(script), 'settings.conf')
 config = ConfigParser()
 config.read([config_file])
@@ -56,22 +62,234 @@ def _mount_container_volumes(container_props, unmount=False):
         os.rmdir(mounts)
 
 
+LXD_SOCKET = os.path.join(
+    os.environ.get('LXD_DIR', '/var/lib/lxd'), 'unix.socket')
+
+# image servers behind the remotes lxc knows by default
+LXD_REMOTES = {
+    'images': 'https://images.linuxcontainers.org',
+    'ubuntu': 'https://cloud-images.ubuntu.com/releases',
+    'ubuntu-daily': 'https://cloud-images.ubuntu.com/daily',
+}
+
+
+class LXDError(RuntimeError):
+    pass
+
+
+def _parse_memory(mem):
+    if not mem:
+        return 0
+    amount = int(mem[:-2])
+    unit = mem[-2:]
+    if unit == 'MB':
+        return amount * 1000000
+    elif unit == 'GB':
+        return amount * 1000000000
+    else:
+        raise RuntimeError('Unknown unit of memory: %s' % mem)
+
+
+class LXDCli(object):
+    '''Drives LXD by running the lxc command for each operation.'''
+
+    def containers(self):
+        containers = subprocess.check_output(['lxc', 'list', '--format=json'])
+        return json.loads(containers.decode())
+
+    def start(self, name):
+        subprocess.check_call(['lxc', 'start', name])
+
+    def stop(self, name):
+        subprocess.check_call(['lxc', 'stop', name])
+
+    def delete(self, name):
+        subprocess.check_call(['lxc', 'delete', '--force', name])
+
+    def create(self, name, image, container_config):
+        args = ['lxc', 'init', image, name]
+        for key, val in container_config.items():
+            args.append('--config=%s=%s' % (key, val))
+        subprocess.check_call(args)
+
+    def add_disk(self, name, device, source, path):
+        subprocess.check_call([
+            'lxc', 'config', 'device', 'add', name, device, 'disk',
+            'source=' + source, 'path=' + path])
+
+    def max_memory(self, container):
+        mem = subprocess.check_output(
+            ['lxc', 'config', 'get', container['name'], 'limits.memory'])
+        return _parse_memory(mem.decode().strip())
+
+    def image_properties(self, fingerprint):
+        image = subprocess.check_output(
+            ['lxc', 'image', 'show', fingerprint],
+            stderr=subprocess.DEVNULL).decode()
+        return yaml.safe_load(image)['properties']
+
+    def close(self):
+        pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(_UnixHTTPConnection, self).__init__('lxd')
+        self.unix_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.unix_path)
+        self.sock = sock
+
+
+class LXDApi(object):
+    '''Drives LXD through its REST API over persistent connections to its
+       unix socket, one per thread.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conns = []
+
+    def _conn(self):
+        # each reconcile worker thread has its own connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _PersistentConnection(_UnixHTTPConnection(self.path))
+            self._local.conn = conn
+            self._conns.append(conn)
+        return conn
+
+    def _request(self, method, url, data=None):
+        headers = {}
+        if data is not None:
+            data = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        resp = self._conn().request(method, url, data, headers, None)
+        resp = json.loads(resp.read().decode())
+        if resp['type'] == 'error':
+            raise LXDError('%s %s: %s' % (method, url, resp['error']))
+        if resp['type'] == 'async':
+            op = self._request('GET', resp['operation'] + '/wait')
+            if op['status_code'] != 200:
+                raise LXDError('%s %s: %s' % (method, url, op['err']))
+            return op
+        return resp['metadata']
+
+    def containers(self):
+        containers = self._request('GET', '/1.0/containers?recursion=2')
+        for x in containers:
+            if 'state' not in x:
+                # recursion=2 is only understood by newer LXD versions
+                x['state'] = self._request(
+                    'GET', '/1.0/containers/%s/state' % x['name'])
+        return containers
+
+    def _set_state(self, name, action, force=False):
+        self._request('PUT', '/1.0/containers/%s/state' % name, {
+            'action': action, 'timeout': 30, 'force': force})
+
+    def start(self, name):
+        self._set_state(name, 'start')
+
+    def stop(self, name):
+        self._set_state(name, 'stop')
+
+    def delete(self, name):
+        c = self._request('GET', '/1.0/containers/%s' % name)
+        if c['status'] != 'Stopped':
+            self._set_state(name, 'stop', force=True)
+        self._request('DELETE', '/1.0/containers/%s' % name)
+
+    def create(self, name, image, container_config):
+        remote, alias = image.split(':', 1)
+        self._request('POST', '/1.0/containers', {
+            'name': name,
+            'config': container_config,
+            'source': {
+                'type': 'image',
+                'protocol': 'simplestreams',
+                'server': LXD_REMOTES[remote],
+                'alias': alias,
+            },
+        })
+
+    def add_disk(self, name, device, source, path):
+        self._request('PATCH', '/1.0/containers/%s' % name, {
+            'devices': {
+                device: {'type': 'disk', 'source': source, 'path': path},
+            },
+        })
+
+    def max_memory(self, container):
+        # the listing already has the config, no need to ask again
+        return _parse_memory(container['config'].get('limits.memory', ''))
+
+    def image_properties(self, fingerprint):
+        return self._request('GET', '/1.0/images/' + fingerprint)['properties']
+
+    def close(self):
+        for conn in self._conns:
+            conn.close()
+
+
+_lxd = None
+
+
+def lxd():
+    '''The LXD backend set by lxd_backend in settings.conf. "auto", the
+       default, uses the API when LXD's unix socket is there and falls back
+       to the lxc command.'''
+    global _lxd
+    if _lxd is None:
+        backend = config.get('cya', 'lxd_backend', fallback='auto')
+        path = config.get('cya', 'lxd_socket', fallback=LXD_SOCKET)
+        if backend == 'api' or (backend == 'auto' and os.path.exists(path)):
+            _lxd = LXDApi(path)
+        else:
+            _lxd = LXDCli()
+    return _lxd
+
+
 def lxd_containers():
-    containers = subprocess.check_output(['lxc', 'list', '--format=json'])
-    containers = json.loads(containers.decode())
+    containers = lxd().containers()
     for x in containers:
         ips = []
         if x['state']:
-            for adapter, props in x['state'].get('network', {}).items():
+            for adapter, props in (x['state'].get('network') or {}).items():
                 if adapter != 'lo':
                     ips.extend([i['address'] for i in props['addresses']])
         x['ips'] = ', '.join(ips)
     return {x['name']: x for x in containers}
 
 
+_inventory = {}
+
+
+def lxd_inventory():
+    '''lxd_containers() kept between daemon ticks. Start and stop update
+       it in place, anything else the client does to a container drops it.
+       It's re-read every full_check_interval seconds to notice local
+       changes and while a running container is still waiting on an IP.'''
+    interval = config.getint('cya', 'full_check_interval', fallback=600)
+    containers = _inventory.get('containers')
+    if containers is None or time.time() - _inventory['read'] > interval or \
+            any(x['status'] == 'Running' and not x['ips']
+                for x in containers.values()):
+        _inventory['containers'] = containers = lxd_containers()
+        _inventory['read'] = time.time()
+    return containers
+
+
+def lxd_inventory_changed():
+    _inventory.clear()
+
+
 def lxc_container_stop(container, container_props):
     log.debug('stopping container: %s', container['name'])
-    subprocess.check_call(['lxc', 'stop', container['name']])
+    lxd().stop(container['name'])
     _mount_container_volumes(container_props, unmount=True)
     container['status'] = 'Stopped'
 
@@ -79,33 +297,66 @@ def lxc_container_stop(container, container_props):
 def lxc_container_start(container, container_props):
     log.debug('starting container: %s', container['name'])
     _mount_container_volumes(container_props)
-    subprocess.check_call(['lxc', 'start', container['name']])
+    lxd().start(container['name'])
     container['status'] = 'Running'
 
 
-def lxd_container_get_max_memory(name):
-    mem = subprocess.check_output(
-        ['lxc', 'config', 'get', name, 'limits.memory'])
-    mem = mem.decode().strip()
-    if not mem:
-        return 0
-    amount = int(mem[:-2])
-    unit = mem[-2:]
-    if unit == 'MB':
-        return amount * 1000000
-    elif unit == 'GB':
-        return amount * 1000000000
-    else:
-        raise RuntimeError('Unknown unit of memory: %s' % mem)
+class LookupCache(object):
+    '''A small LRU of lookup results kept on disk between runs.'''
+
+    def __init__(self, path, max_size=512):
+        self.path = path
+        self.max_size = max_size
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = OrderedDict(json.load(f))
+            except (OSError, ValueError):
+                self._entries = OrderedDict()
+        return self._entries
+
+    def get(self, key, lookup):
+        entries = self._load()
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+        value = entries[key] = lookup()
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(entries.items()), f)
+        os.rename(tmp, self.path)
+        return value
+
+
+lookups = LookupCache(lookups_cached)
+
+
+def _config_revision(container):
+    # volatile keys change with every start and stop
+    conf = {k: v for k, v in container['config'].items()
+            if not k.startswith('volatile.')}
+    conf = json.dumps(conf, sort_keys=True).encode()
+    return hashlib.sha1(conf).hexdigest()
+
+
+def lxd_container_get_max_memory(container):
+    key = 'memory:%s:%s' % (container['name'], _config_revision(container))
+    return lookups.get(key, lambda: lxd().max_memory(container))
 
 
 def lxd_image_info(container):
+    # base image fingerprints are immutable so this never goes stale
     image = container['config']['volatile.base_image']
-    image = subprocess.check_output(
-        ['lxc', 'image', 'show', image], stderr=subprocess.DEVNULL).decode()
-    image = yaml.load(image)
-    os = image['properties'].get('os', image['properties'].get('distribution'))
-    return os, image['properties']['release']
+
+    def lookup():
+        props = lxd().image_properties(image)
+        return [props.get('os', props.get('distribution')), props['release']]
+    return tuple(lookups.get('image:' + image, lookup))
 
 
 def _create_conf(server_url, version):
@@ -133,21 +384,100 @@ def _create_conf(server_url, version):
         config.write(f, True)
 
 
-def _http_resp(resource, headers=None, data=None, method=None):
+class _Response(object):
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self._body = body
+
+    def read(self):
+        return self._body
+
+
+class _PersistentConnection(object):
+    '''A keep-alive http.client connection shared by every request this
+       process makes to one server. It is re-opened when the server drops
+       it.'''
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._used = False
+
+    def request(self, method, url, data, headers, timeout):
+        # a reused connection may have been closed by the server while idle,
+        # so it gets one retry on a fresh connection
+        for attempt in (0, 1):
+            self._conn.timeout = timeout
+            if self._conn.sock:
+                self._conn.sock.settimeout(timeout)
+            try:
+                # a callable gives a fresh body, eg an iterator, per attempt
+                body = data() if callable(data) else data
+                self._conn.request(method, url, body, headers)
+                resp = self._conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, ConnectionError):
+                reused = self._used
+                self.close()
+                if attempt or not reused:
+                    raise
+                continue
+            except OSError:
+                self.close()
+                raise
+            self._used = True
+            return _Response(resp.status, resp.headers, body)
+
+    def close(self):
+        self._conn.close()
+        self._used = False
+
+
+_connection = None
+
+
+def _server_connection():
+    global _connection
+    if _connection is None:
+        parts = urllib.parse.urlsplit(config.get('cya', 'server_url'))
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.netloc)
+        else:
+            conn = http.client.HTTPConnection(parts.netloc)
+        _connection = _PersistentConnection(conn)
+    return _connection
+
+
+def _reset_connections():
+    '''Drop the shared connections, a forked child must not use its
+       parent's sockets or worker threads.'''
+    global _connection, _lxd, _pool
+    _pool = None
+    if _connection is not None:
+        _connection.close()
+    _connection = None
+    if _lxd is not None:
+        _lxd.close()
+    _lxd = None
+
+
+def _http_resp(resource, headers=None, data=None, method=None, timeout=None):
     url = urllib.parse.urljoin(config.get('cya', 'server_url'), resource)
-    req = urllib.request.Request(
-        url, data=data, headers=headers, method=method)
+    url = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(('', '', url.path, url.query, ''))
+    if method is None:
+        method = 'GET' if data is None else 'POST'
     try:
-        resp = urllib.request.urlopen(req)
-        return resp
-    except urllib.error.URLError as e:
-        if hasattr(e, 'reason'):
-            sys.stderr.write('Failed to issue request: %s\n' % e.reason)
-            sys.stderr.write('  ' + e.read().decode())
-        elif hasattr(e, 'code'):
-            print('The server couldn\'t fulfill the request.')
-            print('Error code: ', e.code)
+        resp = _server_connection().request(
+            method, path, data, headers or {}, timeout)
+    except (http.client.HTTPException, OSError) as e:
+        sys.stderr.write('Failed to issue request: %s\n' % e)
         sys.exit(1)
+    if resp.code == 304 or resp.code < 300:
+        return resp  # on 304 (not modified) the caller checks resp.code
+    sys.stderr.write('Failed to issue request: %d\n' % resp.code)
+    sys.stderr.write('  ' + resp.read().decode())
+    sys.exit(1)
 
 
 def _auth_headers():
@@ -157,8 +487,9 @@ def _auth_headers():
     }
 
 
-def _get(resource):
-    return json.loads(_http_resp(resource, _auth_headers()).read().decode())
+def _get(resource, timeout=None):
+    resp = _http_resp(resource, _auth_headers(), timeout=timeout)
+    return json.loads(resp.read().decode())
 
 
 def _post(resource, data):
@@ -172,17 +503,29 @@ def _patch(resource, data):
     return _http_resp(resource, _auth_headers(), data, method='PATCH')
 
 
-def _post_logs(container, logname, data):
+def _post_logs(container, logname, data, offset=None):
+    '''Send data, bytes or a callable returning an iterator of them, as the
+       log from byte offset on. Returns the size of the log on the server or
+       None if it couldn't be reached.'''
     if type(data) == str:
         data = data.encode()
     headers = _auth_headers()
     headers['content-type'] = 'text/plain'
     resource = '/api/v1/host/%s/container/%s/logs/%s' % (
         config.get('cya', 'hostname'), container, logname)
+    if offset is not None:
+        resource += '?offset=%d' % offset
     try:
-        return _http_resp(resource, headers, data, method='POST')
-    except:
-        return False
+        resp = _server_connection().request(
+            'POST', resource, data, headers, 30)
+    except (http.client.HTTPException, OSError) as e:
+        log.error('Unable to post log %s: %s', logname, e)
+        return None
+    # a 409 means the server has less than offset, it tells us how much
+    if resp.code not in (201, 409):
+        log.error('Unable to post log %s: HTTP %d', logname, resp.code)
+        return None
+    return json.loads(resp.read().decode())['size']
 
 
 def _host_props():
@@ -201,7 +544,7 @@ def _host_props():
 
 
 def _container_props(container):
-    max_mem = lxd_container_get_max_memory(container['name'])
+    max_mem = lxd_container_get_max_memory(container)
     created = time.mktime(
         dateutil.parser.parse(container['created_at']).timetuple())
     props = {
@@ -261,19 +604,77 @@ def _create_shared_mounts(container_props):
     for mount in container_props.get('containermounts', []):
         log.debug('adding device to container')
         mp = os.path.join(mounts, mount['name'])
-        subprocess.check_call([
-            'lxc', 'config', 'device', 'add', container_props['name'],
-            mount['name'], 'disk', 'source=' + mp,
-            'path=%s' % mount['directory']])
+        lxd().add_disk(
+            container_props['name'], mount['name'], mp, mount['directory'])
+
+
+class _LogUpload(object):
+    '''Output of an init script, spooled to disk and streamed from there to
+       the server so neither side holds more than a chunk of it in memory.
+       The server is told the offset of each upload so one that failed half
+       way can simply be sent again.'''
+    CHUNK_SIZE = 65536
+
+    def __init__(self, container_name, name):
+        self.container_name = container_name
+        self.name = name
+        spool_dir = os.path.join(
+            os.path.dirname(script), 'logs', container_name)
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        self.path = os.path.join(spool_dir, name)
+        self.spool = open(self.path, 'wb')
+        self.base = None  # where our output starts in the server's log
+        self.sent = 0
+
+    def write(self, data):
+        self.spool.write(data)
+
+    @property
+    def pending(self):
+        return self.spool.tell() - self.sent
+
+    def _chunks(self, start, end):
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(self.CHUNK_SIZE, end - start))
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
+
+    def flush(self):
+        '''Send what the server doesn't have yet, returns True when it has
+           everything.'''
+        self.spool.flush()
+        if self.base is None:
+            # the log may already hold output of an earlier run
+            self.base = _post_logs(self.container_name, self.name, b'')
+            if self.base is None:
+                return False
+        end = self.spool.tell()
+        if self.sent == end:
+            return True
+        size = _post_logs(
+            self.container_name, self.name,
+            lambda: self._chunks(self.sent, end), self.base + self.sent)
+        if size is None:
+            return False
+        self.sent = min(max(size - self.base, 0), end)
+        return self.sent == end
+
+    def close(self):
+        self.spool.close()
+        os.unlink(self.path)
 
 
 def _run_init(container_name, name, script):
     log.info('Running init script: %s', name)
-    buff = ('\n== CYA-INIT-SCRIPT(%s) STARTED at: %s\n' % (
-        name, time.asctime())).encode()
-    if _post_logs(container_name, name, buff):
-        buff = b''
-    else:
+    upload = _LogUpload(container_name, name)
+    upload.write(('\n== CYA-INIT-SCRIPT(%s) STARTED at: %s\n' % (
+        name, time.asctime())).encode())
+    if not upload.flush():
         log.error('Unable to post log start, will try again')
     p = subprocess.Popen(['lxc', 'exec', container_name, 'bash'],
                          stdin=subprocess.PIPE, stderr=subprocess.STDOUT,
@@ -284,29 +685,34 @@ def _run_init(container_name, name, script):
     poller = select.poll()
     RONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
     poller.register(p.stdout.fileno(), RONLY)
-    last_update = 0
+    last_update = time.time()
     while poller:
-        events = poller.poll()
+        events = poller.poll(20000)
         for fd, flag in events:
             data = os.read(fd, 1024)
             if data:
-                buff += data
-                now = time.time()
-                # update server log ever 20s or 8k bytes
-                if now - last_update > 20 or len(buff) > 8192:
-                    if _post_logs(container_name, name, buff):
-                        last_update = now
-                        buff = b''
-                    else:
-                        log.error('Unable to update log, will try again')
+                upload.write(data)
             else:
                 poller = None
+        now = time.time()
+        # update server log ever 20s or 8k bytes
+        if upload.pending and (now - last_update > 20 or
+                               upload.pending > 8192):
+            last_update = now
+            if not upload.flush():
+                log.error('Unable to update log, will try again')
     p.wait()
-    buff += b'\n== RC=%d' % p.returncode
-    buff = '\n== CYA-INIT-SCRIPT(%s) ENDED at: %s RC=%d\n' % (
-        name, time.asctime(), p.returncode)
-    if not _post_logs(container_name, name, buff.encode()):
-        log.error('Unable to update script finish log, ignoring')
+    upload.write(('\n== CYA-INIT-SCRIPT(%s) ENDED at: %s RC=%d\n' % (
+        name, time.asctime(), p.returncode)).encode())
+    for attempt in range(3):
+        if upload.flush():
+            upload.close()
+            break
+        time.sleep(5)
+    else:
+        upload.spool.close()
+        log.error('Unable to update script finish log, leaving it in: %s',
+                  upload.path)
     return p.returncode
 
 
@@ -314,16 +720,23 @@ def _run_init_scripts(container_props):
     log.info('Fork and run init script')
     if os.fork():
         return
-    lockfile.close()
-    for script in container_props['initscripts']:
-        _run_init(container_props['name'], script['name'], script['content'])
-
-    if container_props.get('one_shot'):
-        data = {'state': 'DESTROY'}
-        _patch('/api/v1/host/%s/container/%s/' %
-               (config.get('cya', 'hostname'), container_props['name']), data)
-        _handle_dels([container_props['name']])
-        sys.exit(0)
+    # the child must never return into the caller's loop
+    try:
+        lockfile.close()
+        _reset_connections()
+        for script in container_props['initscripts']:
+            _run_init(
+                container_props['name'], script['name'], script['content'])
+
+        if container_props.get('one_shot'):
+            data = {'state': 'DESTROY'}
+            _patch('/api/v1/host/%s/container/%s/' % (
+                config.get('cya', 'hostname'), container_props['name']), data)
+            _handle_dels([container_props['name']])
+    except:
+        log.exception('Init scripts for %s failed', container_props['name'])
+    finally:
+        os._exit(0)
 
 
 def _create_container(container_props):
@@ -331,28 +744,39 @@ def _create_container(container_props):
     arch = IMAGE_ARCH[platform.processor()]
     image = 'images:%s/%s/%s' % (
         container_props['template'], container_props['release'], arch)
-    args = ['lxc', 'init', image, container_props['name']]
+    container_config = {}
 
     mem = container_props.get('max_memory')
     if mem:
-        args.append('--config=limits.memory=%dMB' % (mem / 1000000))
+        container_config['limits.memory'] = '%dMB' % (mem / 1000000)
     init = container_props.get('initscripts', [])
     for name, content in init:
-        args.append('--config=user.cya_%s=%s' % (name, content))
+        container_config['user.cya_%s' % name] = content
 
-    subprocess.check_call(args)
+    lxd().create(container_props['name'], image, container_config)
     _create_shared_mounts(container_props)
     lxc_container_start({'name': container_props['name']}, container_props)
 
-    if init:
-        _run_init_scripts(container_props)
+
+_container_updates = []
 
 
 def _update_container(container):
-    data = _container_props(container)
-    del data['name']
-    _patch('/api/v1/host/%s/container/%s/' %
-           (config.get('cya', 'hostname'), container['name']), data)
+    # sent to the server in one request by _send_container_updates
+    _container_updates.append(_container_props(container))
+
+
+def _send_container_updates():
+    if not _container_updates:
+        return
+    log.debug('updating %d containers on server', len(_container_updates))
+    data = {'containers': list(_container_updates)}
+    del _container_updates[:]
+    resp = _patch(
+        '/api/v1/host/%s/containers/' % config.get('cya', 'hostname'), data)
+    missing = json.loads(resp.read().decode())['missing']
+    if missing:
+        log.debug('containers deleted on the server: %s', missing)
 
 
 def _upgrade_client(version):
@@ -393,25 +817,71 @@ def _handle_ips(container, cache):
     return False
 
 
+_pool = None
+
+
+def _in_parallel(func, names):
+    '''Run func(name) for each name on up to reconcile_workers threads.
+       A failure only affects its own container, the names that failed are
+       returned in the order they were given.'''
+    global _pool
+    if _pool is None:
+        workers = config.getint('cya', 'reconcile_workers', fallback=4)
+        _pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [(x, _pool.submit(func, x)) for x in names]
+    failed = []
+    for name, future in futures:
+        try:
+            future.result()
+        except Exception:
+            log.exception('Unable to handle container: %s', name)
+            failed.append(name)
+    return failed
+
+
+def _add_container(container_props):
+    print('Creating: container: %s' % container_props['name'])
+    _create_container(container_props)
+
+
 def _handle_adds(container_props, to_add):
-    for x in to_add:
-        print('Creating: container: %s' % x)
-        _create_container(container_props[x])
+    if not to_add:
+        return []
+    lxd_inventory_changed()
+    to_add = sorted(to_add)
+    failed = _in_parallel(
+        lambda x: _add_container(container_props[x]), to_add)
+
+    # the server hears about them in order and only once all are created,
+    # the init scripts are forked here so no worker thread is running
+    if len(failed) < len(to_add):
         log.debug('updating container info on server')
-        _update_container(lxd_containers()[x])
+        containers = lxd_containers()
+    for x in to_add:
+        if x not in failed:
+            _update_container(containers[x])
+            if container_props[x].get('initscripts'):
+                _run_init_scripts(container_props[x])
+    return failed
+
+
+def _delete_container(name):
+    print('Deleting container: %s' % name)
+    lxd().delete(name)
+    mounts = os.path.join(os.path.dirname(script), 'shared_storage', name)
+    if os.path.exists(mounts):
+        for mount in os.listdir(mounts):
+            mount = os.path.join(mounts, mount)
+            subprocess.check_call(['umount', mount])
+            os.rmdir(mount)
+        os.rmdir(mounts)
 
 
 def _handle_dels(to_del):
-    for x in to_del:
-        print('Deleting container: %s' % x)
-        subprocess.check_call(['lxc', 'delete', '--force', x])
-        mounts = os.path.join(os.path.dirname(script), 'shared_storage', x)
-        if os.path.exists(mounts):
-            for mount in os.listdir(mounts):
-                mount = os.path.join(mounts, mount)
-                subprocess.check_call(['umount', mount])
-                os.rmdir(mount)
-            os.rmdir(mounts)
+    if not to_del:
+        return []
+    lxd_inventory_changed()
+    return _in_parallel(_delete_container, sorted(to_del))
 
 
 def _handle_existing(lxc_containers, container_props, names):
@@ -421,11 +891,11 @@ def _handle_existing(lxc_containers, container_props, names):
     except:
         cache = {}
 
-    for name in names:
+    re_create = []
+    for name in sorted(names):
         container = lxc_containers[name]
         if container_props[name].get('re_create'):
-            _handle_dels([name])
-            _handle_adds(container_props, [name])
+            re_create.append(name)
         else:
             changed = _handle_start_stop(container, container_props)
             if changed or _handle_ips(container, cache):
@@ -434,11 +904,12 @@ def _handle_existing(lxc_containers, container_props, names):
     with open(container_cached, 'w') as f:
         json.dump(cache, f)
 
+    failed = _handle_dels(re_create)
+    return failed + _handle_adds(
+        container_props, [x for x in re_create if x not in failed])
 
-def _check(args):
-    c = _get(
-        '/api/v1/host/%s/?with_containers' % config.get('cya', 'hostname'))
 
+def _reconcile(c, args):
     if c['client_version'] != config.get('cya', 'version'):
         log.warn('Upgrading client to: %s', c['client_version'])
         _upgrade_client(c['client_version'])
@@ -447,12 +918,78 @@ def _check(args):
 
     rem_containers = {x['name']: x for x in c.get('containers', [])}
     rem_names = set(rem_containers.keys())
-    containers = lxd_containers()
+    containers = lxd_inventory()
+    if rem_names != set(containers.keys()):
+        # don't act on a stale inventory, eg a one_shot container its init
+        # script child already deleted
+        lxd_inventory_changed()
+        containers = lxd_inventory()
     local_names = set(containers.keys())
 
-    _handle_adds(rem_containers, rem_names - local_names)
-    _handle_dels(local_names - rem_names)
-    _handle_existing(containers, rem_containers, rem_names & local_names)
+    try:
+        failed = _handle_adds(rem_containers, rem_names - local_names)
+        failed += _handle_dels(local_names - rem_names)
+        failed += _handle_existing(
+            containers, rem_containers, rem_names & local_names)
+    finally:
+        _send_container_updates()
+    if failed:
+        # so the next check-in does it all again
+        raise RuntimeError('Unable to reconcile: %s' % ', '.join(failed))
+
+
+def _check(args):
+    try:
+        with open(etag_cached) as f:
+            cached = json.load(f)
+    except:
+        cached = {}
+
+    headers = _auth_headers()
+    # local changes, like a container stopped by hand, are only noticed by
+    # a full check so one is forced every full_check_interval seconds
+    interval = config.getint('cya', 'full_check_interval', fallback=600)
+    now = time.time()
+    if cached.get('etag') and now - cached.get('checked', 0) < interval:
+        headers['If-None-Match'] = cached['etag']
+
+    resp = _http_resp(
+        '/api/v1/host/%s/?with_containers' % config.get('cya', 'hostname'),
+        headers)
+    if resp.code == 304:
+        log.debug('host unchanged since: %s', cached['etag'])
+        return
+    _reconcile(json.loads(resp.read().decode()), args)
+
+    # only remember the etag once everything it describes has been done
+    with open(etag_cached, 'w') as f:
+        json.dump({'etag': resp.headers.get('ETag'), 'checked': now}, f)
+
+
+def _daemon(args):
+    '''Wait on the server for changes and reconcile as soon as they happen.
+       Local state is also re-checked each time a wait times out.'''
+    resource = '/api/v1/host/%s/wait/?timeout=%d' % (
+        config.get('cya', 'hostname'), args.timeout)
+    revision = None
+    host = None
+    while True:
+        try:
+            url = resource
+            if revision is not None:
+                url += '&revision=%d' % revision
+            c = _get(url, timeout=args.timeout + 30)
+            if 'containers' in c:
+                host = c
+                log.debug('host changed, revision: %d', c['revision'])
+            else:
+                host['client_version'] = c['client_version']
+            revision = c['revision']
+            _reconcile(host, args)
+        except (Exception, SystemExit):
+            # _http_resp exits on errors, the daemon has to keep going
+            log.exception('Unable to check in, retrying in %ds', args.retry)
+            time.sleep(args.retry)
 
 
 def main(args):
@@ -475,6 +1012,14 @@ def get_args():
     p = sub.add_parser('check', help='Check in with server for updates')
     p.set_defaults(func=_check)
 
+    p = sub.add_parser('daemon',
+                       help='Wait on the server and react to changes')
+    p.set_defaults(func=_daemon)
+    p.add_argument('--timeout', type=int, default=60,
+                   help='Seconds each wait on the server can last')
+    p.add_argument('--retry', type=int, default=10,
+                   help='Seconds to wait after a failed check-in')
+
     p = sub.add_parser('uninstall', help='Uninstall the client')
     p.set_defaults(func=_uninstall)
 
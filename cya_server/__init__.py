@@ -4,5 +4,6 @@ app = flask.Flask(__name__)
 app.config.from_object('cya_server.settings')
 
 
+import cya_server.views.metrics  # NOQA
 import cya_server.views.api  # NOQA
 import cya_server.views.ui  # NOQA
@@ -1,6 +1,11 @@
 import contextlib
 import fcntl
 import json
+import os
+import tempfile
+import time
+
+from cya_server import metrics
 
 
 @contextlib.contextmanager
@@ -16,10 +21,13 @@ def open_for_read(filename):
 
 
 @contextlib.contextmanager
-def open_for_write(filename, append=False):
+def open_for_write(filename, append=False, lock='open_for_write'):
+    '''The time spent waiting for the lock is recorded under `lock`.'''
     f = open(filename, 'a+')
     try:
+        start = time.time()
         fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        metrics.lock_wait.observe(time.time() - start, lock=lock)
         f.cya_size = f.tell()
         if not append:
             f.seek(0)
@@ -64,3 +72,59 @@ def json_data(filename, create=True):
         f.seek(0)
         f.truncate()
         json.dump(data, f, indent=2)
+
+
+class LockManager(object):
+    '''Shared and exclusive locks keyed by path that hold between threads
+       and processes.
+
+       The lock for a path is a flock of the file `lockfile % path`, a file
+       of its own, so it keeps working when what it protects is replaced by
+       a rename. flock locks belong to an open file, so threads that each
+       take a lock exclude one another just like processes do. A thread
+       must not take a lock it already holds.
+    '''
+    def __init__(self, lockfile, label):
+        self.lockfile = lockfile
+        self.label = label
+
+    @contextlib.contextmanager
+    def _locked(self, path, mode, kind):
+        fd = os.open(self.lockfile % path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            start = time.time()
+            fcntl.flock(fd, mode)
+            metrics.lock_wait.observe(
+                time.time() - start, lock='%s_%s' % (self.label, kind))
+            yield
+        finally:
+            os.close(fd)
+
+    def shared(self, path):
+        '''For readers, who only exclude writers.'''
+        return self._locked(path, fcntl.LOCK_SH, 'shared')
+
+    def exclusive(self, path):
+        '''For read-modify-write.'''
+        return self._locked(path, fcntl.LOCK_EX, 'exclusive')
+
+
+def atomic_write(path, data):
+    '''Replace path with `data`, a str. It goes to a uniquely named temp
+       file that is fsync'ed before being renamed over path, so readers see
+       the old or the new content and a crash can't leave a partial file.'''
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path))
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,471 @@
+'''Container logs with size based rotation and compressed segments.
+
+   A log called "init" is made up of files in the container's logs directory:
+     init             - the active segment, new bytes are appended here
+     init.<s>-<e>.gz  - a rotated segment holding bytes s up to e of the log
+                        (.zst when zstandard is installed)
+     .init.lock       - taken by writers and rotation
+   Offsets always count from the start of the whole log. Deleting old
+   segments to stay within the retention budget doesn't move them, the log
+   just starts later.
+'''
+import fcntl
+import glob
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+
+from cya_server import concurrently
+from cya_server.simplemodels import ModelError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger()
+
+# how much of a log is held in memory at a time
+CHUNK_SIZE = 65536
+
+_SEGMENT = re.compile(r'^(?P<name>.+)\.(?P<start>\d+)-(?P<end>\d+)'
+                      r'(?P<ext>\.gz|\.zst)?$')
+
+
+def is_log(filename):
+    '''Tell the name of a log from the other files in a logs directory.'''
+    return not filename.startswith('.') and not _SEGMENT.match(filename)
+
+
+def _open_segment(path):
+    if not os.path.exists(path) and not _SEGMENT.match(
+            os.path.basename(path)).group('ext'):
+        # compressed since we listed the segments
+        for ext in ('.gz', '.zst'):
+            if os.path.exists(path + ext):
+                path += ext
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('zstandard is needed to read: %s' % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def _compress(src, compression):
+    '''Write a compressed copy of segment src next to it, remove src and
+       return the new path.'''
+    if compression == 'auto':
+        compression = 'zstd' if zstandard else 'gzip'
+    dst = src + ('.zst' if compression == 'zstd' else '.gz')
+    # the compactor may be compressing the same segment right now
+    tmp = os.path.join(os.path.dirname(dst), '.%s.%d.%d.tmp' % (
+        os.path.basename(dst), os.getpid(), threading.get_ident()))
+    try:
+        f = open(src, 'rb')
+    except FileNotFoundError:
+        return dst
+    if compression == 'zstd':
+        writer = zstandard.ZstdCompressor().stream_writer(open(tmp, 'wb'))
+    else:
+        writer = gzip.open(tmp, 'wb')
+    with f, writer:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+    os.rename(tmp, dst)
+    try:
+        os.unlink(src)
+    except FileNotFoundError:
+        pass
+    return dst
+
+
+class ContainerLog(object):
+    def __init__(self, path, rotate_size=0, compression='auto'):
+        self.path = path
+        self.rotate_size = rotate_size
+        self.compression = compression
+        self._dir, self.name = os.path.split(path)
+        self._lock = os.path.join(self._dir, '.%s.lock' % self.name)
+
+    def segments(self):
+        '''Return the rotated segments as a sorted list of
+           (start, end, path).'''
+        segments = {}
+        try:
+            names = os.listdir(self._dir)
+        except FileNotFoundError:
+            return []
+        for x in names:
+            m = _SEGMENT.match(x)
+            if m and m.group('name') == self.name:
+                key = (int(m.group('start')), int(m.group('end')))
+                # while being compressed both copies exist, take the plain one
+                if key not in segments or not m.group('ext'):
+                    segments[key] = os.path.join(self._dir, x)
+        return [(s, e, p) for (s, e), p in sorted(segments.items())]
+
+    def _active_start(self):
+        segments = self.segments()
+        return segments[-1][1] if segments else 0
+
+    def exists(self):
+        return os.path.exists(self.path) or bool(self.segments())
+
+    def size(self):
+        try:
+            active = os.path.getsize(self.path)
+        except FileNotFoundError:
+            active = 0
+        return self._active_start() + active
+
+    def first_offset(self):
+        '''Return the offset of the oldest byte still kept. compact() deletes
+           old segments and empties the newest one instead of deleting it,
+           so a log can start past 0.'''
+        for start, end, path in self.segments():
+            try:
+                if os.path.getsize(path):
+                    return start
+            except FileNotFoundError:
+                pass  # compressed or deleted since we looked
+        return self._active_start()
+
+    def write(self, stream, offset=None):
+        '''Copy stream into the log as the bytes from offset on. Bytes the
+           log already has are skipped. Without an offset it's appended.
+           Returns the new size of the log.'''
+        with concurrently.open_for_write(self._lock, append=True):
+            start = self._active_start()
+            with open(self.path, 'ab') as f:
+                size = start + f.seek(0, os.SEEK_END)
+                if offset is None:
+                    offset = size
+                elif offset > size:
+                    raise ModelError(
+                        'Log %s has %d bytes, can not write at %d' % (
+                            self.name, size, offset), 409)
+                skip = size - offset
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if skip:
+                        dup = min(skip, len(chunk))
+                        chunk = chunk[dup:]
+                        skip -= dup
+                    f.write(chunk)
+                active = f.tell()
+            segment = None
+            if self.rotate_size and active >= self.rotate_size:
+                segment = self._rotate(start, active)
+        if segment:
+            _compress(segment, self.compression)
+        return start + active
+
+    def _rotate(self, start, active):
+        # readers that have the active file open keep reading the same
+        # bytes, and until it's compressed the plain copy is a segment
+        segment = '%s.%d-%d' % (self.path, start, start + active)
+        os.rename(self.path, segment)
+        open(self.path, 'ab').close()
+        return segment
+
+    def rotate(self, idle=0):
+        '''Rotate the active file if it hasn't been written to in idle
+           seconds. Returns True if it was.'''
+        with concurrently.open_for_write(self._lock, append=True):
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return False
+            if not st.st_size or time.time() - st.st_mtime < idle:
+                return False
+            segment = self._rotate(self._active_start(), st.st_size)
+        _compress(segment, self.compression)
+        return True
+
+    def _open_active(self):
+        '''Return (start, file) for the active segment, making sure it isn't
+           rotated between finding its start and opening it.'''
+        while True:
+            start = self._active_start()
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                f = None
+            if self._active_start() == start:
+                return start, f
+            if f:
+                f.close()
+
+    def _pieces(self):
+        '''Return (pieces, active) where pieces are (start, end, opener,
+           compressed) for every part of the log in order. The active file
+           is opened right away so it matches the segments and the caller
+           has to close it.'''
+        start, active = self._open_active()
+        pieces = []
+        for s, e, p in self.segments():
+            if e <= start:
+                compressed = _SEGMENT.match(os.path.basename(p)).group('ext')
+                pieces.append((s, e, lambda p=p: _open_segment(p),
+                               compressed is not None))
+        if active:
+            end = start + os.fstat(active.fileno()).st_size
+            pieces.append((start, end, lambda: os.fdopen(
+                os.dup(active.fileno()), 'rb'), False))
+        return pieces, active
+
+    def read(self, start=0, end=None):
+        '''Yield the log's bytes from start up to end in chunks.'''
+        pieces, active = self._pieces()
+        try:
+            for pstart, pend, opener, _ in pieces:
+                if end is not None and pstart >= end:
+                    break
+                if pend <= start:
+                    continue
+                pos = max(start, pstart)
+                stop = pend if end is None else min(pend, end)
+                with opener() as f:
+                    f.seek(pos - pstart)
+                    while pos < stop:
+                        chunk = f.read(min(CHUNK_SIZE, stop - pos))
+                        if not chunk:
+                            break
+                        pos += len(chunk)
+                        yield chunk
+                start = pos
+        finally:
+            if active:
+                active.close()
+
+    @staticmethod
+    def _newlines_backwards(f, size):
+        '''Yield the offsets of newlines in a seekable file, last first.'''
+        pos = size
+        while pos > 0:
+            step = min(CHUNK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step)
+            idx = len(chunk)
+            while True:
+                idx = chunk.rfind(b'\n', 0, idx)
+                if idx < 0:
+                    break
+                yield pos + idx
+
+    @staticmethod
+    def _newlines_forwards(f):
+        pos = 0
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            idx = chunk.find(b'\n')
+            while idx >= 0:
+                yield pos + idx
+                idx = chunk.find(b'\n', idx + 1)
+            pos += len(chunk)
+
+    def tail_offset(self, lines):
+        '''Return where the last `lines` lines of the log start. Only as
+           much of the log as those lines span is read, from the end.'''
+        pieces, active = self._pieces()
+        try:
+            return self._tail_offset(pieces, lines)
+        finally:
+            if active:
+                active.close()
+
+    def _tail_offset(self, pieces, lines):
+        if not pieces:
+            return 0
+        first, size = pieces[0][0], pieces[-1][1]
+        if lines <= 0 or size == first:
+            return size
+        wanted = lines
+        if b''.join(self.read(size - 1, size)) == b'\n':
+            # the newline ending the last line doesn't start a new one
+            wanted += 1
+        for pstart, pend, opener, compressed in reversed(pieces):
+            if not compressed:
+                with opener() as f:
+                    for idx in self._newlines_backwards(f, pend - pstart):
+                        wanted -= 1
+                        if wanted == 0:
+                            return pstart + idx + 1
+                continue
+            # compressed data can only be read forwards, so count its
+            # newlines first and then go find the one we're after
+            with opener() as f:
+                count = sum(1 for _ in self._newlines_forwards(f))
+            if count < wanted:
+                wanted -= count
+                continue
+            with opener() as f:
+                for i, idx in enumerate(self._newlines_forwards(f)):
+                    if i == count - wanted:
+                        return pstart + idx + 1
+        return first
+
+    def follow(self, start, timeout, interval):
+        '''Yield the log from start on and then whatever is appended to it,
+           until nothing has been for timeout seconds.'''
+        pos = start
+        for chunk in self.read(start):
+            pos += len(chunk)
+            yield chunk
+        idle_since = time.time()
+        active_start, f = self._open_active()
+        try:
+            while True:
+                if pos < active_start:
+                    # rotated while we were reading
+                    for chunk in self.read(pos, active_start):
+                        pos += len(chunk)
+                        yield chunk
+                    # anything still missing was deleted
+                    pos = max(pos, active_start)
+                    idle_since = time.time()
+                if f is not None:
+                    f.seek(max(pos - active_start, 0))
+                    chunk = f.read(CHUNK_SIZE)
+                    if chunk:
+                        pos += len(chunk)
+                        idle_since = time.time()
+                        yield chunk
+                        continue
+                    try:
+                        rotated = os.stat(self.path).st_ino != \
+                            os.fstat(f.fileno()).st_ino
+                    except FileNotFoundError:
+                        rotated = True
+                else:
+                    rotated = os.path.exists(self.path)
+                if rotated:
+                    # what we have open was rotated, it's fully read now
+                    if f is not None:
+                        f.close()
+                    active_start, f = self._open_active()
+                    continue
+                if time.time() - idle_since >= timeout:
+                    return
+                time.sleep(interval)
+        finally:
+            if f is not None:
+                f.close()
+
+
+def log_files(hosts_dir):
+    '''Return every container log under hosts_dir as a ContainerLog.'''
+    logs = []
+    pattern = os.path.join(hosts_dir, '*', 'containers', '*', 'logs', '*')
+    for path in glob.glob(pattern):
+        if is_log(os.path.basename(path)):
+            logs.append(path)
+    # logs whose active file is gone but still have segments
+    for path in glob.glob(pattern):
+        m = _SEGMENT.match(os.path.basename(path))
+        if m:
+            active = os.path.join(os.path.dirname(path), m.group('name'))
+            if active not in logs:
+                logs.append(active)
+    return logs
+
+
+def compact(hosts_dir, budget, idle, compression='auto'):
+    '''Rotate logs idle for `idle` seconds (0 to leave them be), compress
+       anything a crash left uncompressed and delete the oldest segments
+       across the whole fleet until the logs take at most `budget` bytes of
+       disk (0 is no limit).
+       Returns the number of segments deleted.'''
+    segments = []
+    total = 0
+    for path in log_files(hosts_dir):
+        clog = ContainerLog(path, compression=compression)
+        if idle:
+            try:
+                clog.rotate(idle)
+            except OSError:
+                log.exception('Unable to rotate: %s', path)
+        try:
+            total += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        clog_segments = clog.segments()
+        for start, end, seg in clog_segments:
+            if not _SEGMENT.match(os.path.basename(seg)).group('ext'):
+                seg = _compress(seg, compression)
+            try:
+                st = os.stat(seg)
+            except FileNotFoundError:
+                continue
+            if st.st_size:
+                newest = end == clog_segments[-1][1]
+                total += st.st_size
+                segments.append((st.st_mtime, seg, st.st_size, newest))
+
+    deleted = 0
+    if budget:
+        segments.sort()
+        while segments and total > budget:
+            _, seg, size, newest = segments.pop(0)
+            log.info('Deleting log segment to stay within budget: %s', seg)
+            if newest:
+                # its name says where the active file starts, so it stays
+                os.truncate(seg, 0)
+            else:
+                os.unlink(seg)
+            total -= size
+            deleted += 1
+    return deleted
+
+
+class Compactor(object):
+    '''Runs `func` every `interval` seconds on a daemon thread. When more
+       than one server process runs one, a lock file lets only one of them
+       work at a time and its mtime records when the last run started.'''
+
+    def __init__(self, func, lockfile, interval):
+        self.func = func
+        self.lockfile = lockfile
+        self.interval = interval
+        self._thread = None
+
+    def run_once(self, min_age=0):
+        '''Returns what `func` did or None if another process is running it
+           or did so less than `min_age` seconds ago.'''
+        with open(self.lockfile, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None  # another process is on it
+            if time.time() - os.fstat(f.fileno()).st_mtime < min_age:
+                return None
+            os.utime(f.fileno())
+            return self.func()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                # every server worker has a thread, one run per interval will
+                # do for all of them
+                self.run_once(self.interval * 0.9)
+            except Exception:
+                log.exception('Log compaction failed')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
@@ -1,11 +1,96 @@
 #!/usr/bin/env python3
 import argparse
+import os
+import sys
 
-from cya_server import app
+from cya_server import app, settings
 
 
 def _run(args):
-    app.run(args.host, args.port)
+    from cya_server.models import log_compactor
+    log_compactor.start()
+    # threaded so clients waiting on changes don't block everyone else
+    app.run(args.host, args.port, threaded=True)
+
+
+def _serve(args):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit('The serve command requires gunicorn: pip3 install gunicorn')
+
+    def post_worker_init(worker):
+        from cya_server.models import log_compactor
+        log_compactor.start()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '%s:%d' % (args.host, args.port))
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('keepalive', args.keepalive)
+            self.cfg.set('post_worker_init', post_worker_init)
+
+        def load(self):
+            # already imported by us, so settings like a generated
+            # SECRET_KEY are shared by every worker
+            return app
+    if not settings.METRICS_DIR:
+        settings.METRICS_DIR = os.path.join(settings.MODELS_DIR, '.metrics')
+    Application().run()
+
+
+def _compact_pings(args):
+    from cya_server.models import hosts
+    for name in hosts.list():
+        if hosts.get(name).compact_pings():
+            print('Compacted pings.log for: %s' % name)
+
+
+def _compact_models(args):
+    from cya_server import models
+    for manager in (models.hosts, models.users, models.shared_storage,
+                    models.container_requests):
+        print('Compacted %d %s' % (
+            manager.compact(), os.path.basename(manager._model_dir)))
+
+
+def _compact_logs(args):
+    from cya_server.models import log_compactor
+    deleted = log_compactor.run_once()
+    if deleted is None:
+        print('Logs are being compacted by a running server')
+    else:
+        print('Deleted %d log segments' % deleted)
+
+
+def _profile(args):
+    from cya_server.views.metrics import profile_flag
+    flag = profile_flag()
+    if args.state == 'on':
+        os.makedirs(os.path.dirname(flag), exist_ok=True)
+        open(flag, 'a').close()
+        print('Profiling requests into: %s' % os.path.dirname(flag))
+    elif os.path.exists(flag):
+        os.unlink(flag)
+
+
+def _rebuild_indexes(args):
+    from cya_server.models import users
+    users.rebuild_indexes()
+
+
+def _copy_storage(args):
+    from cya_server import models
+    from cya_server.simplemodels import copy_models
+    from cya_server.storage import create_backend
+    db = settings.STORAGE_DB or os.path.join(settings.MODELS_DIR, 'models.db')
+    src = create_backend(args.src, db)
+    dst = create_backend(args.dst, db)
+    print('Copied %d models' % copy_models(src, dst, (
+        models.hosts, models.users, models.shared_storage,
+        models.container_requests)))
 
 
 def main():
@@ -18,8 +103,52 @@ def main():
     p.add_argument('-p', '--port', type=int, default=8000)
     p.set_defaults(func=_run)
 
+    p = sub.add_parser('serve',
+                       help='Run webserver with multiple worker processes')
+    p.add_argument('--host', default='0.0.0.0')
+    p.add_argument('-p', '--port', type=int, default=8000)
+    p.add_argument('-w', '--workers', type=int,
+                   default=int(settings.SERVE_WORKERS))
+    p.add_argument('-t', '--threads', type=int,
+                   default=int(settings.SERVE_THREADS))
+    p.add_argument('--keepalive', type=int,
+                   default=int(settings.SERVE_KEEPALIVE),
+                   help='Seconds to keep idle client connections open')
+    p.set_defaults(func=_serve)
+
+    p = sub.add_parser('compact-pings',
+                       help='Replace old pings.log files with heartbeats')
+    p.set_defaults(func=_compact_pings)
+
+    p = sub.add_parser('compact-models',
+                       help='Strip embedded child data from props.json files')
+    p.set_defaults(func=_compact_models)
+
+    p = sub.add_parser('compact-logs',
+                       help='Rotate idle container logs and enforce the log '
+                            'retention budget')
+    p.set_defaults(func=_compact_logs)
+
+    p = sub.add_parser('profile',
+                       help='Turn the cProfile dump of every request served '
+                            'on or off')
+    p.add_argument('state', choices=('on', 'off'))
+    p.set_defaults(func=_profile)
+
+    p = sub.add_parser('rebuild-indexes',
+                       help='Rebuild model lookup indexes from scratch')
+    p.set_defaults(func=_rebuild_indexes)
+
+    p = sub.add_parser('copy-storage',
+                       help='Copy all models from one storage backend to '
+                            'another')
+    p.add_argument('src', choices=('filesystem', 'sqlite'))
+    p.add_argument('dst', choices=('filesystem', 'sqlite'))
+    p.set_defaults(func=_copy_storage)
+
     args = parser.parse_args()
     args.func(args)
 
+
 if __name__ == '__main__':
     main()
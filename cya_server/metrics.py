@@ -0,0 +1,240 @@
+'''Counters and histograms for the /metrics endpoint.
+
+Metrics are kept per process. A server running more than one process saves
+them in a shared directory with dump() so any process can render() them all.
+'''
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# seconds, from a props cache hit to a long poll
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                   2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s needs labels: %s' % (
+                self.name, ', '.join(self.labelnames)))
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def snapshot(self):
+        '''Return a JSON friendly copy of the values.'''
+        with self._lock:
+            return [[list(k), self._copy(v)] for k, v in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    @staticmethod
+    def merge(into, value):
+        return (into or 0) + value
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield '%s%s %r' % (self.name, _labels(self.labelnames, key),
+                               float(value))
+
+
+class Histogram(_Metric):
+    '''Observations are counted in the first bucket they fit in, the
+       cumulative counts Prometheus wants are worked out when rendering.'''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1]]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # one more for +Inf
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][idx] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    @staticmethod
+    def merge(into, value):
+        if into is None:
+            return [list(value[0]), value[1]]
+        return [[a + b for a, b in zip(into[0], value[0])], into[1] + value[1]]
+
+    def render(self, values):
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            bounds = [repr(float(x)) for x in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '%s_bucket%s %d' % (self.name, _labels(
+                    self.labelnames, key, [('le', bound)]), cumulative)
+            labels = _labels(self.labelnames, key)
+            yield '%s_sum%s %r' % (self.name, labels, float(total))
+            yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+def _reset_all():
+    for metric in _registry:
+        metric._lock = threading.Lock()
+        metric._values = {}
+
+
+# a forked worker starts from zero, its parent still reports what it did
+os.register_at_fork(after_in_child=_reset_all)
+
+
+def snapshot():
+    return {x.name: x.snapshot() for x in _registry}
+
+
+def dump(dirname):
+    '''Save this process's metrics for render() in other processes.'''
+    os.makedirs(dirname, exist_ok=True)
+    path = os.path.join(dirname, '%d.json' % os.getpid())
+    # threads may dump at the same time, each needs a temp file of its own
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.%d.' % os.getpid())
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot(), f)
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _snapshots(dirname):
+    yield snapshot()
+    if not dirname:
+        return
+    try:
+        names = os.listdir(dirname)
+    except FileNotFoundError:
+        return
+    for name in names:
+        pid, ext = os.path.splitext(name)
+        if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            # a worker that has exited, its counts go with it
+            try:
+                os.unlink(os.path.join(dirname, name))
+            except FileNotFoundError:
+                pass
+            continue
+        except PermissionError:
+            pass  # alive, just not ours
+        try:
+            with open(os.path.join(dirname, name)) as f:
+                yield json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+
+
+def render(dirname=None):
+    '''Return every metric in the Prometheus text format. With `dirname`
+       the metrics other processes saved there with dump() are added in.'''
+    merged = {x.name: {} for x in _registry}
+    metrics = {x.name: x for x in _registry}
+    for snap in _snapshots(dirname):
+        for name, values in snap.items():
+            metric = metrics.get(name)
+            if metric is None:
+                continue
+            for key, value in values:
+                key = tuple(key)
+                merged[name][key] = metric.merge(merged[name].get(key), value)
+
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines.extend(metric.render(merged[metric.name]))
+    return '\n'.join(lines) + '\n'
+
+
+requests = Histogram(
+    'cya_request_seconds', 'Time spent handling requests',
+    ['endpoint', 'method'])
+responses = Counter(
+    'cya_responses_total', 'Responses sent', ['endpoint', 'method', 'status'])
+props_reads = Counter(
+    'cya_props_reads_total', 'Model props loaded', ['backend', 'source'])
+props_writes = Counter(
+    'cya_props_writes_total', 'Model props written', ['backend', 'op'])
+lock_wait = Histogram(
+    'cya_lock_wait_seconds', 'Time spent waiting for locks', ['lock'])
+secret_verify = Histogram(
+    'cya_secret_verify_seconds', 'Time spent verifying hashed API keys')
+secret_cache = Counter(
+    'cya_secret_cache_total', 'API key checks by cache result', ['result'])
+to_dict = Histogram(
+    'cya_to_dict_seconds', 'Time spent serializing models', ['model'])
+scheduler_pass = Histogram(
+    'cya_scheduler_pass_seconds', 'Time spent placing queued requests')
+scheduler_placed = Counter(
+    'cya_scheduler_placed_total', 'Container requests placed on hosts')
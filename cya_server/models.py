@@ -1,19 +1,46 @@
+import contextlib
 import datetime
+import fcntl
+import io
+import logging
 import os
 import random
+import struct
 import time
 import string
+import threading
+import weakref
 
+from cya_server import concurrently, metrics
+from cya_server.logs import Compactor, ContainerLog, compact, is_log
+from cya_server.scheduler import PlacementIndex, ONLINE_WINDOW, get_policy
 from cya_server.settings import (
-    MODELS_DIR, CONTAINER_TYPES, CLIENT_SCRIPT)
+    API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL, MODELS_DIR, CONTAINER_TYPES,
+    CLIENT_SCRIPT, LOG_COMPACT_INTERVAL, LOG_COMPRESSION, LOG_RETENTION_BYTES,
+    LOG_ROTATE_IDLE, LOG_ROTATE_SIZE, LONG_POLL_INTERVAL, PLACEMENT_POLICY,
+    PLACEMENT_RESYNC_INTERVAL, PROPS_CACHE_SIZE, STORAGE_BACKEND, STORAGE_DB)
 from cya_server.simplemodels import (
-    Field, Model, ModelManager, ModelError, SecretField)
+    Field, Model, ModelManager, ModelError, SecretCache, SecretField,
+    add_listener, get_storage, set_storage)
+from cya_server.storage import create_backend, props_cache
+
+log = logging.getLogger()
+host_api_keys = SecretCache(int(API_KEY_CACHE_SIZE), int(API_KEY_CACHE_TTL))
+props_cache.max_size = int(PROPS_CACHE_SIZE)
+set_storage(create_backend(
+    STORAGE_BACKEND, STORAGE_DB or os.path.join(MODELS_DIR, 'models.db')))
 
 
 def client_version():
     return str(os.stat(CLIENT_SCRIPT).st_mtime)
 
 
+def date_str(timestamp):
+    if timestamp:
+        return datetime.datetime.fromtimestamp(timestamp)
+    return '?'
+
+
 class ContainerMount(Model):
     FIELDS = [
         Field('type', data_type=str),
@@ -44,20 +71,17 @@ class Container(Model):
         Field('requested_by', data_type=str, required=False),
     ]
     CHILDREN = [ContainerMount, InitScript]
+    # what the client reports back, changing them doesn't change what the
+    # host should be doing
+    REPORTED_FIELDS = frozenset(('state', 'ips'))
 
     @property
     def requested_str(self):
-        v = self.date_requested
-        if v:
-            return datetime.datetime.fromtimestamp(v)
-        return '?'
+        return date_str(self.date_requested)
 
     @property
     def created_str(self):
-        v = self.date_created
-        if v:
-            return datetime.datetime.fromtimestamp(v)
-        return '?'
+        return date_str(self.date_created)
 
     def update(self, data):
         if self.date_created and \
@@ -65,25 +89,64 @@ class Container(Model):
             data['re_create'] = False
         return super(Container, self).update(data)
 
-    def _get_log_file(self, logname):
+    def delete(self):
+        max_memory = self.max_memory
+        super(Container, self).delete()
+        if type(self) is Container:
+            # modeldir is: <hosts>/<host>/containers/<name>
+            host = os.path.dirname(os.path.dirname(self._modeldir))
+            placement.container_removed(os.path.basename(host), max_memory)
+
+    def _get_log(self, logname):
         logdir = os.path.join(self._modeldir, 'logs')
         if not os.path.exists(logdir):
-            os.mkdir(logdir)
-        return os.path.join(logdir, logname)
+            os.makedirs(logdir)
+        return ContainerLog(os.path.join(logdir, logname),
+                            int(LOG_ROTATE_SIZE), LOG_COMPRESSION)
 
     def append_log(self, logname, content):
-        with open(self._get_log_file(logname), 'a') as f:
-            f.write(content)
+        self.write_log(logname, io.BytesIO(content.encode()))
+
+    def write_log(self, logname, stream, offset=None):
+        '''Copy `stream` into the log in chunks, as the bytes from `offset`
+           on. Bytes the log already has are skipped so retrying an upload
+           never duplicates data. Without an offset it's appended. Returns
+           the new size of the log.'''
+        return self._get_log(logname).write(stream, offset)
+
+    def get_log_size(self, logname):
+        return self._get_log(logname).size()
+
+    def log_first_offset(self, logname):
+        '''Return where the part of the log retention has kept starts.'''
+        return self._get_log(logname).first_offset()
 
     def get_log_names(self):
         logdir = os.path.join(self._modeldir, 'logs')
         if os.path.exists(logdir):
-            return os.listdir(logdir)
+            return sorted(x for x in os.listdir(logdir) if is_log(x))
         return []
 
     def get_log(self, logname):
-        with open(self._get_log_file(logname)) as f:
-            return f.read()
+        clog = self._get_log(logname)
+        if not clog.exists():
+            raise FileNotFoundError(clog.path)
+        return b''.join(clog.read()).decode()
+
+    def read_log(self, logname, start=0, end=None):
+        '''Yield the log's bytes from start up to end in chunks, rotated
+           segments are decompressed on the way.'''
+        return self._get_log(logname).read(start, end)
+
+    def log_tail_offset(self, logname, lines):
+        '''Return where the last `lines` lines of the log start.'''
+        return self._get_log(logname).tail_offset(lines)
+
+    def follow_log(self, logname, start, timeout):
+        '''Yield the log from start on and then whatever is appended to it,
+           until nothing has been for timeout seconds.'''
+        return self._get_log(logname).follow(
+            start, timeout, float(LONG_POLL_INTERVAL))
 
     def __repr__(self):
         return self.name
@@ -97,6 +160,144 @@ class Container(Model):
             raise KeyError('Invalid release for template: %s' % release)
 
 
+class Heartbeat(object):
+    '''A constant size record of the last SLOTS pings of a host.
+
+       The file is a header holding the newest slot and its timestamp
+       followed by a ring of SLOTS timestamps. It never grows and the last
+       ping is always at offset 0, so reading it is a single small pread.
+    '''
+    SLOTS = 16
+    _HEADER = struct.Struct('<Qd')
+    _SLOT = struct.Struct('<d')
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self):
+        '''Hold the record's lock, yielding a descriptor for record().'''
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            # models kept in a database don't have a directory until needed
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    def record(self, when, fd=None):
+        '''Add a ping, `fd` is needed when the caller holds locked().'''
+        if fd is None:
+            with self.locked() as fd:
+                return self.record(when, fd)
+        header = os.pread(fd, self._HEADER.size, 0)
+        if len(header) == self._HEADER.size:
+            slot = (self._HEADER.unpack(header)[0] + 1) % self.SLOTS
+        else:
+            os.ftruncate(fd, self._HEADER.size + self.SLOTS * self._SLOT.size)
+            slot = 0
+        os.pwrite(fd, self._SLOT.pack(when),
+                  self._HEADER.size + slot * self._SLOT.size)
+        os.pwrite(fd, self._HEADER.pack(slot, when), 0)
+
+    def last(self):
+        '''The time of the last ping or None if there's no heartbeat.'''
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(self._HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) != self._HEADER.size:
+            return None
+        return self._HEADER.unpack(header)[1]
+
+    def history(self):
+        '''The recorded ping times, newest first.'''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        if len(data) < self._HEADER.size + self.SLOTS * self._SLOT.size:
+            return []  # being created by record()
+        newest, _ = self._HEADER.unpack_from(data)
+        times = []
+        for x in range(self.SLOTS):
+            slot = (newest - x) % self.SLOTS
+            when = self._SLOT.unpack_from(
+                data, self._HEADER.size + slot * self._SLOT.size)[0]
+            if when:
+                times.append(when)
+        return times
+
+
+class Revision(object):
+    '''A counter that is bumped every time a host's desired state changes.
+
+       Clients waiting on a host compare it against the revision they last
+       saw. Waiters in this process are woken through a Condition, waiters
+       in other server processes notice within LONG_POLL_INTERVAL.
+    '''
+    _VALUE = struct.Struct('<Q')
+    # an entry goes once no Revision for the host is left, so deleted hosts
+    # don't keep theirs forever
+    _conditions = weakref.WeakValueDictionary()
+    _conditions_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with self._conditions_lock:
+            self._cond = self._conditions.get(path)
+            if self._cond is None:
+                self._cond = threading.Condition()
+                self._conditions[path] = self._cond
+
+    def get(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read(self._VALUE.size)
+        except FileNotFoundError:
+            return 0
+        if len(data) != self._VALUE.size:
+            return 0
+        return self._VALUE.unpack(data)[0]
+
+    def bump(self):
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(self.path))
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, self._VALUE.size, 0)
+            value = 0
+            if len(data) == self._VALUE.size:
+                value = self._VALUE.unpack(data)[0]
+            os.pwrite(fd, self._VALUE.pack(value + 1), 0)
+        finally:
+            os.close(fd)
+        with self._cond:
+            self._cond.notify_all()
+        return value + 1
+
+    def wait(self, revision, timeout):
+        '''Wait up to timeout seconds for the revision to be something other
+           than `revision` and return the current one.'''
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                current = self.get()
+                remaining = deadline - time.time()
+                if current != revision or remaining <= 0:
+                    return current
+                self._cond.wait(min(remaining, float(LONG_POLL_INTERVAL)))
+
+
 class Host(Model):
     FIELDS = [
         Field('distro_id', data_type=str),
@@ -116,6 +317,21 @@ class Host(Model):
     def __repr__(self):
         return self.name
 
+    def verify_api_key(self, key):
+        return host_api_keys.verify(self.name, key, self.api_key)
+
+    def update(self, data):
+        rv = super(Host, self).update(data)
+        if 'api_key' in data:
+            host_api_keys.invalidate(self.name)
+        placement.refresh(self.name)
+        return rv
+
+    def delete(self):
+        super(Host, self).delete()
+        host_api_keys.invalidate(self.name)
+        placement.host_removed(self.name)
+
     def get_container(self, name):
         for c in self.containers:
             if c.name == name:
@@ -123,21 +339,96 @@ class Host(Model):
         raise ModelError('Container not found: %s' % name, 404)
 
     def _get_ping_file(self):
+        # pings used to be appended here forever, see compact_pings
         return os.path.join(self._modeldir, 'pings.log')
 
-    def ping(self):
-        with open(self._get_ping_file(), mode='a') as f:
-            f.write('%d\n' % time.time())
+    def _get_heartbeat(self):
+        return Heartbeat(os.path.join(self._modeldir, 'heartbeat'))
+
+    def _get_revision(self, name='revision'):
+        return Revision(os.path.join(self._modeldir, name))
 
     @property
-    def online(self):
-        """Online means we've been "pinged" in the last 3 minutes."""
+    def revision(self):
+        return self._get_revision().get()
+
+    @property
+    def reported_revision(self):
+        '''Bumped by reported() so the host's data can still be versioned
+           by (revision, reported_revision).'''
+        return self._get_revision('reported').get()
+
+    def reported(self):
+        '''Note a change to something only the client reports, which
+           doesn't wake up anyone waiting on the host.'''
+        return self._get_revision('reported').bump()
+
+    def changed(self):
+        '''Tell clients waiting on this host that something changed.'''
+        return self._get_revision().bump()
+
+    def wait_for_change(self, revision, timeout):
+        return self._get_revision().wait(revision, timeout)
+
+    def compact_pings(self):
+        '''Move the tail of an old pings.log into the heartbeat record.'''
         ping_file = self._get_ping_file()
         if not os.path.exists(ping_file):
             return False
+        heartbeat = self._get_heartbeat()
+        # workers handling the same host mustn't both move it
+        with heartbeat.locked() as fd:
+            try:
+                with open(ping_file, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    # each line is a 10 digit timestamp and a newline
+                    start = max(0, f.tell() - 12 * (Heartbeat.SLOTS + 1))
+                    f.seek(start)
+                    lines = f.read().split()
+            except FileNotFoundError:
+                return False
+            if start:
+                lines = lines[1:]  # most likely a partial line
+            last = heartbeat.last() or 0
+            for line in lines[-Heartbeat.SLOTS:]:
+                when = float(line)
+                if when > last:
+                    heartbeat.record(when, fd)
+            try:
+                os.unlink(ping_file)
+            except FileNotFoundError:
+                pass  # already moved
+        return True
+
+    def ping(self):
         now = time.time()
-        mtime = os.path.getmtime(self._get_ping_file())
-        return now - mtime < 180  # pinged in last 3 minutes
+        self.compact_pings()
+        self._get_heartbeat().record(now)
+        placement.host_pinged(self.name, now)
+
+    @staticmethod
+    def _last_ping(modeldir):
+        last = Heartbeat(os.path.join(modeldir, 'heartbeat')).last()
+        if last is None:
+            # a host that hasn't pinged since pings.log was replaced
+            try:
+                return os.path.getmtime(os.path.join(modeldir, 'pings.log'))
+            except FileNotFoundError:
+                return 0
+        return last
+
+    @property
+    def last_ping(self):
+        return self._last_ping(self._modeldir)
+
+    @property
+    def pings(self):
+        return self._get_heartbeat().history()
+
+    @property
+    def online(self):
+        """Online means we've been "pinged" in the last 3 minutes."""
+        return time.time() - self.last_ping < ONLINE_WINDOW
 
 
 class User(Model):
@@ -151,6 +442,7 @@ class User(Model):
     CHILDREN = [
         InitScript,
     ]
+    INDEXES = ['openid']
 
 
 class SharedStorage(Model):
@@ -170,12 +462,20 @@ shared_storage = ModelManager(MODELS_DIR, SharedStorage)
 container_requests = ModelManager(MODELS_DIR, ContainerRequest)
 
 
+def _compact_logs():
+    '''Rotate idle container logs and delete the oldest rotated segments
+       until they all fit in the fleet's LOG_RETENTION_BYTES.'''
+    return compact(hosts._model_dir, int(LOG_RETENTION_BYTES),
+                   int(LOG_ROTATE_IDLE), LOG_COMPRESSION)
+log_compactor = Compactor(
+    _compact_logs, hosts._model_dir + '.compact.lock',
+    float(LOG_COMPACT_INTERVAL))
+placement = PlacementIndex(
+    hosts, int(PLACEMENT_RESYNC_INTERVAL), get_policy(PLACEMENT_POLICY))
+
+
 def _get_user_by_openid(openid):
-    for x in users.list():
-        x = users.get(x)
-        if x.openid == openid:
-            return x
-    return None
+    return users.find('openid', openid)
 users.get_user_by_openid = _get_user_by_openid
 
 
@@ -185,36 +485,128 @@ def _generate_api_key():
 users.generate_api_key = _generate_api_key
 
 
-def _container_request_handle(host):
-    '''Dumb logic but find host with least number of containers.
-       It also honors allowing max_containers on a host.
+def fleet_snapshot():
+    '''Return every host with its containers and every queued request.
+
+       This is built in a single os.scandir pass per directory with props
+       served from the props cache instead of creating a Model per item.
+    '''
+    now = time.time()
+    host_list = hosts.snapshot()
+    for h in host_list:
+        path = os.path.join(hosts._model_dir, h['name'])
+        del h['api_key']
+        h['online'] = now - Host._last_ping(path) < ONLINE_WINDOW
+        h['containers'] = ModelManager(path, Container).snapshot()
+    return {
+        'hosts': host_list,
+        'requests': container_requests.snapshot(),
+    }
+
+
+def _move_request(name, host_name):
+    # the storage backend's move is atomic
+    host = hosts.get(host_name)
+    src = os.path.join(container_requests._model_dir, name)
+    dst = os.path.join(host.containers._model_dir, name)
+    try:
+        get_storage().move(src, dst)
+    except FileNotFoundError:
+        return False  # another server process placed it
+    except OSError as e:
+        log.error('Unable to move request %s to %s: %s', name, host_name, e)
+        return False
+    host.changed()
+    return True
+
+
+def _container_request_handle(host=None):
+    '''Place as many queued requests as the fleet has room for, oldest
+       first. The placement policy picks the host for each. It honors
+       max_containers and won't commit more memory to a host than it has.
+       `host` is the host checking in, one that isn't enlisted doesn't
+       trigger a pass.
     '''
-    if not host.enlisted or (host.max_containers and
-                             host.max_containers <= host.containers.count()):
-        return  # no point in checking
+    if host is not None and not host.enlisted:
+        return []
+    with metrics.scheduler_pass.time():
+        placed = _place_requests()
+    for name, host_name in placed:
+        log.info('Placed container request %s on %s (check-in from %s)',
+                 name, host_name, host)
+    return placed
+container_requests.handle = _container_request_handle
 
-    requests = list(container_requests.list())
-    if not requests:
-        return
-    candidates = []
-    for h in hosts.list():
-        h = hosts.get(h)
-        h.count_cache = h.containers.count()
-        if h.enlisted and h.online and (h.max_containers == 0 or
-                                        h.count_cache < h.max_containers):
-                candidates.append(h)
-
-    candidates = sorted(candidates, key=lambda x: -1 * x.mem_total)
-    candidates = sorted(candidates, key=lambda x: x.count_cache)
-    match = candidates and host.name == candidates[0].name
-
-    if match:
-        # use os.rename which is atomic
-        src = os.path.join(container_requests._model_dir, requests[0])
-        dst = os.path.join(host.containers._model_dir, requests[0])
+
+def _place_requests():
+    # the queue isn't worth reading when no host has room for anything
+    if placement.best() is None:
+        return []
+    queue = []
+    for name in container_requests.list():
         try:
-            os.mkdir(host.containers._model_dir)
-        except FileExistsError:
-            pass
-        os.rename(src, dst)
-container_requests.handle = _container_request_handle
+            r = container_requests.get(name)
+            queue.append((r.date_requested or 0, name, r.max_memory or 0))
+        except (ModelError, FileNotFoundError):
+            pass  # placed by another server process
+    if not queue:
+        return []
+    queue.sort()
+
+    lock = container_requests._model_dir + '.lock'
+    with concurrently.open_for_write(lock, append=True, lock='scheduler'):
+        placed = placement.place(
+            [(name, mem) for _, name, mem in queue], _move_request)
+    metrics.scheduler_placed.inc(len(placed))
+    return placed
+
+
+_batch = threading.local()
+
+
+@contextlib.contextmanager
+def batched_changes():
+    '''Bump the revision of each host changed in the block once, when it
+       ends, rather than once for every model changed.'''
+    if getattr(_batch, 'pending', None) is not None:
+        yield  # already in a batch
+        return
+    pending = _batch.pending = {}
+    try:
+        yield
+    finally:
+        _batch.pending = None
+        for name, reported in pending.items():
+            _bump_host(name, reported)
+
+
+def _bump_host(name, reported):
+    try:
+        host = hosts.get(name)
+        if reported:
+            host.reported()
+        else:
+            host.changed()
+    except ModelError:
+        pass  # the host itself was deleted
+
+
+def _model_changed(path, fields=None):
+    # bump the revision of the host a changed model belongs to
+    rel = os.path.relpath(path, hosts._model_dir)
+    if rel.startswith('..'):
+        return
+    parts = rel.split(os.sep)
+    reported = False
+    if fields is not None:
+        if not fields:
+            return
+        # the client doesn't need waking up for what it just told us
+        reported = len(parts) == 3 and parts[1] == 'containers' and \
+            not set(fields) - Container.REPORTED_FIELDS
+    pending = getattr(_batch, 'pending', None)
+    if pending is not None:
+        pending[parts[0]] = pending.get(parts[0], True) and reported
+    else:
+        _bump_host(parts[0], reported)
+add_listener(_model_changed)
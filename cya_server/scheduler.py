@@ -0,0 +1,317 @@
+import abc
+import heapq
+import importlib
+import logging
+import threading
+import time
+
+from cya_server.simplemodels import ModelError
+
+log = logging.getLogger()
+
+# a host is online if its been "pinged" in the last 3 minutes
+ONLINE_WINDOW = 180
+
+
+def committed_memory(host):
+    '''The sum of max_memory for all containers on the host.'''
+    total = 0
+    for name in host.containers.list():
+        try:
+            total += host.containers.get(name).max_memory or 0
+        except (ModelError, FileNotFoundError):
+            pass  # deleted while we were looking
+    return total
+
+
+class HostState(object):
+    '''What the scheduler needs to know about a host.
+
+       Adding up the memory of every container is the expensive part, so
+       `mem_committed` can be passed in when its already known.
+    '''
+    __slots__ = ('name', 'enlisted', 'max_containers', 'mem_total',
+                 'cpu_total', 'count', 'mem_committed', 'last_ping',
+                 'version')
+
+    def __init__(self, host, mem_committed=None):
+        self.name = host.name
+        self.enlisted = host.enlisted
+        self.max_containers = host.max_containers
+        self.mem_total = host.mem_total
+        self.cpu_total = host.cpu_total
+        self.count = host.containers.count()
+        if mem_committed is None:
+            mem_committed = committed_memory(host)
+        self.mem_committed = mem_committed
+        self.last_ping = host.last_ping
+        self.version = 0
+
+    def same(self, other):
+        return (self.enlisted, self.max_containers, self.mem_total,
+                self.cpu_total, self.count) == (
+            other.enlisted, other.max_containers, other.mem_total,
+            other.cpu_total, other.count)
+
+    @property
+    def online(self):
+        return time.time() - self.last_ping < ONLINE_WINDOW
+
+    @property
+    def has_room(self):
+        return self.max_containers == 0 or self.count < self.max_containers
+
+    @property
+    def available(self):
+        return self.enlisted and self.has_room and self.online
+
+    @property
+    def mem_free(self):
+        return self.mem_total - self.mem_committed
+
+    def fits(self, max_memory):
+        '''Containers without a max_memory fit anywhere.'''
+        return not max_memory or max_memory <= self.mem_free
+
+
+class PlacementPolicy(abc.ABC):
+    '''Decides which host gets a container.
+
+       choose() returns the HostState of the host that should get a container
+       needing `max_memory` bytes, or None if no host can take it. Candidates
+       must be checked with index.verify() before being returned. Custom
+       policies can be used by setting PLACEMENT_POLICY to "module:Class".
+    '''
+    @abc.abstractmethod
+    def choose(self, index, max_memory):
+        pass
+
+
+class LeastContainers(PlacementPolicy):
+    '''The host with the fewest containers, then the most memory, wins.
+
+       Uses the index's heap so this is O(log hosts).
+    '''
+    def choose(self, index, max_memory):
+        heap = index._heap
+        too_small = []
+        try:
+            while heap:
+                entry = heap[0]
+                state = index._states.get(entry[2])
+                if state is None or state.version != entry[3]:
+                    heapq.heappop(heap)  # superseded entry
+                    continue
+                if not state.available:
+                    heapq.heappop(heap)  # it gets re-pushed on its next update
+                    continue
+                current = index.verify(state)
+                if current is not state:
+                    continue  # changed and was re-pushed (or removed)
+                if not state.fits(max_memory):
+                    too_small.append(heapq.heappop(heap))
+                    continue
+                return state
+            return None
+        finally:
+            for entry in too_small:
+                heapq.heappush(heap, entry)
+
+
+class _MemoryFit(PlacementPolicy):
+    '''Base for the memory bin-packing policies. Hosts are compared by the
+       memory they'd have left after taking the container. Ties go to the
+       host with fewer containers and then more CPUs.'''
+    @abc.abstractmethod
+    def _key(self, state, max_memory):
+        pass
+
+    def choose(self, index, max_memory):
+        while True:
+            candidates = [x for x in index._states.values()
+                          if x.available and x.fits(max_memory)]
+            if not candidates:
+                return None
+            state = min(candidates, key=lambda x: self._key(x, max_memory))
+            if index.verify(state) is state:
+                return state
+
+
+class BestFit(_MemoryFit):
+    '''Put the container where it leaves the least memory free. This packs
+       hosts as tightly as possible and keeps big holes for big requests.'''
+    def _key(self, state, max_memory):
+        return (state.mem_free - (max_memory or 0), state.count,
+                -state.cpu_total, state.name)
+
+
+class WorstFit(_MemoryFit):
+    '''Put the container where it leaves the most memory free. This spreads
+       the load so containers have the most room to grow.'''
+    def _key(self, state, max_memory):
+        return (-(state.mem_free - (max_memory or 0)), state.count,
+                -state.cpu_total, state.name)
+
+
+POLICIES = {
+    'least-containers': LeastContainers,
+    'best-fit': BestFit,
+    'worst-fit': WorstFit,
+}
+
+
+def get_policy(name):
+    '''Return a policy instance from its name or a "module:Class" path.'''
+    if name in POLICIES:
+        return POLICIES[name]()
+    if ':' in name:
+        module, clazz = name.split(':', 1)
+        return getattr(importlib.import_module(module), clazz)()
+    raise ValueError('Unknown placement policy: %s' % name)
+
+
+class PlacementIndex(object):
+    '''An in-memory index of the hosts' scheduling state.
+
+       Hosts are kept in a heap keyed by (count, -mem_total) so finding the
+       best place for a container is O(log hosts). Updates push a new heap
+       entry and the old one is discarded lazily when it reaches the top.
+       Which host actually gets a container is up to the `policy`.
+
+       The index is kept current by the model hooks in this process. Other
+       server processes may change things behind our back, so the chosen
+       host is always re-read from disk before it is returned and a full
+       re-sync is done every `resync_interval` seconds.
+    '''
+    def __init__(self, hosts, resync_interval=60, policy=None):
+        self.resync_interval = resync_interval
+        self.policy = policy or LeastContainers()
+        self._hosts = hosts
+        self._lock = threading.RLock()
+        self._states = {}
+        self._heap = []
+        self._synced = 0
+        self._synced_dir = None
+
+    def _push(self, state):
+        old = self._states.get(state.name)
+        if old:
+            state.version = old.version + 1
+        self._states[state.name] = state
+        if state.enlisted and state.has_room:
+            heapq.heappush(self._heap, (
+                state.count, -state.mem_total, state.name, state.version))
+
+    def _load(self, name, mem_committed=None):
+        try:
+            return HostState(self._hosts.get(name), mem_committed)
+        except (ModelError, FileNotFoundError):
+            return None
+
+    def _sync(self):
+        self._states = {}
+        self._heap = []
+        for name in self._hosts.list():
+            state = self._load(name)
+            if state:
+                self._push(state)
+        self._synced = time.time()
+        self._synced_dir = self._hosts._model_dir
+
+    def _maybe_sync(self):
+        if self._synced_dir != self._hosts._model_dir or \
+                time.time() - self._synced > self.resync_interval:
+            self._sync()
+
+    def verify(self, state):
+        '''Re-read a host's state from disk. Returns `state` itself if it
+           was still accurate and available, otherwise the index is updated
+           and the new state (or None if its gone) is returned.'''
+        current = self._load(state.name, state.mem_committed)
+        if current is None:
+            self._states.pop(state.name, None)
+            return None
+        if not current.same(state):
+            if current.count != state.count:
+                current = self._load(state.name)
+            self._push(current)
+            return current
+        state.last_ping = current.last_ping
+        if not state.available:
+            return None
+        return state
+
+    def refresh(self, name):
+        '''Re-read the state of a host from disk.'''
+        with self._lock:
+            self._maybe_sync()
+            old = self._states.get(name)
+            if old:
+                # only re-add container memory if the containers changed
+                state = self._load(name, old.mem_committed)
+                if state and state.count != old.count:
+                    state = self._load(name)
+            else:
+                state = self._load(name)
+            if state:
+                self._push(state)
+            else:
+                self._states.pop(name, None)
+            return state
+
+    def host_pinged(self, name, when):
+        with self._lock:
+            self._maybe_sync()
+            state = self._states.get(name)
+            if state is None:
+                self.refresh(name)
+            else:
+                was_online = state.online
+                state.last_ping = when
+                if not was_online:
+                    # it may have been dropped from the heap while offline
+                    self._push(state)
+
+    def host_removed(self, name):
+        with self._lock:
+            self._states.pop(name, None)
+
+    def container_added(self, name, max_memory=0, num=1):
+        with self._lock:
+            self._maybe_sync()
+            state = self._states.get(name)
+            if state:
+                state.count += num
+                state.mem_committed += num * (max_memory or 0)
+                self._push(state)
+
+    def container_removed(self, name, max_memory=0):
+        self.container_added(name, max_memory, -1)
+
+    def best(self, max_memory=0):
+        '''Return the HostState of the host that should get the next
+           container or None if no host can take one.'''
+        with self._lock:
+            self._maybe_sync()
+            return self.policy.choose(self, max_memory)
+
+    def place(self, requests, move):
+        '''Assign as many of the queued requests as capacity allows.
+
+           `requests` is a list of (name, max_memory) in queue order and
+           `move(name, host_name)` performs the actual placement. It returns
+           False if the request was no longer there. Requests that don't fit
+           on any host are left queued. Returns a list of (name, host_name).
+        '''
+        placed = []
+        with self._lock:
+            for name, max_memory in requests:
+                state = self.best(max_memory)
+                if state is None:
+                    if self.best() is None:
+                        break  # nothing has room for anything
+                    continue  # too big for now, try the next request
+                if move(name, state.name):
+                    self.container_added(state.name, max_memory)
+                    placed.append((name, state.name))
+        return placed
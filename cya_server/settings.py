@@ -35,6 +35,74 @@ AUTO_APPROVE_USER = True
 OPENID_STORE = os.path.join(_here, '../.openid')
 AUTO_ENLIST_HOSTS = True
 
+# Successful host API key checks are cached so that client check-ins don't
+# pay for a PBKDF2 verify every time.
+API_KEY_CACHE_TTL = 300
+API_KEY_CACHE_SIZE = 1024
+
+# Max number of parsed props.json files kept in memory per server process.
+PROPS_CACHE_SIZE = 4096
+
+# How often (seconds) the scheduler's in-memory view of the hosts is fully
+# re-read from disk to pick up changes made by other server processes.
+PLACEMENT_RESYNC_INTERVAL = 60
+
+# How the scheduler picks a host for a container:
+#  least-containers - fewest containers, then most memory
+#  best-fit - pack hosts by leaving the least memory free
+#  worst-fit - spread containers by leaving the most memory free
+# A custom policy can be given as "module:Class".
+PLACEMENT_POLICY = 'least-containers'
+
+# Clients can wait on /api/v1/host/<name>/wait/ for their containers to
+# change. A wait returns after at most LONG_POLL_TIMEOUT seconds and changes
+# made by other server processes are noticed within LONG_POLL_INTERVAL.
+LONG_POLL_TIMEOUT = 60
+LONG_POLL_INTERVAL = 1
+
+# Following a container log (?follow) ends once nothing has been appended to
+# it for this many seconds.
+LOG_FOLLOW_TIMEOUT = 300
+
+# Container logs are rotated once they reach LOG_ROTATE_SIZE bytes or go
+# LOG_ROTATE_IDLE seconds without being written to. Rotated segments are
+# compressed with LOG_COMPRESSION: gzip, zstd or auto (zstd if the zstandard
+# module is installed). Every LOG_COMPACT_INTERVAL seconds the server
+# deletes the oldest segments until all logs fit in LOG_RETENTION_BYTES
+# (0 for no limit).
+LOG_ROTATE_SIZE = 16 * 1024 * 1024
+LOG_ROTATE_IDLE = 3600
+LOG_COMPRESSION = 'auto'
+LOG_RETENTION_BYTES = 10 * 1024 * 1024 * 1024
+LOG_COMPACT_INTERVAL = 300
+
+# Where model props are stored:
+#  filesystem - a props.json file in each model's directory under MODELS_DIR
+#  sqlite - rows in the STORAGE_DB database (default: MODELS_DIR/models.db)
+# Logs and heartbeats live under MODELS_DIR either way. Use
+# "manage.py copy-storage" to move existing models between them.
+STORAGE_BACKEND = 'filesystem'
+STORAGE_DB = None
+
+# "manage.py serve" runs the server under gunicorn with SERVE_WORKERS
+# processes of SERVE_THREADS threads each. Long polls and followed logs hold
+# a thread for as long as they last, so allow for them in SERVE_THREADS.
+# Idle client connections are kept open for SERVE_KEEPALIVE seconds.
+SERVE_WORKERS = 4
+SERVE_THREADS = 16
+SERVE_KEEPALIVE = 75
+
+# Request latency and other counters are served at /metrics in the
+# Prometheus text format. Each server process keeps its own, with more than
+# one process they're shared through METRICS_DIR every METRICS_INTERVAL
+# seconds ("manage.py serve" uses MODELS_DIR/.metrics if it isn't set).
+METRICS_DIR = None
+METRICS_INTERVAL = 5
+
+# "manage.py profile on" makes the server dump a cProfile of every request
+# into PROFILE_DIR until "manage.py profile off".
+PROFILE_DIR = os.path.join(_here, '../profiles')
+
 
 LOCAL_SETTINGS = os.path.join(_here, 'local_settings.conf')
 _settings_files = (
@@ -1,13 +1,16 @@
 import binascii
-import fcntl
+import collections
 import fnmatch
 import hashlib
-import json
+import hmac
 import os
 import functools
 import logging
+import threading
+import time
 
-from shutil import rmtree
+from cya_server import metrics
+from cya_server.storage import FilesystemBackend
 
 log = logging.getLogger()
 
@@ -53,10 +56,117 @@ class SecretField(Field):
 
     @staticmethod
     def verify(value, encrypted):
-        salt, hashed = encrypted.split(':')
-        salt = binascii.unhexlify(salt)
-        new = hashlib.pbkdf2_hmac('sha256', value.encode(), salt, 100000)
-        return binascii.unhexlify(hashed) == new
+        with metrics.secret_verify.time():
+            salt, hashed = encrypted.split(':')
+            salt = binascii.unhexlify(salt)
+            new = hashlib.pbkdf2_hmac('sha256', value.encode(), salt, 100000)
+            return binascii.unhexlify(hashed) == new
+
+
+class SecretCache(object):
+    '''A bounded, TTL based cache of successful SecretField.verify calls.
+
+       Entries are keyed on an owner name and hold an HMAC of the presented
+       value and its stored hash, so neither the plain-text secret nor a
+       stale hash can ever produce a hit.
+    '''
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = os.urandom(32)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, value, encrypted):
+        msg = (value + '\0' + encrypted).encode()
+        return hmac.new(self._key, msg, hashlib.sha256).digest()
+
+    def verify(self, owner, value, encrypted):
+        digest = self._digest(value, encrypted)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(owner)
+            if entry and entry[1] > now and \
+                    hmac.compare_digest(entry[0], digest):
+                self._entries.move_to_end(owner)
+                metrics.secret_cache.inc(result='hit')
+                return True
+
+        metrics.secret_cache.inc(result='miss')
+        if not SecretField.verify(value, encrypted):
+            return False
+
+        if self.ttl > 0 and self.max_size > 0:
+            with self._lock:
+                self._entries[owner] = (digest, now + self.ttl)
+                self._entries.move_to_end(owner)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return True
+
+    def invalidate(self, owner=None):
+        with self._lock:
+            if owner is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(owner, None)
+
+
+_storage = FilesystemBackend()
+
+
+def get_storage():
+    return _storage
+
+
+def set_storage(backend):
+    '''Select the StorageBackend every model uses.'''
+    global _storage
+    _storage = backend
+
+
+_listeners = []
+
+
+def add_listener(func):
+    '''Call func(path, fields) after the model at path is created, updated
+       or deleted. `fields` names the props an update changed, it is None
+       for a create or delete.'''
+    _listeners.append(func)
+
+
+def notify(path, fields=None):
+    for func in _listeners:
+        func(path, fields)
+
+
+def copy_models(src, dst, managers):
+    '''Copy the models of `managers`, and all their children, from one
+       StorageBackend to another. Returns the number of models copied.'''
+    copied = 0
+
+    def copy(collection, clazz):
+        nonlocal copied
+        try:
+            names = list(src.list(collection))
+        except FileNotFoundError:
+            return
+        fields = [x.name for x in clazz.FIELDS]
+        for name in names:
+            path = os.path.join(collection, name)
+            props = src.load(path)
+            dst.create(path, {k: props[k] for k in fields if k in props})
+            copied += 1
+            for child in clazz.CHILDREN:
+                copy(os.path.join(path, child.__name__.lower() + 's'), child)
+        for field in clazz.INDEXES:
+            dst.index_rebuild(collection, field, (
+                (n, dst.load(os.path.join(collection, n)).get(field))
+                for n in dst.list(collection)))
+
+    for manager in managers:
+        copy(manager._model_dir, manager._model_class)
+    return copied
 
 
 class ModelManager(object):
@@ -67,7 +177,7 @@ class ModelManager(object):
 
     def list(self, pattern=None):
         try:
-            for item in os.listdir(self._model_dir):
+            for item in _storage.list(self._model_dir):
                 if not pattern or fnmatch.fnmatch(item, pattern):
                     yield item
         except FileNotFoundError as e:
@@ -78,44 +188,107 @@ class ModelManager(object):
                 raise
 
     def count(self):
-        return len(list(self.list()))
+        try:
+            return _storage.count(self._model_dir)
+        except FileNotFoundError:
+            return 0
 
     def get(self, name):
         return self._model_class(name, os.path.join(self._model_dir, name))
 
-    def _create_children(self, name, props):
-        parent_model = None
-        for child in self._model_class.CHILDREN:
-            cname = child.__name__.lower() + 's'
-            if cname in props:
-                kids_props = props[cname]
-                del props[cname]
-                for child_props in kids_props:
-                    n = child_props['name']
-                    del child_props['name']
-                    if not parent_model:
-                        parent_model = self.get(name)
-                    getattr(parent_model, cname).create(n, child_props)
+    def snapshot(self):
+        '''Return the fields of every model in the collection as a list of
+           dicts sorted by name. This is a single pass over the collection
+           with props served from props_cache, so its much cheaper than
+           get()ing each model. Children aren't included.'''
+        items = []
+        fields = self._model_class.FIELDS
+        for name, props in _storage.snapshot(
+                self._model_dir, self._model_class.valid_props_or_none):
+            if props is None:
+                continue
+            data = {f.name: props.get(f.name) for f in fields}
+            data['name'] = name
+            items.append(data)
+        return sorted(items, key=lambda x: x['name'])
+
+    def compact(self):
+        fixed = 0
+        for name in self.list():
+            fixed += self.get(name).compact()
+        return fixed
+
+    def _index_items(self, field):
+        for name in self.list():
+            try:
+                yield name, getattr(self.get(name), field)
+            except (ModelError, FileNotFoundError):
+                continue  # being created or deleted right now
+
+    def find(self, field, value):
+        '''Return the model whose indexed `field` equals `value` or None.'''
+        if not _storage.index_exists(self._model_dir, field):
+            _storage.index_rebuild(
+                self._model_dir, field, self._index_items(field))
+        for attempt in (0, 1):
+            name = _storage.index_get(self._model_dir, field, value)
+            if name is None:
+                return None
+            try:
+                model = self.get(name)
+                if getattr(model, field) == value:
+                    return model
+            except ModelError:
+                pass
+            if not attempt:
+                log.warning('Stale %s index entry for %s, rebuilding',
+                            field, name)
+                _storage.index_rebuild(
+                    self._model_dir, field, self._index_items(field))
+        return None
+
+    def rebuild_indexes(self):
+        for field in self._model_class.INDEXES:
+            _storage.index_rebuild(
+                self._model_dir, field, self._index_items(field))
+
+    def _create_children(self, name, kids):
+        parent_model = self.get(name)
+        for cname, kids_props in kids.items():
+            for child_props in kids_props:
+                n = child_props['name']
+                del child_props['name']
+                getattr(parent_model, cname).create(n, child_props)
 
     def create(self, name, props):
         self._model_class.validate_props(props, save=True)
+        kids = {}
+        for child in self._model_class.CHILDREN:
+            cname = child.__name__.lower() + 's'
+            if cname in props:
+                kids[cname] = props.pop(cname)
+        path = os.path.join(self._model_dir, name)
         try:
-            path = os.path.join(self._model_dir, name)
-            os.makedirs(path)
-            with open(os.path.join(path, 'props.json'), 'w') as f:
-                json.dump(props, f)
+            _storage.create(path, props)
+        except FileExistsError:
+            raise ModelError('Item(%s) already exists' % name, 409)
+        if kids:
             try:
-                self._create_children(name, props)
+                self._create_children(name, kids)
             except:
-                rmtree(path)
+                _storage.delete(path)
                 raise
-        except FileExistsError:
-            raise ModelError('Item(%s) already exists' % name, 409)
+        for field in self._model_class.INDEXES:
+            if props.get(field) is not None:
+                _storage.index_set(self._model_dir, field, props[field], name)
+        notify(path)
 
 
 class Model(object):
     FIELDS = []
     CHILDREN = []
+    # fields indexed by the storage backend that ModelManager.find can use
+    INDEXES = []
 
     @classmethod
     def validate_props(clazz, props, ignore_required=False, save=False):
@@ -146,12 +319,21 @@ class Model(object):
                         clazz.__name__, ', '.join(required)))
         return props
 
+    @classmethod
+    def valid_props_or_none(clazz, props):
+        '''validate_props for parsing stored props, None if they are bad.
+           Being a classmethod it is cached by PropsCache as the same parse
+           on every call.'''
+        try:
+            return clazz.validate_props(props)
+        except ModelError:
+            return None
+
     @staticmethod
     def getfield(field, self):
-        if isinstance(self._props, str):
+        if self._props is None:
             # we haven't loaded in the properties yet
-            with open(self._props) as f:
-                self._props = self.validate_props(json.load(f))
+            self._props = _storage.load(self._modeldir, self.validate_props)
         return self._props[field.name]
 
     @classmethod
@@ -172,15 +354,17 @@ class Model(object):
             attr = clazz.__name__.lower() + 's'
             setattr(self, attr, ModelManager(modeldir, clazz))
 
-        if not os.path.exists(modeldir):
+        if not _storage.exists(modeldir):
             raise ModelError('%s does not exist' % name, 404)
 
         self.name = name
-        self._props = os.path.join(modeldir, 'props.json')
-        if not os.path.exists(self._props):
-            raise ModelError('props.json not found for ' + name)
+        self._props = None
 
     def to_dict(self):
+        with metrics.to_dict.time(model=self.__class__.__name__):
+            return self._to_dict()
+
+    def _to_dict(self):
         data = {}
         for f in self.FIELDS:
             data[f.name] = self.getfield(f, self)
@@ -192,17 +376,58 @@ class Model(object):
                 data.setdefault(cname, []).append(cdata)
         return data
 
+    def _indexed_values(self, props=None):
+        return {f: getattr(self, f) for f in self.INDEXES
+                if props is None or f in props}
+
+    def _own_props(self, props):
+        return {f.name: props.get(f.name) for f in self.FIELDS}
+
     def update(self, props):
-        p = os.path.join(self._modeldir, 'props.json')
-        temp = p + '.tmp'
         props = self.validate_props(props, ignore_required=True, save=True)
-        with open(temp, 'w') as f:
-            fcntl.flock(f, fcntl.LOCK_EX)
-            oldprops = self.to_dict()
-            oldprops.update(props)
-            json.dump(oldprops, f)
-            f.flush()
-            os.rename(temp, p)
+        indexed = self._indexed_values(props)
+        changed = set()
+
+        def apply(current):
+            # only our own fields are read and written, children are stored
+            # as models of their own
+            newprops = self._own_props(self.validate_props(current))
+            changed.clear()
+            changed.update(
+                k for k, v in props.items() if newprops.get(k) != v)
+            newprops.update(props)
+            return newprops
+        self._props = _storage.update(self._modeldir, apply)
+
+        collection = os.path.dirname(self._modeldir)
+        for field, old in indexed.items():
+            if old != props[field]:
+                if old is not None:
+                    _storage.index_remove(collection, field, old, self.name)
+                if props[field] is not None:
+                    _storage.index_set(
+                        collection, field, props[field], self.name)
+        notify(self._modeldir, changed)
+
+    def compact(self):
+        '''Strip anything that isn't one of our fields out of the stored
+           props for this model and its children. Older versions of update()
+           would embed the whole child tree. Returns the number fixed.'''
+        fields = set(x.name for x in self.FIELDS)
+        fixed = 0
+        if set(_storage.load(self._modeldir).keys()) - fields:
+            _storage.update(self._modeldir, lambda props: {
+                k: v for k, v in props.items() if k in fields})
+            fixed += 1
+        for clazz in self.CHILDREN:
+            fixed += getattr(self, clazz.__name__.lower() + 's').compact()
+        return fixed
 
     def delete(self):
-        rmtree(self._modeldir)
+        indexed = self._indexed_values()
+        _storage.delete(self._modeldir)
+        collection = os.path.dirname(self._modeldir)
+        for field, value in indexed.items():
+            if value is not None:
+                _storage.index_remove(collection, field, value, self.name)
+        notify(self._modeldir)
@@ -0,0 +1,626 @@
+import abc
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import logging
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+from shutil import rmtree
+
+from cya_server import concurrently, metrics
+
+log = logging.getLogger()
+
+
+class PropsCache(object):
+    '''A process wide LRU cache of parsed props.json files.
+
+       Entries are validated against the file's (st_mtime_ns, st_ino, st_size)
+       so a change on disk, including one made by another process, is always
+       picked up. Writers replace props.json via rename which gives the file a
+       new inode. A file is cached once for each `parse` it is loaded with, so
+       a caller never gets data parsed for another.
+    '''
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(st):
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def load(self, path, parse=None):
+        '''Return a copy of the parsed file. `parse` is applied to freshly
+           loaded data before it gets cached.'''
+        sig = self._signature(os.stat(path))
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == sig and parse in entry[1]:
+                self._entries.move_to_end(path)
+                metrics.props_reads.inc(backend='filesystem', source='cache')
+                return self._copy(entry[1][parse])
+        metrics.props_reads.inc(backend='filesystem', source='disk')
+
+        with open(path) as f:
+            # the file may have been replaced since the stat above, so cache
+            # the data under the signature of what we actually read
+            sig = self._signature(os.fstat(f.fileno()))
+            data = json.load(f)
+        if parse:
+            data = parse(data)
+        if self.max_size > 0:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is None or entry[0] != sig:
+                    entry = self._entries[path] = (sig, {})
+                entry[1][parse] = data
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return self._copy(data)
+
+    @staticmethod
+    def _copy(data):
+        # parse may reject a file by returning None
+        return None if data is None else dict(data)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+
+props_cache = PropsCache()
+
+# read-modify-writes of a model's props.json
+model_locks = concurrently.LockManager(
+    os.path.join('%s', '.props.lock'), 'model')
+# readers of a FieldIndex only need to exclude a rebuild swapping it out
+index_locks = concurrently.LockManager('%s.lock', 'index')
+
+
+class FieldIndex(object):
+    '''A persistent value -> model name index for one field of a collection.
+
+       The index lives beside the collection directory and holds one small
+       file per value, named after a hash of the value. This keeps lookups
+       and updates O(1) regardless of how many models exist. Updates are
+       skipped until the index has been built, which happens on first use.
+    '''
+    def __init__(self, collection_dir, field):
+        self.field = field
+        self.path = '%s.%s.idx' % (collection_dir, field)
+
+    def _entry(self, value):
+        return os.path.join(
+            self.path, hashlib.sha1(str(value).encode()).hexdigest())
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def _get(self, value):
+        try:
+            with open(self._entry(value)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, value):
+        with index_locks.shared(self.path):
+            return self._get(value)
+
+    def set(self, value, name):
+        with index_locks.exclusive(self.path):
+            if self.exists():
+                concurrently.atomic_write(self._entry(value), name)
+
+    def remove(self, value, name):
+        with index_locks.exclusive(self.path):
+            if self._get(value) == name:
+                os.unlink(self._entry(value))
+
+    def rebuild(self, items):
+        '''Replace the index with `items`, an iterable of (name, value)
+           which is consumed while the index is locked.'''
+        with index_locks.exclusive(self.path):
+            tmp = self.path + '.new'
+            if os.path.exists(tmp):
+                rmtree(tmp)
+            os.makedirs(tmp)
+            # nothing reads .new, so the entries don't need atomic_write's
+            # temp file and rename. They are fsync'ed so a crash can't leave
+            # an empty one in the index once it's swapped in.
+            for name, value in items:
+                if value is not None:
+                    entry = os.path.join(tmp, os.path.basename(
+                        self._entry(value)))
+                    with open(entry, 'w') as f:
+                        f.write(name)
+                        f.flush()
+                        os.fsync(f.fileno())
+            fd = os.open(tmp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if self.exists():
+                os.rename(self.path, self.path + '.old')
+                os.rename(tmp, self.path)
+                rmtree(self.path + '.old')
+            else:
+                os.rename(tmp, self.path)
+
+
+class Counter(object):
+    '''A persistent count of the models in a collection directory.
+
+       The count is a single binary value kept in a file beside the
+       collection so reading it never touches the collection itself. Changes
+       to the collection are made while holding the counter's lock, see
+       adjust(). The count is created by the first get() and is rebuilt from
+       a listing if it ever disagrees with one, see verify().
+    '''
+    _VALUE = struct.Struct('<q')
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.path = collection + '.count'
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    def _read(self, fd):
+        data = os.pread(fd, self._VALUE.size, 0)
+        if len(data) == self._VALUE.size:
+            return self._VALUE.unpack(data)[0]
+        return None  # not created yet
+
+    def _write(self, fd, value):
+        os.pwrite(fd, self._VALUE.pack(value), 0)
+
+    def peek(self):
+        '''Return the stored count or None if there isn't one.'''
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            return self._read(fd)
+        finally:
+            os.close(fd)
+
+    def get(self):
+        value = self.peek()
+        if value is None or value < 0:
+            return self.recount()
+        return value
+
+    def recount(self):
+        with self._locked() as fd:
+            try:
+                value = len(os.listdir(self.collection))
+            except FileNotFoundError:
+                value = 0
+            self._write(fd, value)
+            return value
+
+    def verify(self, names):
+        '''Recount if a full listing of the collection disagrees.'''
+        value = self.peek()
+        if value is not None and value != len(names):
+            log.warning('Count for %s drifted (%d != %d), recounting',
+                        self.collection, value, len(names))
+            self.recount()
+
+    @contextlib.contextmanager
+    def adjust(self, delta):
+        '''Lock the count while the collection is changed and then apply
+           `delta` to it, unless the change raised an exception.'''
+        with self._locked() as fd:
+            yield
+            value = self._read(fd)
+            if value is not None:
+                self._write(fd, value + delta)
+
+
+class StorageBackend(abc.ABC):
+    '''Where models keep their props.
+
+       A model is identified by its path, <collection>/<name>, where the
+       collection is <parent model path>/<model class name>s. Anything else
+       a model keeps, like logs, is stored in files under its path no matter
+       which backend is in use.
+
+       Missing models raise FileNotFoundError and creating one that exists
+       raises FileExistsError, just like the filesystem would.
+    '''
+    name = None
+
+    @abc.abstractmethod
+    def list(self, collection):
+        pass
+
+    def count(self, collection):
+        return len(list(self.list(collection)))
+
+    @abc.abstractmethod
+    def exists(self, path):
+        pass
+
+    @abc.abstractmethod
+    def load(self, path, parse=None):
+        '''Return the model's props, after `parse` if given.'''
+
+    def snapshot(self, collection, parse=None):
+        '''Yield (name, props) for every model in the collection.'''
+        for name in self.list(collection):
+            try:
+                yield name, self.load(os.path.join(collection, name), parse)
+            except FileNotFoundError:
+                pass  # deleted while we were looking
+
+    @abc.abstractmethod
+    def create(self, path, props):
+        pass
+
+    @abc.abstractmethod
+    def update(self, path, func):
+        '''Atomically replace the model's props with func(props) and
+           return the new props.'''
+
+    @abc.abstractmethod
+    def delete(self, path):
+        '''Delete the model and everything beneath it.'''
+
+    @abc.abstractmethod
+    def move(self, src, dst):
+        '''Atomically move a model and everything beneath it.'''
+
+    def index_exists(self, collection, field):
+        return True
+
+    @abc.abstractmethod
+    def index_get(self, collection, field, value):
+        '''Return the name of the model whose field equals value.'''
+
+    def index_set(self, collection, field, value, name):
+        pass
+
+    def index_remove(self, collection, field, value, name):
+        pass
+
+    def index_rebuild(self, collection, field, items):
+        pass
+
+
+class FilesystemBackend(StorageBackend):
+    '''A directory per model with its fields in a props.json file.'''
+    name = 'filesystem'
+
+    @staticmethod
+    def _props_file(path):
+        return os.path.join(path, 'props.json')
+
+    def list(self, collection):
+        names = os.listdir(collection)
+        Counter(collection).verify(names)
+        return names
+
+    def count(self, collection):
+        return Counter(collection).get()
+
+    def exists(self, path):
+        return os.path.exists(self._props_file(path))
+
+    def load(self, path, parse=None):
+        return props_cache.load(self._props_file(path), parse)
+
+    def snapshot(self, collection, parse=None):
+        try:
+            entries = os.scandir(collection)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                try:
+                    yield entry.name, props_cache.load(
+                        self._props_file(entry.path), parse)
+                except (FileNotFoundError, ValueError):
+                    continue  # being created or deleted
+
+    def create(self, path, props):
+        collection = os.path.dirname(path)
+        os.makedirs(collection, exist_ok=True)
+        with Counter(collection).adjust(1):
+            # the directory may already hold files like logs, so props.json
+            # is what has to be created exclusively
+            os.makedirs(path, exist_ok=True)
+            with open(self._props_file(path), 'x') as f:
+                json.dump(props, f)
+        metrics.props_writes.inc(backend='filesystem', op='create')
+
+    def update(self, path, func):
+        # readers don't take the lock, props.json is only ever replaced by
+        # a rename so they always see a whole file
+        p = self._props_file(path)
+        with model_locks.exclusive(path):
+            props = func(props_cache.load(p))
+            concurrently.atomic_write(p, json.dumps(props))
+        metrics.props_writes.inc(backend='filesystem', op='update')
+        return props
+
+    def delete(self, path):
+        with Counter(os.path.dirname(path)).adjust(-1):
+            rmtree(path)
+
+    def move(self, src, dst):
+        src_dir, dst_dir = os.path.dirname(src), os.path.dirname(dst)
+        os.makedirs(dst_dir, exist_ok=True)
+        if src_dir == dst_dir:
+            # a rename, the count file can only be locked once
+            with Counter(src_dir).adjust(0):
+                if os.path.exists(dst):
+                    raise FileExistsError(17, 'File exists', dst)
+                os.rename(src, dst)
+            return
+        # take the locks in a fixed order so moves can't deadlock
+        first, second = sorted([(src_dir, -1), (dst_dir, 1)])
+        with Counter(first[0]).adjust(first[1]):
+            with Counter(second[0]).adjust(second[1]):
+                if os.path.exists(dst):
+                    raise FileExistsError(17, 'File exists', dst)
+                os.rename(src, dst)
+
+    def index_exists(self, collection, field):
+        return FieldIndex(collection, field).exists()
+
+    def index_get(self, collection, field, value):
+        return FieldIndex(collection, field).get(value)
+
+    def index_set(self, collection, field, value, name):
+        FieldIndex(collection, field).set(value, name)
+
+    def index_remove(self, collection, field, value, name):
+        FieldIndex(collection, field).remove(value, name)
+
+    def index_rebuild(self, collection, field, items):
+        FieldIndex(collection, field).rebuild(items)
+
+
+class SQLiteBackend(StorageBackend):
+    '''Every model is a row in one SQLite database running in WAL mode.
+
+       Rows are keyed by the model's path and indexed on (parent, name) and
+       name, so listing and lookups never walk directories. The number of
+       models per collection is kept in the counts table by triggers.
+       Indexed fields use SQLite expression indexes on the JSON props.
+    '''
+    name = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS models (
+            path TEXT PRIMARY KEY,
+            parent TEXT NOT NULL,
+            name TEXT NOT NULL,
+            props TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS models_parent ON models(parent, name);
+        CREATE INDEX IF NOT EXISTS models_name ON models(name);
+        CREATE TABLE IF NOT EXISTS counts (
+            parent TEXT PRIMARY KEY,
+            n INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS models_insert AFTER INSERT ON models
+        BEGIN
+            INSERT INTO counts (parent, n) VALUES (NEW.parent, 1)
+                ON CONFLICT (parent) DO UPDATE SET n = n + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS models_delete AFTER DELETE ON models
+        BEGIN
+            UPDATE counts SET n = n - 1 WHERE parent = OLD.parent;
+        END;
+        CREATE TRIGGER IF NOT EXISTS models_move AFTER UPDATE OF parent
+            ON models WHEN OLD.parent != NEW.parent
+        BEGIN
+            UPDATE counts SET n = n - 1 WHERE parent = OLD.parent;
+            INSERT INTO counts (parent, n) VALUES (NEW.parent, 1)
+                ON CONFLICT (parent) DO UPDATE SET n = n + 1;
+        END;
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._local = threading.local()
+        self._indexes = set()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # connections can't be shared by threads or forked processes
+            os.makedirs(os.path.dirname(os.path.abspath(self.db)),
+                        exist_ok=True)
+            conn = sqlite3.connect(self.db, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            new = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'counts'"
+            ).fetchone() is None
+            conn.executescript(self.SCHEMA)
+            if new:
+                # databases from before counts existed
+                with self._transaction(conn):
+                    conn.execute('DELETE FROM counts')
+                    conn.execute(
+                        'INSERT INTO counts SELECT parent, COUNT(*) '
+                        'FROM models GROUP BY parent')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @contextlib.contextmanager
+    def _transaction(self, conn=None, lock='sqlite'):
+        conn = conn or self._conn()
+        start = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        metrics.lock_wait.observe(time.time() - start, lock=lock)
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def _subtree(path):
+        # everything beneath path sorts between "path/" and "path0"
+        return 'path = ? OR (path > ? AND path < ?)', (
+            path, path + '/', path + '0')
+
+    def list(self, collection):
+        rows = self._conn().execute(
+            'SELECT name FROM models WHERE parent = ? ORDER BY name',
+            (collection,))
+        return [x[0] for x in rows]
+
+    def count(self, collection):
+        row = self._conn().execute(
+            'SELECT n FROM counts WHERE parent = ?', (collection,)).fetchone()
+        return row[0] if row else 0
+
+    def exists(self, path):
+        return self._conn().execute(
+            'SELECT 1 FROM models WHERE path = ?', (path,)).fetchone() \
+            is not None
+
+    @staticmethod
+    def _parse(props, parse):
+        props = json.loads(props)
+        if parse:
+            props = parse(props)
+        return props
+
+    def load(self, path, parse=None):
+        row = self._conn().execute(
+            'SELECT props FROM models WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(2, 'No such model', path)
+        metrics.props_reads.inc(backend='sqlite', source='db')
+        return self._parse(row[0], parse)
+
+    def snapshot(self, collection, parse=None):
+        rows = self._conn().execute(
+            'SELECT name, props FROM models WHERE parent = ? ORDER BY name',
+            (collection,)).fetchall()
+        metrics.props_reads.inc(len(rows), backend='sqlite', source='db')
+        for name, props in rows:
+            yield name, self._parse(props, parse)
+
+    def create(self, path, props):
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    'INSERT INTO models (path, parent, name, props) '
+                    'VALUES (?, ?, ?, ?)',
+                    (path, os.path.dirname(path), os.path.basename(path),
+                     json.dumps(props)))
+        except sqlite3.IntegrityError:
+            raise FileExistsError(17, 'Model exists', path)
+        metrics.props_writes.inc(backend='sqlite', op='create')
+
+    def update(self, path, func):
+        with self._transaction(lock='model_exclusive') as conn:
+            row = conn.execute(
+                'SELECT props FROM models WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(2, 'No such model', path)
+            props = func(json.loads(row[0]))
+            conn.execute('UPDATE models SET props = ? WHERE path = ?',
+                         (json.dumps(props), path))
+        metrics.props_writes.inc(backend='sqlite', op='update')
+        return props
+
+    def delete(self, path):
+        where, args = self._subtree(path)
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM models WHERE ' + where, args)
+        rmtree(path, ignore_errors=True)  # logs and such
+
+    def move(self, src, dst):
+        where, args = self._subtree(src)
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM models WHERE path = ?',
+                            (dst,)).fetchone():
+                raise FileExistsError(17, 'Model exists', dst)
+            rows = conn.execute(
+                'SELECT path FROM models WHERE ' + where, args).fetchall()
+            if not rows:
+                raise FileNotFoundError(2, 'No such model', src)
+            for (path,) in rows:
+                new = dst + path[len(src):]
+                conn.execute(
+                    'UPDATE models SET path = ?, parent = ?, name = ? '
+                    'WHERE path = ?',
+                    (new, os.path.dirname(new), os.path.basename(new), path))
+        if os.path.isdir(src):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(src, dst)
+
+    def _field_expr(self, field):
+        if not re.match(r'^\w+$', field):
+            raise ValueError('Invalid field name: %s' % field)
+        expr = "json_extract(props, '$.%s')" % field
+        if field not in self._indexes:
+            self._conn().execute(
+                'CREATE INDEX IF NOT EXISTS models_%s '
+                'ON models(parent, %s)' % (field, expr))
+            self._indexes.add(field)
+        return expr
+
+    def index_get(self, collection, field, value):
+        row = self._conn().execute(
+            'SELECT name FROM models WHERE parent = ? AND %s = ?' % (
+                self._field_expr(field)), (collection, value)).fetchone()
+        return row and row[0]
+
+    def index_rebuild(self, collection, field, items):
+        # the index is maintained by SQLite, so items aren't needed
+        self._field_expr(field)
+        self._conn().execute('REINDEX models_%s' % field)
+
+
+BACKENDS = {
+    'filesystem': FilesystemBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def create_backend(name, db=None):
+    if name == 'sqlite':
+        return SQLiteBackend(db)
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    raise ValueError('Unknown storage backend: %s' % name)
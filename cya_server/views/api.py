@@ -1,10 +1,11 @@
 import functools
 
-from flask import g, jsonify, request
+from flask import Response, g, jsonify, request
 
 from cya_server import app, settings
 from cya_server.models import (
-    client_version, container_requests, hosts, users, ModelError, SecretField)
+    Container, batched_changes, client_version, container_requests,
+    fleet_snapshot, hosts, users, ModelError)
 
 
 def _is_host_authenticated(host):
@@ -12,7 +13,7 @@ def _is_host_authenticated(host):
     if key:
         parts = key.split(' ')
         if len(parts) == 2 and parts[0] == 'Token':
-            return SecretField.verify(parts[1], host.api_key)
+            return host.verify_api_key(parts[1])
     return False
 
 
@@ -30,7 +31,7 @@ def host_authenticated(f):
             resp.status_code = 401
             return resp
         host = hosts.get(kwargs['name'])
-        if not SecretField.verify(parts[1], host.api_key):
+        if not host.verify_api_key(parts[1]):
             resp = jsonify({'Message': 'Incorrect API key for host'})
             resp.status_code = 401
             return resp
@@ -77,11 +78,18 @@ def container_create():
     name = request.json.pop('name')
     request.json['requested_by'] = g.user.nickname
     container_requests.create(name, request.json)
+    # hosts waiting on a change find out right away
+    container_requests.handle()
     resp = jsonify({})
     resp.status_code = 202
     return resp
 
 
+@app.route('/api/v1/fleet/', methods=['GET'])
+def fleet_get():
+    return jsonify(fleet_snapshot())
+
+
 @app.route('/api/v1/host/', methods=['GET'])
 def host_list():
     return jsonify({'hosts': [x for x in hosts.list()]})
@@ -118,6 +126,16 @@ def host_delete(name):
     return jsonify({})
 
 
+def _host_data(h, with_containers):
+    data = h.to_dict()
+    data['client_version'] = client_version()
+    if not with_containers and 'containers' in data:
+        del data['containers']
+    if 'api_key' in data:
+        del data['api_key']
+    return data
+
+
 @app.route('/api/v1/host/<string:name>/', methods=['GET'])
 def host_get(name):
     h = hosts.get(name)
@@ -125,13 +143,56 @@ def host_get(name):
         h.ping()
         container_requests.handle(h)
 
-    data = h.to_dict()
-    data['client_version'] = client_version()
     withcontainers = request.args.get('with_containers') is not None
-    if not withcontainers and 'containers' in h.data:
-        del data['containers']
-    if 'api_key' in data:
-        del data['api_key']
+    # one of the revisions changes with any write to the host or its
+    # containers
+    etag = '%d.%d-%s' % (h.revision, h.reported_revision, client_version())
+    if withcontainers:
+        etag += '-c'
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(_host_data(h, withcontainers))
+    resp.set_etag(etag)
+    return resp
+
+
+@app.route('/api/v1/host/<string:name>/wait/', methods=['GET'])
+@host_authenticated
+def host_wait(name):
+    '''Long-poll for changes to the host and its containers.
+
+       Returns the host with its containers and current revision as soon as
+       the revision differs from ?revision=, or just the revision and
+       client_version once ?timeout= seconds pass without a change.
+    '''
+    h = hosts.get(name)
+    timeout = float(settings.LONG_POLL_TIMEOUT)
+    try:
+        timeout = float(request.args.get('timeout', timeout))
+    except ValueError:
+        raise ModelError(
+            'Invalid timeout: %s' % request.args['timeout'], 400)
+    timeout = max(0, min(timeout, float(settings.LONG_POLL_TIMEOUT)))
+    revision = request.args.get('revision')
+    if revision is not None:
+        if not revision.isdigit():
+            raise ModelError('Invalid revision: %s' % revision, 400)
+        revision = int(revision)
+    # checked before the ping so a bad request changes nothing
+    h.ping()
+    container_requests.handle(h)
+
+    if revision is None:
+        current = h.revision
+    else:
+        current = h.wait_for_change(revision, timeout)
+        if current == revision:
+            return jsonify({
+                'revision': current, 'client_version': client_version()})
+    data = _host_data(hosts.get(name), True)
+    data.setdefault('containers', [])
+    data['revision'] = current
     return jsonify(data)
 
 
@@ -151,20 +212,73 @@ def host_container_get(name, c):
            methods=['PATCH'])
 @host_authenticated
 def host_container_update(name, c):
-    c = hosts.get(name).containers.get(c)
-    if c.one_shot and request.json.get('state') == 'DESTROY':
+    _update_container(hosts.get(name).containers.get(c), request.json)
+    return jsonify({})
+
+
+@app.route('/api/v1/host/<string:name>/containers/', methods=['PATCH'])
+@host_authenticated
+def host_containers_update(name):
+    '''Apply the {"containers": [{"name": ..., <fields>}]} updates a client
+       collected during one check-in. Containers that no longer exist are
+       skipped and returned in "missing".'''
+    h = hosts.get(name)
+    updates = request.json.get('containers', [])
+    if not isinstance(updates, list):
+        raise ModelError('"containers" must be a list', 400)
+    # check them all first so a bad one doesn't leave the batch half done
+    for data in updates:
+        if not isinstance(data, dict):
+            raise ModelError('Invalid container update: %r' % (data,), 400)
+        if 'name' not in data:
+            raise ModelError('Missing required field: name', 400)
+        data = data.copy()
+        del data['name']
+        Container.validate_props(data, ignore_required=True)
+
+    missing = []
+    # waiters on the host are woken once for the whole batch
+    with batched_changes():
+        for data in updates:
+            data = data.copy()
+            cname = data.pop('name')
+            try:
+                c = h.containers.get(cname)
+            except ModelError:
+                missing.append(cname)
+                continue
+            _update_container(c, data)
+    return jsonify({'missing': missing})
+
+
+def _update_container(c, data):
+    if c.one_shot and data.get('state') == 'DESTROY':
         c.delete()
     else:
-        c.update(request.json)
-    return jsonify({})
+        c.update(data)
 
 
 @app.route('/api/v1/host/<string:name>/container/<string:c>/logs/<string:l>',
            methods=['POST'])
 @host_authenticated
 def host_container_logs_update(name, c, l):
+    '''Stream the body into the log. With ?offset=N the body holds the log
+       from byte N on, see Container.write_log. Replies with the size of the
+       log, a 409 means the log is shorter than the offset.'''
     c = hosts.get(name).containers.get(c)
-    c.append_log(l, request.data.decode())
-    resp = jsonify({})
+    offset = request.args.get('offset')
+    if offset is not None:
+        if not offset.isdigit():
+            raise ModelError('Invalid offset: %s' % offset, 400)
+        offset = int(offset)
+    try:
+        size = c.write_log(l, request.stream, offset)
+    except ModelError as e:
+        if e.status_code != 409:
+            raise
+        resp = jsonify({'size': c.get_log_size(l)})
+        resp.status_code = 409
+        return resp
+    resp = jsonify({'size': size})
     resp.status_code = 201
     return resp
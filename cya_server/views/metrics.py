@@ -0,0 +1,94 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+from cya_server import app, metrics, settings
+
+log = logging.getLogger()
+
+# cProfile can only profile one request at a time
+_profile_lock = threading.Lock()
+_profiling = {'checked': 0, 'enabled': False}
+_dumped = {'at': 0}
+_dump_lock = threading.Lock()
+
+
+def profile_flag():
+    return os.path.join(settings.PROFILE_DIR, 'enabled')
+
+
+def _profiling_enabled():
+    # "manage.py profile on" creates the flag, its checked once a second so
+    # every server process notices without a restart
+    now = time.time()
+    if now - _profiling['checked'] > 1:
+        _profiling['enabled'] = os.path.exists(profile_flag())
+        _profiling['checked'] = now
+    return _profiling['enabled']
+
+
+def _dump(interval=0):
+    '''Save our metrics for the other server processes if it hasn't been
+       done in the last `interval` seconds. A failure is only logged, it
+       mustn't fail the request.'''
+    if not settings.METRICS_DIR:
+        return
+    with _dump_lock:
+        if time.time() - _dumped['at'] < interval:
+            return
+        _dumped['at'] = time.time()
+        try:
+            metrics.dump(settings.METRICS_DIR)
+        except Exception:
+            log.exception('Unable to save metrics in %s',
+                          settings.METRICS_DIR)
+
+
+@app.before_request
+def _start_request():
+    g.metrics_start = time.time()
+    g.profiler = None
+    if _profiling_enabled() and _profile_lock.acquire(False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def _record_request(response):
+    start = getattr(g, 'metrics_start', None)
+    if start is not None:
+        endpoint = request.endpoint or 'none'
+        metrics.requests.observe(
+            time.time() - start, endpoint=endpoint, method=request.method)
+        metrics.responses.inc(endpoint=endpoint, method=request.method,
+                              status=response.status_code)
+    _dump(float(settings.METRICS_INTERVAL))
+    return response
+
+
+@app.teardown_request
+def _stop_profile(exc):
+    profiler = getattr(g, 'profiler', None)
+    if profiler is None:
+        return
+    g.profiler = None
+    try:
+        profiler.disable()
+        name = '%d-%s-%s-%d.prof' % (
+            time.time() * 1000, request.endpoint or 'none', request.method,
+            os.getpid())
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(settings.PROFILE_DIR, name))
+    finally:
+        _profile_lock.release()
+
+
+@app.route('/metrics')
+def metrics_get():
+    _dump()
+    return Response(metrics.render(settings.METRICS_DIR),
+                    mimetype='text/plain; version=0.0.4')
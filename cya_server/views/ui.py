@@ -7,7 +7,8 @@ from flask.ext.openid import OpenID
 
 from cya_server import app, settings
 from cya_server.models import (
-    client_version, container_requests, hosts, shared_storage, users)
+    client_version, container_requests, date_str, fleet_snapshot, hosts,
+    shared_storage, users)
 
 oid = OpenID(app, settings.OPENID_STORE, safe_roots=[])
 
@@ -74,11 +75,13 @@ def logout():
 
 @app.route('/')
 def index():
-    host_list = [hosts.get(x) for x in hosts.list()]
-    for h in host_list:
-        h.container_list = [h.containers.get(x) for x in h.containers.list()]
-    requests = [container_requests.get(x) for x in container_requests.list()]
-    return render_template('index.html', hosts=host_list, requests=requests)
+    fleet = fleet_snapshot()
+    for h in fleet['hosts']:
+        h['container_list'] = h['containers']
+    for r in fleet['requests']:
+        r['requested_str'] = date_str(r['date_requested'])
+    return render_template(
+        'index.html', hosts=fleet['hosts'], requests=fleet['requests'])
 
 
 @app.route('/settings/', methods=['POST', 'GET'])
@@ -189,12 +192,40 @@ def host_container_log(host, container, logname):
     if g.user is None or 'openid' not in session:
         flash('You must be logged in to view container logs')
         return redirect(url_for('login'))
-    try:
-        log = hosts.get(host).containers.get(container).get_log(logname)
-        return Response(log, 200, mimetype='text/plain')
-    except FileNotFoundError:
+    c = hosts.get(host).containers.get(container)
+    if logname not in c.get_log_names():
         return ('This container has no %s log' % logname, 404)
 
+    # the log is streamed from disk, it can be far too big to load
+    size = c.get_log_size(logname)
+    # offsets stay where they were, but retention may have deleted the
+    # start of the log
+    first = c.log_first_offset(logname)
+    start, end = first, size
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+    tail = request.args.get('tail')
+    if tail is not None:
+        if not tail.isdigit():
+            return ('Invalid tail: %s' % tail, 400)
+        start = max(first, c.log_tail_offset(logname, int(tail)))
+    elif request.range and len(request.range.ranges) == 1:
+        rng = request.range.range_for_length(size)
+        if rng is None or rng[1] <= first:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response('', 416, headers=headers)
+        start, end = max(first, rng[0]), rng[1]
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+
+    if request.args.get('follow') is not None:
+        body = c.follow_log(
+            logname, start, float(settings.LOG_FOLLOW_TIMEOUT))
+    else:
+        body = c.read_log(logname, start, end)
+        headers['Content-Length'] = str(end - start)
+    return Response(body, status, headers=headers, mimetype='text/plain')
+
 
 @app.route('/create_container/', methods=['POST', 'GET'])
 def ui_create_container():
@@ -230,6 +261,7 @@ def ui_create_container():
                         'directory': directory,
                     })
         container_requests.create(request.form['name'], data)
+        container_requests.handle()
         flash('Container requested')
         return redirect(url_for('index'))
 
@@ -22,7 +22,7 @@ setup(
         'Programming Language :: Python :: 3',
     ],
     keywords='lxc containers',
-    packages=find_packages(exclude=['cya_client', 'tests*']),
+    packages=find_packages(exclude=['cya_client', 'tests*', 'benchmarks*']),
     install_requires=['Flask', 'flask-openid'],
 
     entry_points={
@@ -0,0 +1,13 @@
+import os
+
+from cya_server.simplemodels import get_storage, set_storage
+from cya_server.storage import SQLiteBackend
+
+
+def use_sqlite(test, tmpdir):
+    '''Run `test` against an SQLiteBackend stored in tmpdir.'''
+    old = get_storage()
+    backend = SQLiteBackend(os.path.join(tmpdir, 'models.db'))
+    set_storage(backend)
+    test.addCleanup(set_storage, old)
+    test.addCleanup(backend.close)
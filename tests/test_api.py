@@ -2,10 +2,14 @@ import json
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
-from cya_server import app
-from cya_server.models import container_requests, hosts, users
+from unittest import mock
+
+from cya_server import app, logs
+from cya_server.models import Host, container_requests, hosts, users
 
 h1 = {
     'name': 'host_1',
@@ -45,8 +49,8 @@ class ApiTests(unittest.TestCase):
             url, data=data, headers=headers, content_type='application/json')
         self.assertEqual(status_code, resp.status_code)
 
-    def get_json(self, url, status_code=200):
-        resp = self.app.get(url)
+    def get_json(self, url, status_code=200, headers=None):
+        resp = self.app.get(url, headers=headers)
         self.assertEqual(200, resp.status_code)
         return json.loads(resp.data.decode())
 
@@ -114,5 +118,311 @@ class ApiTests(unittest.TestCase):
         c = container_requests.get('container_foo')
         self.assertEqual('nn', c.requested_by)
 
+    def test_fleet(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'ubuntu'}]
+        self.post_json('/api/v1/host/', h)
+        os.mkdir(container_requests._model_dir)
+        container_requests.create('r1', {'requested_by': 'nn'})
+        hosts.get('host_1').ping()
+
+        data = self.get_json('/api/v1/fleet/')
+        self.assertEqual(['host_1'], [x['name'] for x in data['hosts']])
+        host = data['hosts'][0]
+        self.assertTrue(host['online'])
+        self.assertNotIn('api_key', host)
+        self.assertEqual('arm', host['cpu_type'])
+        self.assertEqual(['c1'], [x['name'] for x in host['containers']])
+        self.assertEqual('ubuntu', host['containers'][0]['template'])
+        self.assertEqual('nn', data['requests'][0]['requested_by'])
+
+        resp = self.app.get('/')
+        self.assertEqual(200, resp.status_code)
+        self.assertIn(b'host_1', resp.data)
+        self.assertIn(b'c1', resp.data)
+
+    def test_wait(self):
+        self.post_json('/api/v1/host/', h1)
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+        url = '/api/v1/host/host_1/wait/'
+        data = self.get_json(url, headers=headers)
+        self.assertEqual([], data['containers'])
+        revision = data['revision']
+
+        # nothing changes
+        start = time.time()
+        data = self.get_json(
+            url + '?timeout=0.2&revision=%d' % revision, headers=headers)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual({'revision', 'client_version'}, set(data.keys()))
+        self.assertEqual(revision, data['revision'])
+
+        # a request gets placed on the host while its waiting
+        def place():
+            time.sleep(0.2)
+            container_requests.create('c1', {'template': 'ubuntu'})
+            container_requests.handle()
+        t = threading.Thread(target=place)
+        t.start()
+        self.addCleanup(t.join)
+        start = time.time()
+        data = self.get_json(
+            url + '?timeout=10&revision=%d' % revision, headers=headers)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(['c1'], [x['name'] for x in data['containers']])
+        self.assertGreater(data['revision'], revision)
+
+    def test_etag(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'ubuntu'}]
+        self.post_json('/api/v1/host/', h)
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+        url = '/api/v1/host/host_1/?with_containers'
+        resp = self.app.get(url, headers=headers)
+        self.assertEqual(200, resp.status_code)
+        etag = resp.headers['ETag']
+
+        headers.append(('If-None-Match', etag))
+        with mock.patch.object(Host, 'to_dict') as to_dict:
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(304, resp.status_code)
+            self.assertEqual(b'', resp.data)
+            self.assertFalse(to_dict.called)
+
+        # without containers is a different document
+        resp = self.app.get('/api/v1/host/host_1/', headers=headers)
+        self.assertEqual(200, resp.status_code)
+
+        hosts.get('host_1').containers.get('c1').update({'state': 'FOO'})
+        resp = self.app.get(url, headers=headers)
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(etag, resp.headers['ETag'])
+        data = json.loads(resp.data.decode())
+        self.assertEqual('FOO', data['containers'][0]['state'])
+
+    def test_containers_update(self):
+        h = h1.copy()
+        h['containers'] = [
+            {'name': 'c1', 'template': 'ubuntu'},
+            {'name': 'c2', 'template': 'ubuntu'},
+            {'name': 'c3', 'template': 'ubuntu', 'one_shot': True},
+        ]
+        self.post_json('/api/v1/host/', h)
+        url = '/api/v1/host/host_1/containers/'
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+
+        # a bad entry fails the whole batch before anything is written
+        data = {'containers': [
+            {'name': 'c1', 'state': 'RUNNING'},
+            {'name': 'c2', 'bad_field': 1},
+        ]}
+        resp = self.app.patch(url, data=json.dumps(data), headers=headers,
+                              content_type='application/json')
+        self.assertEqual(500, resp.status_code)
+        self.assertEqual('UNKNOWN', hosts.get('host_1').containers.get(
+            'c1').state)
+        for bad in (['c1'], [{'name': 'c1'}, 42], 'c1', [{'state': 'x'}]):
+            resp = self.app.patch(
+                url, data=json.dumps({'containers': bad}), headers=headers,
+                content_type='application/json')
+            self.assertEqual(400, resp.status_code, bad)
+
+        data = {'containers': [
+            {'name': 'c1', 'state': 'RUNNING', 'ips': '10.0.0.2'},
+            {'name': 'c2', 'state': 'STOPPED', 'keep_running': False},
+            {'name': 'c3', 'state': 'DESTROY'},
+            {'name': 'c4', 'state': 'RUNNING'},
+        ]}
+        revision = hosts.get('host_1').revision
+        resp = self.app.patch(url, data=json.dumps(data), headers=headers,
+                              content_type='application/json')
+        self.assertEqual(200, resp.status_code)
+        # bumped once for the batch
+        self.assertEqual(revision + 1, hosts.get('host_1').revision)
+        self.assertEqual(['c4'], json.loads(resp.data.decode())['missing'])
+        containers = hosts.get('host_1').containers
+        self.assertEqual(['c1', 'c2'], sorted(containers.list()))
+        self.assertEqual('RUNNING', containers.get('c1').state)
+        self.assertEqual('10.0.0.2', containers.get('c1').ips)
+        self.assertEqual('STOPPED', containers.get('c2').state)
+
+        self.patch_json(url, data, 'badkey', 401)
+
+    def test_log_offsets(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'ubuntu'}]
+        self.post_json('/api/v1/host/', h)
+        url = '/api/v1/host/host_1/container/c1/logs/init'
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+
+        def post(data, offset=None, status_code=201):
+            u = url
+            if offset is not None:
+                u += '?offset=%d' % offset
+            resp = self.app.post(u, data=data, headers=headers)
+            self.assertEqual(status_code, resp.status_code)
+            return json.loads(resp.data.decode())['size']
+
+        self.assertEqual(5, post(b'start'))
+        self.assertEqual(11, post(b'start line1', 0))
+        # a retry of something the server already has changes nothing
+        self.assertEqual(11, post(b' line1', 5))
+        self.assertEqual(17, post(b' line1 line2', 5))
+        # a gap is refused and the client told where the log ends
+        self.assertEqual(17, post(b'line4', 23, 409))
+        self.assertEqual(20, post(b'end'))
+        self.assertEqual('start line1 line2end', hosts.get(
+            'host_1').containers.get('c1').get_log('init'))
+
+    def test_log_bad_offset(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'ubuntu'}]
+        self.post_json('/api/v1/host/', h)
+        url = '/api/v1/host/host_1/container/c1/logs/init?offset='
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+        self.app.post(url + '0', data=b'start', headers=headers)
+        for offset in ('abc', '-3'):
+            resp = self.app.post(url + offset, data=b'line', headers=headers)
+            self.assertEqual(400, resp.status_code)
+        self.assertEqual('start', hosts.get(
+            'host_1').containers.get('c1').get_log('init'))
+
+    def test_log_reads(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'ubuntu'}]
+        self.post_json('/api/v1/host/', h)
+        c = hosts.get('host_1').containers.get('c1')
+        c.append_log('init', ''.join('line%d\n' % x for x in range(10)))
+        url = '/host/host_1/c1/log/init'
+
+        resp = self.app.get(url)
+        self.assertEqual(302, resp.status_code)
+        users.create('a@b.com', {'openid': 'oid', 'approved': True,
+                                 'nickname': 'nn', 'api_key': 'blahBlah'})
+        with self.app.session_transaction() as sess:
+            sess['openid'] = 'oid'
+
+        resp = self.app.get(url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+        self.assertEqual(60, len(resp.data))
+
+        resp = self.app.get(url, headers=[('Range', 'bytes=6-17')])
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual(b'line1\nline2\n', resp.data)
+        self.assertEqual('bytes 6-17/60', resp.headers['Content-Range'])
+        resp = self.app.get(url, headers=[('Range', 'bytes=-6')])
+        self.assertEqual(b'line9\n', resp.data)
+        resp = self.app.get(url, headers=[('Range', 'bytes=100-')])
+        self.assertEqual(416, resp.status_code)
+
+        resp = self.app.get(url + '?tail=2')
+        self.assertEqual(b'line8\nline9\n', resp.data)
+        for tail in ('abc', '-2'):
+            resp = self.app.get(url + '?tail=' + tail)
+            self.assertEqual(400, resp.status_code, tail)
+
+        with mock.patch('cya_server.settings.LOG_FOLLOW_TIMEOUT', 0):
+            resp = self.app.get(url + '?tail=1&follow')
+            self.assertEqual(b'line9\n', resp.data)
+
+        resp = self.app.get('/host/host_1/c1/log/other')
+        self.assertEqual(404, resp.status_code)
+
+    def test_log_reads_compacted(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'ubuntu'}]
+        self.post_json('/api/v1/host/', h)
+        c = hosts.get('host_1').containers.get('c1')
+        with mock.patch('cya_server.models.LOG_ROTATE_SIZE', 12):
+            for x in range(9):
+                c.append_log('init', 'line%d\n' % x)
+        # keep the newest segment and the 6 byte active file
+        newest = c._get_log('init').segments()[-1]
+        budget = os.path.getsize(newest[2]) + 6
+        self.assertEqual(3, logs.compact(hosts._model_dir, budget, 0, 'gzip'))
+        first = c.log_first_offset('init')
+        self.assertEqual(newest[0], first)
+        users.create('a@b.com', {'openid': 'oid', 'approved': True,
+                                 'nickname': 'nn', 'api_key': 'blahBlah'})
+        with self.app.session_transaction() as sess:
+            sess['openid'] = 'oid'
+        url = '/host/host_1/c1/log/init'
+
+        resp = self.app.get(url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(str(len(resp.data)), resp.headers['Content-Length'])
+        self.assertEqual(b'line6\nline7\nline8\n', resp.data)
+
+        resp = self.app.get(url + '?tail=100')
+        self.assertEqual(str(len(resp.data)), resp.headers['Content-Length'])
+
+        resp = self.app.get(url, headers=[('Range', 'bytes=0-%d' % first)])
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual(1, len(resp.data))
+        self.assertEqual('1', resp.headers['Content-Length'])
+        self.assertEqual('bytes %d-%d/54' % (first, first),
+                         resp.headers['Content-Range'])
+        resp = self.app.get(url, headers=[
+            ('Range', 'bytes=0-%d' % (first - 1))])
+        self.assertEqual(416, resp.status_code)
+
+    def test_wait_bad_args(self):
+        self.post_json('/api/v1/host/', h1)
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+        url = '/api/v1/host/host_1/wait/'
+        for args in ('timeout=abc', 'revision=abc', 'revision=-1'):
+            resp = self.app.get(url + '?' + args, headers=headers)
+            self.assertEqual(400, resp.status_code, args)
+        # a negative timeout just doesn't wait
+        data = self.get_json(url, headers=headers)
+        data = self.get_json(url + '?timeout=-5&revision=%d' % (
+            data['revision']), headers=headers)
+        self.assertEqual({'revision', 'client_version'}, set(data.keys()))
+
+    def test_wait_auth(self):
+        self.post_json('/api/v1/host/', h1)
+        resp = self.app.get('/api/v1/host/host_1/wait/')
+        self.assertEqual(401, resp.status_code)
+
+    def test_metrics(self):
+        self.post_json('/api/v1/host/', h1)
+        headers = [('Authorization', 'Token ' + h1['api_key'])]
+        self.app.get('/api/v1/host/host_1/', headers=headers)
+        self.patch_json('/api/v1/host/host_1/', {'cpu_total': 1},
+                        h1['api_key'])
+        resp = self.app.get('/metrics')
+        self.assertEqual(200, resp.status_code)
+        lines = resp.data.decode().splitlines()
+        self.assertIn('# TYPE cya_request_seconds histogram', lines)
+        for metric in ('cya_request_seconds_count{endpoint="host_get",'
+                       'method="GET"}',
+                       'cya_responses_total{endpoint="host_create",'
+                       'method="POST",status="201"}',
+                       'cya_props_writes_total{backend="filesystem",'
+                       'op="create"}',
+                       'cya_lock_wait_seconds_count{lock="model_exclusive"}',
+                       'cya_scheduler_pass_seconds_count',
+                       'cya_secret_verify_seconds_count',
+                       'cya_to_dict_seconds_count{model="Host"}'):
+            self.assertTrue([x for x in lines if x.startswith(metric + ' ')],
+                            metric)
+
+    def test_profile(self):
+        profiles = os.path.join(self.modelsdir, 'profiles')
+        profiling = {'checked': 0, 'enabled': False}
+        with mock.patch('cya_server.settings.PROFILE_DIR', profiles), \
+                mock.patch('cya_server.views.metrics._profiling', profiling):
+            self.app.get('/api/v1/host/')
+            self.assertFalse(os.path.exists(profiles))
+            os.mkdir(profiles)
+            open(os.path.join(profiles, 'enabled'), 'w').close()
+            profiling['checked'] = 0  # as if a second went by
+            self.app.get('/api/v1/host/')
+            dumps = [x for x in os.listdir(profiles) if x != 'enabled']
+            self.assertEqual(1, len(dumps))
+            self.assertIn('host_list-GET', dumps[0])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,437 @@
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
+
+import cya_client_lxd
+
+
+# Stands in for the lxc command. Containers are json files in $FAKE_LXC_DIR
+# and every operation on one takes $FAKE_LXC_DELAY seconds. Names starting
+# with "bad" fail.
+FAKE_LXC = '''#!%s
+import json, os, sys, time
+state = os.environ['FAKE_LXC_DIR']
+cmd, args = sys.argv[1], sys.argv[2:]
+if cmd == 'list':
+    containers = []
+    for name in sorted(os.listdir(state)):
+        with open(os.path.join(state, name)) as f:
+            containers.append(json.load(f))
+    print(json.dumps(containers))
+    sys.exit(0)
+if cmd == 'config':
+    sys.exit(0)
+name = args[1] if cmd == 'init' else args[-1]
+time.sleep(float(os.environ['FAKE_LXC_DELAY']))
+if name.startswith('bad'):
+    sys.exit('failed: ' + name)
+path = os.path.join(state, name)
+if cmd == 'delete':
+    os.unlink(path)
+    sys.exit(0)
+status = 'Running' if cmd == 'start' else 'Stopped'
+with open(path, 'w') as f:
+    json.dump({'name': name, 'status': status, 'config': {},
+               'created_at': '2016-04-12T17:32:55Z', 'state': None}, f)
+''' % sys.executable
+
+
+class FakeLXD(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Just enough of the LXD REST API to drive LXDApi with.'''
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, FakeLXDHandler)
+        self.containers = {}
+        self.requests = []
+        self.connections = 0
+
+    def add_container(self, name, status='Running', ips=(), **config):
+        network = {
+            'lo': {'addresses': [{'address': '127.0.0.1'}]},
+            'eth0': {'addresses': [{'address': x} for x in ips]},
+        }
+        self.containers[name] = {
+            'name': name,
+            'status': status,
+            'created_at': '2016-04-12T17:32:55Z',
+            'config': config,
+            'state': {'status': status, 'network': network},
+        }
+
+
+class FakeLXDHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, data):
+        data = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _sync(self, metadata):
+        self._reply({'type': 'sync', 'metadata': metadata})
+
+    def _async(self, err=''):
+        self.server.ops = getattr(self.server, 'ops', 0) + 1
+        self.server.last_err = err
+        self._reply({
+            'type': 'async',
+            'operation': '/1.0/operations/%d' % self.server.ops})
+
+    def _error(self, msg):
+        self._reply({'type': 'error', 'error': msg, 'error_code': 404})
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode()) if length else None
+        self.server.requests.append((self.command, self.path, body))
+        containers = self.server.containers
+        parts = self.path.split('?')[0].strip('/').split('/')
+
+        if self.path == '/1.0/containers?recursion=2':
+            return self._sync(list(containers.values()))
+        if parts[:2] == ['1.0', 'operations']:
+            return self._sync({
+                'status_code': 400 if self.server.last_err else 200,
+                'err': self.server.last_err})
+        if parts[:2] == ['1.0', 'images']:
+            return self._sync({'properties': {'os': 'ubuntu',
+                                              'release': 'xenial'}})
+        if parts == ['1.0', 'containers'] and self.command == 'POST':
+            self.server.add_container(
+                body['name'], 'Stopped', **body['config'])
+            return self._async()
+        c = containers.get(parts[2])
+        if c is None:
+            return self._error('not found')
+        if len(parts) == 4 and self.command == 'PUT':
+            if body['action'] == 'start' and c['status'] == 'Running':
+                return self._async('The container is already running')
+            c['status'] = 'Running' if body['action'] == 'start' else 'Stopped'
+            return self._async()
+        if self.command == 'DELETE':
+            del containers[c['name']]
+            return self._async()
+        if self.command == 'PATCH':
+            c.setdefault('devices', {}).update(body['devices'])
+            return self._sync({})
+        return self._sync(c)
+
+    do_GET = do_PUT = do_POST = do_PATCH = do_DELETE = _handle
+
+
+class LXDApiTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.server = FakeLXD(os.path.join(tmpdir, 'unix.socket'))
+        self.addCleanup(self.server.server_close)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.addCleanup(self.server.shutdown)
+
+        self.lxd = cya_client_lxd.LXDApi(self.server.server_address)
+        self.addCleanup(self.lxd.close)
+
+    def test_containers(self):
+        self.server.add_container('c1', ips=['10.0.0.2'])
+        self.server.add_container('c2', status='Stopped')
+        cya_client_lxd._lxd = self.lxd
+        self.addCleanup(setattr, cya_client_lxd, '_lxd', None)
+
+        containers = cya_client_lxd.lxd_containers()
+        self.assertEqual(['c1', 'c2'], sorted(containers.keys()))
+        self.assertEqual('10.0.0.2', containers['c1']['ips'])
+        self.assertEqual('', containers['c2']['ips'])
+        self.assertEqual('Stopped', containers['c2']['status'])
+
+    def test_start_stop(self):
+        self.server.add_container('c1', status='Stopped')
+        self.lxd.start('c1')
+        self.assertEqual('Running', self.server.containers['c1']['status'])
+        self.lxd.stop('c1')
+        self.assertEqual('Stopped', self.server.containers['c1']['status'])
+
+    def test_failed_operation(self):
+        self.server.add_container('c1')
+        with self.assertRaisesRegex(cya_client_lxd.LXDError, 'already'):
+            self.lxd.start('c1')
+        with self.assertRaisesRegex(cya_client_lxd.LXDError, 'not found'):
+            self.lxd.stop('c2')
+
+    def test_create_delete(self):
+        self.lxd.create('c1', 'images:ubuntu/xenial/amd64',
+                        {'limits.memory': '512MB'})
+        self.lxd.add_disk('c1', 'data', '/srv/data', '/data')
+        c = self.server.containers['c1']
+        self.assertEqual('512MB', c['config']['limits.memory'])
+        self.assertEqual('/data', c['devices']['data']['path'])
+        method, path, body = self.server.requests[0]
+        self.assertEqual('ubuntu/xenial/amd64', body['source']['alias'])
+        self.assertEqual('https://images.linuxcontainers.org',
+                         body['source']['server'])
+
+        self.lxd.start('c1')
+        self.lxd.delete('c1')
+        self.assertEqual({}, self.server.containers)
+        stop = [x for x in self.server.requests if x[0] == 'PUT'][-1]
+        self.assertEqual({'action': 'stop', 'timeout': 30, 'force': True},
+                         stop[2])
+
+    def test_memory_and_image(self):
+        self.server.add_container(
+            'c1', **{'limits.memory': '2GB', 'volatile.base_image': 'abc'})
+        c = self.lxd.containers()[0]
+        self.assertEqual(2000000000, self.lxd.max_memory(c))
+        self.assertEqual(
+            'xenial', self.lxd.image_properties('abc')['release'])
+
+    def test_one_connection(self):
+        self.server.add_container('c1', status='Stopped')
+        for x in range(5):
+            self.lxd.containers()
+            self.lxd.start('c1')
+            self.lxd.stop('c1')
+        self.assertEqual(1, self.server.connections)
+
+
+class LookupCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'lookups.cache')
+        p = mock.patch.object(
+            cya_client_lxd, 'lookups', cya_client_lxd.LookupCache(self.path))
+        p.start()
+        self.addCleanup(p.stop)
+        self.lxd = mock.Mock()
+        self.lxd.image_properties.return_value = {
+            'os': 'ubuntu', 'release': 'xenial'}
+        self.lxd.max_memory.return_value = 512000000
+        p = mock.patch.object(cya_client_lxd, '_lxd', self.lxd)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_image_info(self):
+        c = {'name': 'c1', 'config': {'volatile.base_image': 'abc'}}
+        for x in range(3):
+            self.assertEqual(('ubuntu', 'xenial'),
+                             cya_client_lxd.lxd_image_info(c))
+        self.assertEqual(1, self.lxd.image_properties.call_count)
+
+        # a new process starts from what's on disk
+        cya_client_lxd.lookups = cya_client_lxd.LookupCache(self.path)
+        self.assertEqual(('ubuntu', 'xenial'),
+                         cya_client_lxd.lxd_image_info(c))
+        self.assertEqual(1, self.lxd.image_properties.call_count)
+
+    def test_max_memory(self):
+        c = {'name': 'c1', 'config': {'limits.memory': '512MB',
+                                      'volatile.last_state.power': 'RUNNING'}}
+        get = cya_client_lxd.lxd_container_get_max_memory
+        self.assertEqual(512000000, get(c))
+        c['config']['volatile.last_state.power'] = 'STOPPED'
+        self.assertEqual(512000000, get(c))
+        self.assertEqual(1, self.lxd.max_memory.call_count)
+
+        c['config']['limits.memory'] = '1GB'
+        self.lxd.max_memory.return_value = 1000000000
+        self.assertEqual(1000000000, get(c))
+        self.assertEqual(2, self.lxd.max_memory.call_count)
+
+    def test_lru(self):
+        cache = cya_client_lxd.LookupCache(self.path, max_size=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 0)
+        cache.get('c', lambda: 3)
+        cache = cya_client_lxd.LookupCache(self.path, max_size=2)
+        self.assertEqual(1, cache.get('a', lambda: 0))
+        self.assertEqual(0, cache.get('b', lambda: 0))
+
+
+class LogUploadTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        p = mock.patch.object(
+            cya_client_lxd, 'script', os.path.join(tmpdir, 'cya_client.py'))
+        p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch.object(cya_client_lxd, '_post_logs', self._post_logs)
+        p.start()
+        self.addCleanup(p.stop)
+        self.log = b'earlier run\n'
+        self.fail = False
+
+    def _post_logs(self, container, logname, data, offset=None):
+        # acts like Container.write_log
+        if self.fail:
+            return None
+        if callable(data):
+            data = b''.join(data())
+        if offset is None:
+            offset = len(self.log)
+        if offset > len(self.log):
+            return len(self.log)
+        self.log += data[len(self.log) - offset:]
+        return len(self.log)
+
+    def test_upload(self):
+        upload = cya_client_lxd._LogUpload('c1', 'init')
+        upload.write(b'start\n')
+        self.assertTrue(upload.flush())
+        upload.write(b'line1\n')
+        self.fail = True
+        self.assertFalse(upload.flush())
+        self.assertEqual(6, upload.pending)
+        upload.write(b'line2\n')
+        self.fail = False
+        self.assertTrue(upload.flush())
+        self.assertEqual(0, upload.pending)
+        self.assertEqual(b'earlier run\nstart\nline1\nline2\n', self.log)
+
+        # the server lost the tail, it gets sent again
+        self.log = self.log[:-6]
+        upload.write(b'end\n')
+        self.assertFalse(upload.flush())
+        self.assertEqual(10, upload.pending)
+        self.assertTrue(upload.flush())
+        self.assertEqual(
+            b'earlier run\nstart\nline1\nline2\nend\n', self.log)
+        upload.close()
+        self.assertFalse(os.path.exists(upload.path))
+
+    def test_chunks(self):
+        upload = cya_client_lxd._LogUpload('c1', 'init')
+        upload.CHUNK_SIZE = 4
+        upload.write(b'0123456789')
+        upload.spool.flush()
+        self.assertEqual([b'2345', b'6789'], list(upload._chunks(2, 10)))
+        upload.close()
+
+
+class ReconcileTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.state = os.path.join(tmpdir, 'state')
+        os.mkdir(self.state)
+        bindir = os.path.join(tmpdir, 'bin')
+        os.mkdir(bindir)
+        lxc = os.path.join(bindir, 'lxc')
+        with open(lxc, 'w') as f:
+            f.write(FAKE_LXC)
+        os.chmod(lxc, 0o755)
+
+        env = {
+            'PATH': bindir + os.pathsep + os.environ['PATH'],
+            'FAKE_LXC_DIR': self.state,
+            'FAKE_LXC_DELAY': '0.1',
+        }
+        p = mock.patch.dict(os.environ, env)
+        p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch('platform.processor', return_value='x86_64')
+        p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch.object(
+            cya_client_lxd, '_container_props',
+            side_effect=lambda c: {'name': c['name'], 'status': c['status']})
+        p.start()
+        self.addCleanup(p.stop)
+        self.addCleanup(cya_client_lxd._container_updates.clear)
+        p = mock.patch.object(cya_client_lxd, 'container_cached',
+                              os.path.join(tmpdir, 'containers.cache'))
+        p.start()
+        self.addCleanup(p.stop)
+
+        cya_client_lxd.config.read_dict({'cya': {'lxd_backend': 'cli'}})
+        self.addCleanup(cya_client_lxd.config.remove_section, 'cya')
+        self.addCleanup(cya_client_lxd._reset_connections)
+
+    @property
+    def updated(self):
+        return [x['name'] for x in cya_client_lxd._container_updates]
+
+    def _adds(self, names, workers):
+        cya_client_lxd._reset_connections()
+        cya_client_lxd.config.set('cya', 'reconcile_workers', str(workers))
+        props = {x: {'name': x, 'template': 'ubuntu', 'release': 'xenial'}
+                 for x in names}
+        start = time.time()
+        failed = cya_client_lxd._handle_adds(props, names)
+        return failed, time.time() - start
+
+    def test_adds_dels(self):
+        names = ['c%d' % x for x in range(4)]
+        failed, _ = self._adds(set(names), 2)
+        self.assertEqual([], failed)
+        self.assertEqual(names, self.updated)
+        self.assertEqual(names, sorted(os.listdir(self.state)))
+
+        self.assertEqual([], cya_client_lxd._handle_dels(names[1:]))
+        self.assertEqual(['c0'], os.listdir(self.state))
+
+    def test_failures_isolated(self):
+        failed, _ = self._adds({'c1', 'bad1', 'c2', 'bad2'}, 4)
+        self.assertEqual(['bad1', 'bad2'], failed)
+        self.assertEqual(['c1', 'c2'], self.updated)
+        self.assertEqual(['bad1'], cya_client_lxd._handle_dels(
+            ['c1', 'bad1', 'c2']))
+        self.assertEqual([], os.listdir(self.state))
+
+    def test_speedup(self):
+        names = ['c%d' % x for x in range(8)]
+        _, serial = self._adds(names, 1)
+        cya_client_lxd._handle_dels(names)
+        cya_client_lxd._container_updates.clear()
+        _, parallel = self._adds(names, 8)
+        self.assertEqual(names, self.updated)
+        self.assertLess(parallel, serial / 2)
+
+    def test_reconcile_one_patch(self):
+        self._adds(['c1', 'c2', 'c3'], 4)
+        cya_client_lxd._container_updates.clear()
+        cya_client_lxd.config.read_dict(
+            {'cya': {'version': '1', 'hostname': 'host1'}})
+        host = {
+            'client_version': '1',
+            'containers': [
+                {'name': 'c1', 'state': 'RUNNING'},
+                {'name': 'c2', 'state': 'RUNNING', 'keep_running': False},
+                {'name': 'c3', 'state': 'RUNNING', 'keep_running': False},
+                {'name': 'c4', 'template': 'ubuntu', 'release': 'xenial'},
+            ],
+        }
+        with mock.patch.object(cya_client_lxd, '_update_host'), \
+                mock.patch.object(cya_client_lxd, '_patch') as patch:
+            patch.return_value.read.return_value = b'{"missing": []}'
+            cya_client_lxd._reconcile(host, None)
+        self.assertEqual(1, patch.call_count)
+        url, data = patch.call_args[0]
+        self.assertEqual('/api/v1/host/host1/containers/', url)
+        self.assertEqual([
+            {'name': 'c4', 'status': 'Running'},
+            {'name': 'c2', 'status': 'Stopped'},
+            {'name': 'c3', 'status': 'Stopped'},
+        ], data['containers'])
+        self.assertEqual([], self.updated)
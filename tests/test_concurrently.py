@@ -1,4 +1,6 @@
 import os
+import shutil
+import stat
 import tempfile
 import threading
 import time
@@ -119,3 +121,88 @@ class TestConcurrently(unittest.TestCase):
             self.assertEqual(d['key'], 'val')
             d['key'] = 'updated'
         self.assertEqual('updated', concurrently.json_get(self.tmpfile)['key'])
+
+
+def _increment(locks, path, times):
+    counter = os.path.join(path, 'counter')
+    for _ in range(times):
+        with locks.exclusive(path):
+            with open(counter) as f:
+                value = int(f.read())
+            concurrently.atomic_write(counter, str(value + 1))
+
+
+def _increment_threads(locks, path, threads, times):
+    workers = [threading.Thread(target=_increment, args=(locks, path, times))
+               for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+
+class TestLockManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.locks = concurrently.LockManager(
+            os.path.join('%s', '.lock'), 'test')
+
+    def test_no_lost_updates(self):
+        with open(os.path.join(self.tmpdir, 'counter'), 'w') as f:
+            f.write('0')
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    _increment_threads(self.locks, self.tmpdir, 4, 25)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        _increment_threads(self.locks, self.tmpdir, 4, 25)
+        for pid in pids:
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+        with open(os.path.join(self.tmpdir, 'counter')) as f:
+            self.assertEqual('500', f.read())
+        # and the temp files were all renamed into place
+        self.assertEqual(['.lock', 'counter'], sorted(os.listdir(self.tmpdir)))
+
+    def test_shared(self):
+        events = {'readers': threading.Barrier(3), 'wrote': threading.Event()}
+        seen = []
+
+        def reader():
+            with self.locks.shared(self.tmpdir):
+                # both readers get in at once
+                events['readers'].wait(5)
+                time.sleep(.1)
+                seen.append(events['wrote'].is_set())
+
+        def writer():
+            events['readers'].wait(5)
+            with self.locks.exclusive(self.tmpdir):
+                events['wrote'].set()
+
+        threads = [threading.Thread(target=x)
+                   for x in (reader, reader, writer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # the writer waited for both readers
+        self.assertEqual([False, False], seen)
+        self.assertTrue(events['wrote'].is_set())
+
+    def test_atomic_write(self):
+        path = os.path.join(self.tmpdir, 'props.json')
+        concurrently.atomic_write(path, '{}')
+        concurrently.atomic_write(path, '{"a": 1}')
+        with open(path) as f:
+            self.assertEqual('{"a": 1}', f.read())
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(path).st_mode))
+        with self.assertRaises(TypeError):
+            concurrently.atomic_write(path, None)
+        self.assertEqual(['props.json'], os.listdir(self.tmpdir))
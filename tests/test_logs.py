@@ -0,0 +1,145 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from cya_server import logs
+from cya_server.simplemodels import ModelError
+
+
+class TestContainerLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.logdir = os.path.join(
+            self.tmpdir, 'hosts', 'h1', 'containers', 'c1', 'logs')
+        os.makedirs(self.logdir)
+        self.path = os.path.join(self.logdir, 'init')
+
+    def _log(self, rotate_size=10, compression='gzip'):
+        return logs.ContainerLog(self.path, rotate_size, compression)
+
+    def _write(self, clog, data, offset=None):
+        return clog.write(io.BytesIO(data), offset)
+
+    def test_rotate(self):
+        clog = self._log()
+        self.assertEqual(6, self._write(clog, b'line1\n'))
+        self.assertEqual(12, self._write(clog, b'line2\n'))
+        self.assertEqual(18, self._write(clog, b'line3\n'))
+        self.assertEqual(
+            ['.init.lock', 'init', 'init.0-12.gz'],
+            sorted(os.listdir(self.logdir)))
+        self.assertEqual(18, clog.size())
+        self.assertEqual(b'line1\nline2\nline3\n', b''.join(clog.read()))
+        self.assertEqual(b'2\nline3', b''.join(clog.read(10, 17)))
+        self.assertEqual(['init'], [x for x in os.listdir(self.logdir)
+                                    if logs.is_log(x)])
+
+    def test_offsets(self):
+        clog = self._log()
+        self._write(clog, b'line1\nline2\n')
+        # a retry spanning the rotated segment isn't duplicated
+        self.assertEqual(18, self._write(clog, b'line2\nline3\n', 6))
+        with self.assertRaises(ModelError) as e:
+            self._write(clog, b'line5\n', 24)
+        self.assertEqual(409, e.exception.status_code)
+        self.assertEqual(b'line1\nline2\nline3\n', b''.join(clog.read()))
+
+    def test_tail(self):
+        clog = self._log()
+        for x in range(5):
+            self._write(clog, b'line%d\n' % x)
+        self.assertEqual(24, clog.tail_offset(1))
+        self.assertEqual(18, clog.tail_offset(2))
+        self.assertEqual(6, clog.tail_offset(4))
+        self.assertEqual(0, clog.tail_offset(10))
+        with mock.patch.object(logs, 'CHUNK_SIZE', 4):
+            self.assertEqual(12, clog.tail_offset(3))
+            self.assertEqual(
+                b'line3\nline4\n', b''.join(clog.read(clog.tail_offset(2))))
+
+    def test_follow(self):
+        clog = self._log()
+        self._write(clog, b'line1\n')
+        follow = clog.follow(0, 0, 0)
+        self.assertEqual(b'line1\n', next(follow))
+        # rotated while being followed
+        self._write(clog, b'line2\nline3\n')
+        self._write(clog, b'line4\n')
+        self.assertEqual(b'line2\nline3\nline4\n', b''.join(follow))
+
+    def test_idle_rotate(self):
+        clog = self._log(0)
+        self._write(clog, b'line1\n')
+        self.assertFalse(clog.rotate(60))
+        self.assertTrue(clog.rotate(0))
+        self.assertFalse(clog.rotate(0))
+        self.assertEqual(6, self._write(clog, b''))
+        self.assertEqual(b'line1\n', b''.join(clog.read()))
+
+    def test_zstd(self):
+        if logs.zstandard is None:
+            self.skipTest('zstandard is not installed')
+        clog = self._log(compression='zstd')
+        self._write(clog, b'line1\nline2\nline3\n')
+        self.assertTrue(os.path.exists(self.path + '.0-18.zst'))
+        self.assertEqual(b'line2\nline3\n', b''.join(clog.read(6)))
+        self.assertEqual(12, clog.tail_offset(1))
+
+    def test_compact(self):
+        hosts = os.path.join(self.tmpdir, 'hosts')
+        clog = self._log(6)
+        for x in range(4):
+            self._write(clog, b'line%d\n' % x)
+        other = logs.ContainerLog(os.path.join(self.logdir, 'other'))
+        self._write(other, b'other\n')
+        self.assertEqual(0, logs.compact(hosts, 0, 60, 'gzip'))
+        self.assertEqual([], other.segments())
+        os.utime(other.path, (0, 0))
+        self.assertEqual(0, logs.compact(hosts, 0, 60, 'gzip'))
+        # the idle "other" log was rotated and compressed
+        self.assertEqual(1, len(other.segments()))
+        self.assertEqual(b'other\n', b''.join(other.read()))
+
+        segments = clog.segments()
+        self.assertEqual(4, len(segments))
+        for i, (start, end, path) in enumerate(segments):
+            os.utime(path, (i, i))
+        budget = os.path.getsize(segments[-1][2]) + os.path.getsize(
+            other.segments()[0][2])
+        self.assertEqual(3, logs.compact(hosts, budget, 60, 'gzip'))
+        self.assertEqual(b'line3\n', b''.join(clog.read()))
+        self.assertEqual(24, clog.size())
+        self.assertEqual(18, clog.first_offset())
+
+        # with everything deleted, new data still goes where it belongs
+        self.assertEqual(2, logs.compact(hosts, 1, 60, 'gzip'))
+        self.assertEqual(b'', b''.join(clog.read()))
+        self.assertEqual(24, clog.first_offset())
+        self.assertEqual(30, self._write(clog, b'line4\n', 24))
+        self.assertEqual(b'line4\n', b''.join(clog.read()))
+
+    def test_compactor_lock(self):
+        lockfile = os.path.join(self.tmpdir, 'compact.lock')
+        calls = []
+
+        def func():
+            calls.append(inner.run_once())
+            return 1
+        inner = logs.Compactor(lambda: 2, lockfile, 1)
+        self.assertEqual(1, logs.Compactor(func, lockfile, 1).run_once())
+        self.assertEqual([None], calls)
+        self.assertEqual(2, inner.run_once())
+
+    def test_compactor_min_age(self):
+        lockfile = os.path.join(self.tmpdir, 'compact.lock')
+        compactor = logs.Compactor(lambda: 1, lockfile, 1)
+        self.assertEqual(1, compactor.run_once())
+        # another worker just did it
+        self.assertIsNone(compactor.run_once(60))
+        os.utime(lockfile, (0, 0))
+        self.assertEqual(1, compactor.run_once(60))
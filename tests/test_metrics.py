@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+from cya_server import metrics
+
+
+def _child(dirname):
+    metrics.props_writes.inc(3, backend='test', op='child')
+    metrics.dump(dirname)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _lines(self, name, dirname=None):
+        return [x for x in metrics.render(dirname).splitlines()
+                if x.startswith(name)]
+
+    def test_counter(self):
+        c = metrics.props_writes
+        c.inc(backend='test', op='x')
+        c.inc(2, backend='test', op='x')
+        self.assertEqual(3, c.get(backend='test', op='x'))
+        self.assertIn('cya_props_writes_total{backend="test",op="x"} 3.0',
+                      self._lines('cya_props_writes_total'))
+        with self.assertRaises(ValueError):
+            c.inc(backend='test')
+
+    def test_histogram(self):
+        h = metrics.Histogram('test_seconds', 'Test', ['l'], (0.1, 1))
+        self.addCleanup(metrics._registry.remove, h)
+        h.observe(0.05, l='a"b')
+        h.observe(0.5, l='a"b')
+        h.observe(5, l='a"b')
+        self.assertEqual(3, h.count(l='a"b'))
+        self.assertEqual([
+            'test_seconds_bucket{l="a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{l="a\\"b",le="1.0"} 2',
+            'test_seconds_bucket{l="a\\"b",le="+Inf"} 3',
+            'test_seconds_sum{l="a\\"b"} 5.55',
+            'test_seconds_count{l="a\\"b"} 3',
+        ], self._lines('test_seconds'))
+
+    def test_processes(self):
+        metrics.props_writes.inc(backend='test', op='child')
+        p = multiprocessing.get_context('fork').Process(
+            target=_child, args=(self.tmpdir,))
+        p.start()
+        p.join()
+        # the child is gone, so its counts are too
+        self.assertIn(
+            'cya_props_writes_total{backend="test",op="child"} 1.0',
+            self._lines('cya_props_writes_total', self.tmpdir))
+
+        with mock.patch('os.kill'):
+            p = multiprocessing.get_context('fork').Process(
+                target=_child, args=(self.tmpdir,))
+            p.start()
+            p.join()
+            self.assertIn(
+                'cya_props_writes_total{backend="test",op="child"} 4.0',
+                self._lines('cya_props_writes_total', self.tmpdir))
+
+    def test_dump_threads(self):
+        errors = []
+
+        def dump():
+            try:
+                for _ in range(20):
+                    metrics.dump(self.tmpdir)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=dump) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(['%d.json' % os.getpid()], os.listdir(self.tmpdir))
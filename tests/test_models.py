@@ -1,9 +1,18 @@
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
-from cya_server.models import container_requests, hosts, SecretField
+from unittest import mock
+
+from cya_server.models import (
+    container_requests, hosts, host_api_keys, placement, Revision,
+    SecretField)
+from cya_server.scheduler import (
+    BestFit, PlacementPolicy, WorstFit, get_policy)
+from cya_server.simplemodels import get_storage
+from tests import use_sqlite
 
 h1 = {
     'distro_id': 'ubuntu',
@@ -42,6 +51,57 @@ class TestModels(unittest.TestCase):
         self.assertEqual('foo', h.containers.get('c1').template)
         self.assertEqual('c1', h.to_dict()['containers'][0]['name'])
 
+    def test_update_own_fields(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'foo'}]
+        hosts.create('host_1', h)
+        h = hosts.get('host_1')
+        h.update({'cpu_total': 12})
+        self.assertEqual(12, h.cpu_total)
+        props = get_storage().load(h._modeldir)
+        self.assertEqual(12, props['cpu_total'])
+        self.assertNotIn('containers', props)
+        self.assertEqual('foo', hosts.get('host_1').containers.get(
+            'c1').template)
+
+    def test_compact(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'foo'}]
+        hosts.create('host_1', h)
+        h = hosts.get('host_1')
+        # what update() used to write
+        data = h.to_dict()
+        get_storage().update(h._modeldir, lambda props: data)
+        self.assertEqual(1, hosts.compact())
+        self.assertNotIn('containers', get_storage().load(h._modeldir))
+        h = hosts.get('host_1')
+        self.assertEqual('ubuntu', h.distro_id)
+        self.assertEqual('c1', h.to_dict()['containers'][0]['name'])
+        self.assertEqual(0, hosts.compact())
+
+    def test_log_reads(self):
+        h = h1.copy()
+        h['containers'] = [{'name': 'c1', 'template': 'foo'}]
+        hosts.create('host_1', h)
+        c = hosts.get('host_1').containers.get('c1')
+        c.append_log('init', 'a\nbb\nccc\n')
+        self.assertEqual(9, c.get_log_size('init'))
+        self.assertEqual(b'bb\nc', b''.join(c.read_log('init', 2, 6)))
+
+        self.assertEqual(5, c.log_tail_offset('init', 1))
+        self.assertEqual(2, c.log_tail_offset('init', 2))
+        self.assertEqual(0, c.log_tail_offset('init', 3))
+        self.assertEqual(0, c.log_tail_offset('init', 30))
+        self.assertEqual(9, c.log_tail_offset('init', 0))
+        c.append_log('init', 'dd')
+        self.assertEqual(9, c.log_tail_offset('init', 1))
+        self.assertEqual(5, c.log_tail_offset('init', 2))
+
+        with mock.patch('cya_server.logs.CHUNK_SIZE', 2):
+            self.assertEqual(2, c.log_tail_offset('init', 3))
+            self.assertEqual([b'cc', b'c\n', b'dd'],
+                             list(c.follow_log('init', 5, 0)))
+
     def test_secret(self):
         sf = SecretField('test')
         password = 'foobar'
@@ -57,6 +117,56 @@ class TestModels(unittest.TestCase):
         self.assertNotEqual('123', h.api_key)
         self.assertTrue(SecretField.verify('123', h.api_key))
 
+    def test_api_key_cache(self):
+        host_api_keys.invalidate()
+        data = h1.copy()
+        data['api_key'] = '123'
+        hosts.create('host_1', data)
+        h = hosts.get('host_1')
+        self.assertTrue(h.verify_api_key('123'))
+        with mock.patch.object(SecretField, 'verify') as verify:
+            self.assertTrue(h.verify_api_key('123'))
+            self.assertFalse(verify.called)
+            # a different key must always be verified for real
+            verify.return_value = False
+            self.assertFalse(h.verify_api_key('1234'))
+            self.assertTrue(verify.called)
+
+    def test_api_key_cache_invalidate(self):
+        host_api_keys.invalidate()
+        data = h1.copy()
+        data['api_key'] = '123'
+        hosts.create('host_1', data)
+        h = hosts.get('host_1')
+        self.assertTrue(h.verify_api_key('123'))
+
+        h.update({'api_key': '456'})
+        h = hosts.get('host_1')
+        self.assertFalse(h.verify_api_key('123'))
+        self.assertTrue(h.verify_api_key('456'))
+
+        h.delete()
+        self.assertNotIn('host_1', host_api_keys._entries)
+
+
+class TestModelsSQLite(TestModels):
+    def setUp(self):
+        super(TestModelsSQLite, self).setUp()
+        use_sqlite(self, self.modelsdir)
+
+    def test_move(self):
+        hosts.create('host_1', h1)
+        src = os.path.join(self.modelsdir, 'reqs', 'c1')
+        get_storage().create(src, {'template': 'foo'})
+        dst = os.path.join(hosts.get('host_1').containers._model_dir, 'c1')
+        get_storage().move(src, dst)
+        self.assertEqual('foo', hosts.get('host_1').containers.get(
+            'c1').template)
+        with self.assertRaises(FileExistsError):
+            get_storage().move(dst, dst)
+        with self.assertRaises(FileNotFoundError):
+            get_storage().move(src, dst + '2')
+
 
 class TestScheduler(unittest.TestCase):
     def setUp(self):
@@ -66,6 +176,7 @@ class TestScheduler(unittest.TestCase):
         container_requests._model_dir = os.path.join(self.modelsdir, 'reqs')
         os.mkdir(hosts._model_dir)
         os.mkdir(container_requests._model_dir)
+        self._use_storage()
 
         hosts.create('host1', h1)
         hosts.create('host2', h1)
@@ -77,6 +188,9 @@ class TestScheduler(unittest.TestCase):
             'release': 'xenial',
         }
 
+    def _use_storage(self):
+        pass
+
     def test_offline(self):
         """The scheduler is okay if everything is offline"""
         container_requests.create('container_foo', self.container_data)
@@ -103,6 +217,20 @@ class TestScheduler(unittest.TestCase):
         self.assertEqual(1, container_requests.count())
         self.assertEqual(0, self.host1.containers.count())
 
+    def test_queue_not_read(self):
+        """The queue isn't loaded when nothing could be placed"""
+        container_requests.create('container_foo', self.container_data)
+        # every host is offline
+        with mock.patch.object(container_requests, 'get') as get:
+            self.assertEqual([], container_requests.handle(self.host1))
+            self.assertFalse(get.called)
+        self.host1.ping()
+        self.host2.update({'enlisted': False})
+        with mock.patch.object(container_requests, 'get') as get:
+            container_requests.handle(hosts.get('host2'))
+            self.assertFalse(get.called)
+        self.assertEqual(1, container_requests.count())
+
     def test_max_containers(self):
         """Ensure we honor max_containers"""
         self.host1.ping()
@@ -134,3 +262,201 @@ class TestScheduler(unittest.TestCase):
         container_requests.handle(self.host1)
         self.assertEqual(0, container_requests.count())
         self.assertEqual(1, self.host1.containers.count())
+
+    def test_no_fleet_scan(self):
+        """Placement decisions don't re-read the whole fleet"""
+        self.host1.ping()
+        self.host2.ping()
+        container_requests.create('c1', self.container_data)
+        container_requests.handle(self.host1)
+        container_requests.create('c2', self.container_data)
+        with mock.patch.object(hosts, 'list') as hosts_list:
+            container_requests.handle(self.host2)
+            self.assertFalse(hosts_list.called)
+        self.assertEqual(1, self.host1.containers.count())
+        self.assertEqual(1, self.host2.containers.count())
+
+    def test_batch(self):
+        """One pass places everything the fleet has room for"""
+        self.host1.ping()
+        self.host2.ping()
+        self.host2.update({'max_containers': 2})
+        for x in range(6):
+            container_requests.create('c%d' % x, self.container_data)
+        placed = container_requests.handle(self.host1)
+        self.assertEqual(6, len(placed))
+        self.assertEqual(0, container_requests.count())
+        self.assertEqual(4, self.host1.containers.count())
+        self.assertEqual(2, self.host2.containers.count())
+
+    def test_batch_memory(self):
+        """Hosts aren't given more memory than they have"""
+        self.host1.ping()
+        self.host2.ping()
+        self.host1.update({'mem_total': 10})
+        self.host2.update({'mem_total': 8})
+        data = self.container_data.copy()
+        data['max_memory'] = 6
+        for x in range(3):
+            container_requests.create('big%d' % x, data)
+        data['max_memory'] = 2
+        container_requests.create('small', data)
+        container_requests.handle(self.host1)
+        # both hosts take one big, small still fits on one of them
+        self.assertEqual(['big2'], list(container_requests.list()))
+        self.assertEqual(2, self.host1.containers.count())
+        self.assertEqual(1, self.host2.containers.count())
+
+    def test_container_deleted(self):
+        """Deleting a container makes its host a candidate again"""
+        self.host1.ping()
+        self.host2.ping()
+        container_requests.create('c1', self.container_data)
+        container_requests.handle(self.host1)
+        self.assertEqual('host2', placement.best().name)
+        self.host1.containers.get('c1').delete()
+        self.assertEqual('host1', placement.best().name)
+
+    def test_changed_on_disk(self):
+        """The best candidate is re-checked against what's on disk"""
+        self.host1.ping()
+        self.host2.ping()
+        self.assertEqual('host1', placement.best().name)
+        # simulate another server process giving host1 a container
+        get_storage().create(
+            os.path.join(self.host1.containers._model_dir, 'c1'), {})
+        self.assertEqual('host2', placement.best().name)
+
+    def _fit_setup(self, policy):
+        old = placement.policy
+        placement.policy = policy
+        self.addCleanup(setattr, placement, 'policy', old)
+        self.host1.ping()
+        self.host2.ping()
+        self.host1.update({'mem_total': 16})
+        self.host2.update({'mem_total': 10})
+        data = self.container_data.copy()
+        data['max_memory'] = 4
+        container_requests.create('c0', data)
+        container_requests.handle(self.host1)
+
+    def test_best_fit(self):
+        """Best fit packs containers onto the fullest host that fits"""
+        self._fit_setup(BestFit())
+        self.assertEqual(1, self.host2.containers.count())
+        data = self.container_data.copy()
+        data['max_memory'] = 4
+        container_requests.create('c1', data)
+        data['max_memory'] = 8
+        container_requests.create('c2', data)
+        container_requests.handle(self.host1)
+        # c1 fills host2 to 8/10, c2 only fits on host1
+        self.assertEqual(['c0', 'c1'], sorted(self.host2.containers.list()))
+        self.assertEqual(['c2'], list(self.host1.containers.list()))
+
+    def test_worst_fit(self):
+        """Worst fit spreads containers onto the emptiest host"""
+        self._fit_setup(WorstFit())
+        self.assertEqual(1, self.host1.containers.count())
+        data = self.container_data.copy()
+        data['max_memory'] = 4
+        container_requests.create('c1', data)
+        container_requests.create('c2', data)
+        container_requests.handle(self.host1)
+        # host1 12 free vs host2 10, then host1 8 free vs host2 10
+        self.assertEqual(['c0', 'c1'], sorted(self.host1.containers.list()))
+        self.assertEqual(['c2'], list(self.host2.containers.list()))
+
+    def test_heartbeat(self):
+        """Pings are kept in a constant size record"""
+        self.assertFalse(self.host1.online)
+        self.host1.ping()
+        self.assertTrue(self.host1.online)
+        path = os.path.join(self.host1._modeldir, 'heartbeat')
+        size = os.path.getsize(path)
+        for x in range(40):
+            self.host1.ping()
+        self.assertEqual(size, os.path.getsize(path))
+        pings = self.host1.pings
+        self.assertEqual(16, len(pings))
+        self.assertEqual(pings[0], self.host1.last_ping)
+        self.assertEqual(sorted(pings, reverse=True), pings)
+
+    def test_compact_pings(self):
+        """Old pings.log files get moved into the heartbeat"""
+        now = int(time.time())
+        os.makedirs(self.host1._modeldir, exist_ok=True)
+        with open(os.path.join(self.host1._modeldir, 'pings.log'), 'w') as f:
+            for x in range(100, -1, -1):
+                f.write('%d\n' % (now - x))
+        self.assertTrue(self.host1.online)
+        self.assertTrue(self.host1.compact_pings())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.host1._modeldir, 'pings.log')))
+        self.assertEqual(now, self.host1.last_ping)
+        self.assertEqual(
+            [now - x for x in range(16)], self.host1.pings)
+        self.assertFalse(self.host1.compact_pings())
+
+    def test_compact_pings_race(self):
+        """A pings.log another worker moved first isn't an error"""
+        now = int(time.time())
+        os.makedirs(self.host1._modeldir, exist_ok=True)
+        ping_file = os.path.join(self.host1._modeldir, 'pings.log')
+        with open(ping_file, 'w') as f:
+            f.write('%d\n' % now)
+        with mock.patch('os.unlink', side_effect=FileNotFoundError):
+            self.assertTrue(self.host1.compact_pings())
+        self.assertEqual([now], self.host1.pings)
+
+    def test_pings_created(self):
+        """A heartbeat that is still being created has no pings"""
+        os.makedirs(self.host1._modeldir, exist_ok=True)
+        open(os.path.join(self.host1._modeldir, 'heartbeat'), 'w').close()
+        self.assertEqual([], self.host1.pings)
+
+    def test_revision(self):
+        """Changes to a host's containers bump its revision"""
+        self.host1.ping()
+        rev = self.host1.revision
+        container_requests.create('c1', self.container_data)
+        self.assertEqual(rev, self.host1.revision)
+        container_requests.handle(self.host1)
+        self.assertLess(rev, self.host1.revision)
+        rev = self.host1.revision
+        self.host1.containers.get('c1').update({'keep_running': False})
+        self.assertLess(rev, self.host1.revision)
+        rev = self.host1.revision
+        # the client reporting on a container doesn't wake it up again
+        reported = self.host1.reported_revision
+        self.host1.containers.get('c1').update(
+            {'state': 'STOPPED', 'ips': '10.0.3.2', 'keep_running': False})
+        self.assertEqual(rev, self.host1.revision)
+        self.assertLess(reported, self.host1.reported_revision)
+        self.host1.containers.get('c1').delete()
+        self.assertLess(rev, self.host1.revision)
+        rev = self.host1.revision
+        self.assertEqual(rev, self.host1.wait_for_change(rev, 0.1))
+        self.host2.changed()
+        self.assertEqual(rev, self.host1.revision)
+        # nothing is waiting, so no Condition is kept for the host
+        path = self.host1._get_revision().path
+        self.assertNotIn(path, Revision._conditions)
+
+    def test_get_policy(self):
+        self.assertIsInstance(get_policy('best-fit'), BestFit)
+        self.assertIsInstance(
+            get_policy('cya_server.scheduler:WorstFit'), WorstFit)
+        with self.assertRaises(ValueError):
+            get_policy('bad')
+
+    def test_incomplete_policy(self):
+        class NoChoice(PlacementPolicy):
+            pass
+        with self.assertRaises(TypeError):
+            NoChoice()
+
+
+class TestSchedulerSQLite(TestScheduler):
+    def _use_storage(self):
+        use_sqlite(self, self.modelsdir)
@@ -1,8 +1,19 @@
+import json
+import os
 import shutil
 import tempfile
+import threading
 import unittest
 
-from cya_server.simplemodels import Field, Model, ModelManager, ModelError
+from unittest import mock
+
+from cya_server.simplemodels import (
+    Field, Model, ModelManager, ModelError, copy_models, get_storage,
+    set_storage)
+from cya_server.storage import (
+    Counter, FieldIndex, FilesystemBackend, PropsCache, SQLiteBackend,
+    StorageBackend, props_cache)
+from tests import use_sqlite
 
 
 class TestFields(unittest.TestCase):
@@ -68,9 +79,276 @@ class TestModel(unittest.TestCase):
         with self.assertRaises(ModelError):
             m.update({'intfield': '12'})
 
+    def test_update_processes(self):
+        '''updates from server worker processes and threads are never
+           lost'''
+        self.models.create('m1', {'strfield': 'x', 'intfield': 0})
+        path = os.path.join(self.models._model_dir, 'm1')
+
+        def incr(props):
+            props['intfield'] += 1
+            return props
+
+        def update():
+            for _ in range(25):
+                get_storage().update(path, incr)
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    for _ in range(25):
+                        get_storage().update(path, incr)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for pid in pids:
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+        self.assertEqual(200, self.models.get('m1').intfield)
+
     def test_delete(self):
         self.models.create('m1', {'strfield': 'x', 'intfield': 42})
         m = self.models.get('m1')
         m.delete()
         with self.assertRaises(ModelError):
             m = self.models.get('m1')
+
+
+class TestModelSQLite(TestModel):
+    def setUp(self):
+        super(TestModelSQLite, self).setUp()
+        use_sqlite(self, self.modeldir)
+
+    def test_find(self):
+        models = ModelManager(self.modeldir, IndexedModel)
+        models.create('m1', {'key': 'k1'})
+        models.create('m2', {'key': 'k2'})
+        self.assertEqual('m2', models.find('key', 'k2').name)
+        models.get('m2').update({'key': 'k3'})
+        self.assertIsNone(models.find('key', 'k2'))
+        self.assertEqual('m2', models.find('key', 'k3').name)
+
+
+class TestStorageBackend(unittest.TestCase):
+    def test_incomplete(self):
+        class NoMove(FilesystemBackend):
+            move = StorageBackend.move
+        with self.assertRaises(TypeError):
+            NoMove()
+
+
+class TestCounter(unittest.TestCase):
+    def setUp(self):
+        super(TestCounter, self).setUp()
+        self.modeldir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.modeldir)
+        self.models = ModelManager(self.modeldir, MyModel)
+        self.counter = Counter(self.models._model_dir)
+
+    def _create(self, name):
+        self.models.create(name, {'strfield': 'x', 'intfield': 1})
+
+    def test_no_listing(self):
+        self._create('m1')
+        self.assertEqual(1, self.models.count())
+        self._create('m2')
+        with mock.patch('os.listdir') as listdir:
+            self.assertEqual(2, self.models.count())
+            self.models.get('m1').delete()
+            self.assertEqual(1, self.models.count())
+            self.assertFalse(listdir.called)
+
+    def test_move(self):
+        self._create('m1')
+        other = ModelManager(os.path.join(self.modeldir, 'other'), MyModel)
+        self.assertEqual(0, other.count())
+        self.assertEqual(1, self.models.count())
+        get_storage().move(os.path.join(self.models._model_dir, 'm1'),
+                           os.path.join(other._model_dir, 'm1'))
+        self.assertEqual(0, self.models.count())
+        self.assertEqual(1, other.count())
+
+    def test_move_rename(self):
+        self._create('m1')
+        get_storage().move(os.path.join(self.models._model_dir, 'm1'),
+                           os.path.join(self.models._model_dir, 'm2'))
+        self.assertEqual(1, self.models.count())
+        self.assertEqual(['m2'], list(self.models.list()))
+
+    def test_drift(self):
+        self._create('m1')
+        self._create('m2')
+        self.assertEqual(2, self.models.count())
+        # a crash between changing the collection and the count
+        shutil.rmtree(os.path.join(self.models._model_dir, 'm2'))
+        self.assertEqual(2, self.models.count())
+        self.assertEqual(['m1'], list(self.models.list()))
+        self.assertEqual(1, self.models.count())
+
+    def test_missing(self):
+        self.assertEqual(0, self.models.count())
+        self._create('m1')
+        self.assertEqual(1, self.models.count())
+        os.unlink(self.counter.path)
+        self.assertEqual(1, self.models.count())
+
+
+class ParentModel(Model):
+    FIELDS = [
+        Field('strfield', str, ''),
+    ]
+    CHILDREN = [MyModel]
+
+
+class TestCopyModels(unittest.TestCase):
+    def setUp(self):
+        super(TestCopyModels, self).setUp()
+        self.modeldir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.modeldir)
+        self.models = ModelManager(self.modeldir, ParentModel)
+        self.sqlite = SQLiteBackend(os.path.join(self.modeldir, 'db'))
+        self.addCleanup(self.sqlite.close)
+
+    def test_copy(self):
+        self.models.create('p1', {'strfield': 'x', 'mymodels': [
+            {'name': 'c1', 'strfield': 'y', 'intfield': 1}]})
+        self.models.create('p2', {'strfield': 'z'})
+        self.assertEqual(
+            3, copy_models(get_storage(), self.sqlite, [self.models]))
+        shutil.rmtree(self.models._model_dir)
+
+        self.addCleanup(set_storage, get_storage())
+        set_storage(self.sqlite)
+        self.assertEqual(['p1', 'p2'], list(self.models.list()))
+        p1 = self.models.get('p1').to_dict()
+        self.assertEqual('y', p1['mymodels'][0]['strfield'])
+
+        # and back again
+        self.assertEqual(
+            3, copy_models(self.sqlite, FilesystemBackend(), [self.models]))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.models._model_dir, 'p1/mymodels/c1/props.json')))
+
+
+class TestPropsCache(unittest.TestCase):
+    def setUp(self):
+        super(TestPropsCache, self).setUp()
+        self.modeldir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.modeldir)
+        self.models = ModelManager(self.modeldir, MyModel)
+        props_cache.invalidate()
+
+    def test_cached(self):
+        self.models.create('m1', {'strfield': 'x', 'intfield': 42})
+        self.assertEqual('x', self.models.get('m1').strfield)
+        with mock.patch('json.load') as load:
+            self.assertEqual('x', self.models.get('m1').strfield)
+            self.assertEqual(42, self.models.get('m1').intfield)
+            self.assertFalse(load.called)
+
+    def test_update_seen(self):
+        self.models.create('m1', {'strfield': 'x', 'intfield': 42})
+        self.assertEqual('x', self.models.get('m1').strfield)
+        self.models.get('m1').update({'strfield': 'y'})
+        self.assertEqual('y', self.models.get('m1').strfield)
+
+    def test_external_change_seen(self):
+        self.models.create('m1', {'strfield': 'x', 'intfield': 42})
+        self.assertEqual('x', self.models.get('m1').strfield)
+        # simulate another process rewriting the file in place
+        path = os.path.join(self.modeldir, 'mymodels/m1/props.json')
+        with open(path, 'w') as f:
+            json.dump({'strfield': 'longer', 'intfield': 42}, f)
+        self.assertEqual('longer', self.models.get('m1').strfield)
+
+    def test_parse_per_caller(self):
+        models = ModelManager(self.modeldir, OptionalModel)
+        models.create('m1', {'strfield': 'x'})
+        path = os.path.join(self.modeldir, 'optionalmodels/m1')
+        # saved before optfield existed
+        with open(os.path.join(path, 'props.json'), 'w') as f:
+            json.dump({'strfield': 'x'}, f)
+        # an unparsed load mustn't be handed to a caller wanting defaults
+        self.assertEqual({'strfield': 'x'}, get_storage().load(path))
+        self.assertEqual(7, models.get('m1').optfield)
+        self.assertEqual(7, models.snapshot()[0]['optfield'])
+
+    def test_lru(self):
+        cache = PropsCache(max_size=2)
+        path = os.path.join(self.modeldir, 'mymodels/m%d/props.json')
+        for x in range(3):
+            self.models.create('m%d' % x, {'strfield': 'x', 'intfield': x})
+            cache.load(path % x)
+        self.assertEqual(2, len(cache._entries))
+        self.assertNotIn(path % 0, cache._entries)
+
+
+class OptionalModel(Model):
+    FIELDS = [
+        Field('strfield', str, ''),
+        Field('optfield', int, 7, required=False),
+    ]
+
+
+class IndexedModel(Model):
+    FIELDS = [
+        Field('key', str),
+    ]
+    INDEXES = ['key']
+
+
+class TestFieldIndex(unittest.TestCase):
+    def setUp(self):
+        super(TestFieldIndex, self).setUp()
+        self.modeldir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.modeldir)
+        self.models = ModelManager(self.modeldir, IndexedModel)
+        self.index = FieldIndex(self.models._model_dir, 'key')
+
+    def test_built_on_first_use(self):
+        self.models.create('m1', {'key': 'k1'})
+        self.models.create('m2', {'key': 'k2'})
+        self.assertFalse(self.index.exists())
+        self.assertEqual('m2', self.models.find('key', 'k2').name)
+        self.assertTrue(self.index.exists())
+        self.assertIsNone(self.models.find('key', 'k3'))
+
+    def test_maintained(self):
+        self.models.create('m1', {'key': 'k1'})
+        self.assertEqual('m1', self.models.find('key', 'k1').name)
+
+        self.models.create('m2', {'key': 'k2'})
+        self.assertEqual('m2', self.index.get('k2'))
+
+        self.models.get('m2').update({'key': 'k3'})
+        self.assertIsNone(self.index.get('k2'))
+        self.assertEqual('m2', self.models.find('key', 'k3').name)
+
+        self.models.get('m1').delete()
+        self.assertIsNone(self.index.get('k1'))
+        self.assertIsNone(self.models.find('key', 'k1'))
+
+    def test_stale(self):
+        self.models.create('m1', {'key': 'k1'})
+        self.models.find('key', 'k1')
+        # change the value behind the index's back
+        path = os.path.join(self.models._model_dir, 'm1/props.json')
+        with open(path, 'w') as f:
+            json.dump({'key': 'something-else'}, f)
+        self.assertIsNone(self.models.find('key', 'k1'))
+        self.assertEqual('m1', self.models.find('key', 'something-else').name)
+
+    def test_rebuild(self):
+        self.models.create('m1', {'key': 'k1'})
+        self.models.rebuild_indexes()
+        self.assertEqual('m1', self.index.get('k1'))
+        shutil.rmtree(self.index.path)
+        self.models.rebuild_indexes()
+        self.assertEqual('m1', self.index.get('k1'))